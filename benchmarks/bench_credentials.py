@@ -0,0 +1,43 @@
+#!/usr/bin/python
+"""
+Micro-benchmark of the per-event credential cost.
+
+Compares decrypting the API key with a fresh AES cipher on every event (what Datadog.post_event used to do) with
+reading the cached header from a CredentialVault.
+
+    python benchmarks/bench_credentials.py [--events 10000]
+"""
+import os
+import sys
+import timeit
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from vcenterdd.datadog.encryption import AESCipher
+from vcenterdd.datadog.vault import CredentialVault
+
+API_KEY = '0123456789abcdef0123456789abcdef'
+
+
+def per_call_decrypt(events):
+    cipher = AESCipher()
+    enc = cipher.encrypt(API_KEY)
+    for _ in range(events):
+        {'DD-API-KEY': cipher.decrypt(key=cipher.AES_KEY, enc=enc)}
+
+
+def vault_headers(events):
+    vault = CredentialVault(API_KEY)
+    for _ in range(events):
+        vault.api_headers
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Per-event credential cost")
+    parser.add_argument('--events', required=False, action='store', type=int, default=10000)
+    args = parser.parse_args()
+
+    for name, func in (('per-call decrypt', per_call_decrypt), ('credential vault', vault_headers)):
+        seconds = min(timeit.repeat(lambda: func(args.events), number=1, repeat=3))
+        print('{:<18} {:>10.3f} us/event'.format(name, seconds / args.events * 1e6))
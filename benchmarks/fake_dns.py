@@ -0,0 +1,77 @@
+"""
+Local stub DNS server for the benchmarks. Answers A queries for the names it knows (with a CNAME to the FQDN
+when the name is short) and NXDOMAIN for everything else, after an optional delay.
+"""
+import time
+import socket
+import threading
+
+
+class FakeDns(object):
+
+    def __init__(self, records=None, domain='example.com', latency=0.0, ttl=300):
+        """
+        :param records: dict of name -> ip, names not listed get NXDOMAIN
+        :param domain: short names are answered with a CNAME to name.domain
+        :param latency: seconds before answering
+        """
+        self.records = {k.lower().rstrip('.'): v for k, v in (records or {}).items()}
+        self.domain = domain
+        self.latency = latency
+        self.ttl = ttl
+        self.queries = 0
+        self.sock = None
+        self._stop = threading.Event()
+
+    @property
+    def port(self):
+        return self.sock.getsockname()[1]
+
+    def resolver(self, timeout=1.0):
+        """ :return: a dns.resolver.Resolver pointed at this server """
+        import dns.resolver
+
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.nameservers = ['127.0.0.1']
+        resolver.port = self.port
+        resolver.lifetime = resolver.timeout = timeout
+        return resolver
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(0.2)
+        threading.Thread(target=self._serve, name='fake-dns', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _serve(self):
+        import dns.message
+        import dns.rcode
+        import dns.rrset
+
+        while not self._stop.is_set():
+            try:
+                data, address = self.sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            self.queries += 1
+            query = dns.message.from_wire(data)
+            response = dns.message.make_response(query)
+            qname = query.question[0].name
+            name = qname.to_text().rstrip('.').lower()
+            short = name.split('.')[0]
+            if name in self.records or short in self.records:
+                ip = self.records.get(name) or self.records[short]
+                target = qname.to_text()
+                if '.' not in name:
+                    target = '{}.{}.'.format(name, self.domain)
+                    response.answer.append(dns.rrset.from_text(qname, self.ttl, 'IN', 'CNAME', target))
+                response.answer.append(dns.rrset.from_text(target, self.ttl, 'IN', 'A', ip))
+            else:
+                response.set_rcode(dns.rcode.NXDOMAIN)
+            if self.latency:
+                time.sleep(self.latency)
+            self.sock.sendto(response.to_wire(), address)
@@ -0,0 +1,87 @@
+"""
+Local stand-in for api.datadoghq.com.
+
+Accepts events, series and logs on any path, answers like Datadog (202 with an event id) after a configurable
+latency, and injects 429 (with Retry-After and X-RateLimit-* headers) and 5xx responses at configurable rates.
+"""
+import json
+import time
+import random
+import threading
+import itertools
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class _IntakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes; without this Nagle + delayed ACK add ~40 ms per response
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        intake = self.server.intake
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if intake.latency:
+            time.sleep(intake.latency)
+        roll = intake.random.random()
+        headers = {'X-RateLimit-Limit': str(intake.rate_limit), 'X-RateLimit-Period': '1'}
+        if roll < intake.error_rate:
+            code, body = 503, {'errors': ['Service unavailable']}
+        elif roll < intake.error_rate + intake.throttle_rate:
+            code, body = 429, {'errors': ['Rate limit exceeded']}
+            headers.update({'Retry-After': str(intake.retry_after), 'X-RateLimit-Remaining': '0',
+                            'X-RateLimit-Reset': str(intake.retry_after)})
+        else:
+            code, body = 202, {'status': 'ok', 'event': {'id': next(intake.ids)}}
+        intake.count(code)
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeIntake(object):
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, error_rate=0.0, retry_after=0.1, rate_limit=1000, seed=None):
+        """
+        :param latency: seconds before each response
+        :param throttle_rate: fraction of requests answered with 429
+        :param error_rate: fraction of requests answered with 503
+        """
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.ids = itertools.count(1)
+        self.responses = {}
+        self._lock = threading.Lock()
+        self.server = None
+
+    def count(self, code):
+        with self._lock:
+            self.responses[code] = self.responses.get(code, 0) + 1
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/api/v1/'.format(self.server.server_port)
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _IntakeHandler)
+        self.server.daemon_threads = True
+        self.server.intake = self
+        threading.Thread(target=self.server.serve_forever, name='fake-intake', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,86 @@
+"""
+Synthetic vCenter alarm storms.
+
+Generates VMWARE_ALARM_* environments the way vCenter sets them for the "Run a Script" action, for the three alarm
+families that dominate storms: datastore usage, host connection and VM CPU usage. Each target flaps between states
+with a tunable probability.
+"""
+import random
+
+ALARM_PROFILES = {
+    'datastore': {
+        'name': 'alarm.DatastoreDiskUsageAlarm',
+        'title': 'Datastore usage on disk',
+        'id': 'alarm-7',
+        'target': ('CL{:04d}NTNXP002_CTR-RF2', 'datastore-{}'),
+        'declaring': '([Yellow metric Is above 75%; Red metric Is above 85%])',
+        'triggering': 'Metric Disk Space actually used = {}%',
+        'states': ('Green', 'Yellow', 'Red'),
+    },
+    'host': {
+        'name': 'alarm.HostConnectionStateAlarm',
+        'title': 'Host connection and power state',
+        'id': 'alarm-1',
+        'target': ('esx{:04d}.example.com', 'host-{}'),
+        'declaring': '([Event alarm expression: Host connection state = notResponding; Red])',
+        'triggering': 'Host connection state = {}',
+        'states': ('Green', 'Red'),
+    },
+    'vm_cpu': {
+        'name': 'alarm.VmCPUUsageAlarm',
+        'title': 'Virtual machine CPU usage',
+        'id': 'alarm-12',
+        'target': ('vm{:05d}.example.com', 'vm-{}'),
+        'declaring': '([Yellow metric Is above 75%; Red metric Is above 90%])',
+        'triggering': 'Metric CPU Usage = {}%',
+        'states': ('Green', 'Yellow', 'Red'),
+    },
+}
+
+
+class AlarmStormGenerator(object):
+
+    def __init__(self, targets=100, families=None, flap_rate=0.3, seed=None):
+        """
+        :param targets: number of distinct targets per alarm family
+        :param families: alarm families to generate, defaults to all of ALARM_PROFILES
+        :param flap_rate: probability that the next alarm re-triggers a target that already fired
+        :param seed: random seed for reproducible storms
+        """
+        self.targets = targets
+        self.families = list(families or ALARM_PROFILES)
+        self.flap_rate = flap_rate
+        self.random = random.Random(seed)
+        self.status = {}
+
+    def alarm(self):
+        """ :return: dict of VMWARE_ALARM_* variables for the next alarm """
+        if self.status and self.random.random() < self.flap_rate:
+            family, index = self.random.choice(list(self.status))
+        else:
+            family, index = self.random.choice(self.families), self.random.randrange(self.targets)
+        profile = ALARM_PROFILES[family]
+        old = self.status.get((family, index), 'Gray')
+        new = self.random.choice([s for s in profile['states'] if s != old])
+        self.status[(family, index)] = new
+
+        target_name = profile['target'][0].format(index)
+        value = self.random.randint(50, 99) if family != 'host' else ('connected' if new == 'Green' else 'notResponding')
+        return {
+            'VMWARE_ALARM_ID': profile['id'],
+            'VMWARE_ALARM_NAME': profile['name'],
+            'VMWARE_ALARM_TARGET_ID': profile['target'][1].format(index + 100),
+            'VMWARE_ALARM_TARGET_NAME': target_name,
+            'VMWARE_ALARM_OLDSTATUS': old,
+            'VMWARE_ALARM_NEWSTATUS': new,
+            'VMWARE_ALARM_EVENTDESCRIPTION': "Alarm '{}' on {} changed from {} to {}".format(
+                profile['title'], target_name, old, new),
+            'VMWARE_ALARM_DECLARINGSUMMARY': profile['declaring'],
+            'VMWARE_ALARM_TRIGGERINGSUMMARY': profile['triggering'].format(value),
+            'VMWARE_ALARM_ALARMVALUE': 'Current values for metric/state',
+        }
+
+    def storm(self, count):
+        """ :return: generator of count alarms """
+        for _ in range(count):
+            yield self.alarm()
@@ -0,0 +1,210 @@
+"""
+End-to-end benchmark of the alarm path.
+
+Times each stage of an alarm against local stand-ins (fake Datadog intake, stub DNS server) and runs a single-shot
+and a storm scenario. Results are written as JSON and can be compared with a stored baseline:
+
+    python -m benchmarks.run --output benchmarks/baseline.json
+    python -m benchmarks.run --baseline benchmarks/baseline.json     # exit code 1 on regression
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import statistics
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from vcenterdd.alarm.handle import VcenterAlarm
+from vcenterdd.alarm.dnscache import DnsCache
+from vcenterdd.datadog.handle import Datadog
+from vcenterdd.datadog.encryption import AESCipher
+from vcenterdd.datadog.vault import CredentialVault
+from vcenterdd.datadog.sender import AsyncSender
+from vcenterdd.datadog.dispatch import Dispatcher, TokenBucket
+from vcenterdd.replay.runner import ReplayRunner
+from .generator import AlarmStormGenerator
+from .fake_intake import FakeIntake
+from .fake_dns import FakeDns
+
+ENV = 'env:bench'
+
+
+def summarize(samples):
+    """ :return: dict with p50/p99/mean in milliseconds of samples in seconds """
+    values = sorted(samples)
+    return {
+        'count': len(values),
+        'p50_ms': values[len(values) // 2] * 1000,
+        'p99_ms': values[min(len(values) - 1, int(len(values) * 0.99))] * 1000,
+        'mean_ms': statistics.mean(values) * 1000,
+    }
+
+
+def timed(func, iterations):
+    samples = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        func(i)
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+class _Static(object):
+    """ Resolver returning a fixed answer, isolates format_datadog_event from DNS """
+
+    @staticmethod
+    def lookup(name):
+        return name
+
+
+def make_datadog(intake, max_in_flight=20):
+    datadog = Datadog(None, config={'api_key': '0123456789abcdef0123456789abcdef'})
+    datadog.sender = AsyncSender(intake.url, max_in_flight=max_in_flight, timeout=5.0)
+    datadog.dispatcher = Dispatcher(datadog.sender, bucket=TokenBucket(rate=intake.rate_limit))
+    return datadog
+
+
+def bench_stages(alarms, intake, dns_server, workdir):
+    stages = {}
+    stages['VcenterAlarm.__init_object'] = timed(lambda i: VcenterAlarm(ENV, environ=alarms[i]), len(alarms))
+
+    built = [VcenterAlarm(ENV, environ=a, resolver=_Static()) for a in alarms]
+    stages['format_datadog_event'] = timed(lambda i: built[i].format_datadog_event(), len(built))
+
+    names = [a['VMWARE_ALARM_TARGET_NAME'] for a in alarms]
+    cache = DnsCache(os.path.join(workdir, 'dns.sqlite'), dns_resolver=dns_server.resolver())
+    stages['_get_fqdn (uncached)'] = timed(lambda i: cache.resolve(names[i]), len(names))
+    cache.prewarm(names)
+    stages['_get_fqdn (cached)'] = timed(lambda i: cache.lookup(names[i]), len(names))
+    cache.close()
+
+    cipher = AESCipher()
+    enc = cipher.encrypt('0123456789abcdef0123456789abcdef')
+    stages['key decryption (per call)'] = timed(lambda i: cipher.decrypt(key=cipher.AES_KEY, enc=enc), len(alarms))
+    vault = CredentialVault('0123456789abcdef0123456789abcdef')
+    stages['key decryption (vault)'] = timed(lambda i: vault.api_headers, len(alarms))
+
+    datadog = make_datadog(intake)
+    stages['post_event'] = timed(lambda i: datadog.post_event(**built[i].datadog_format), len(built))
+    datadog.close()
+    return stages
+
+
+def bench_single_shot(alarms, intake, dns_server, workdir):
+    """ One alarm at a time through the whole path, like sequential script runs with a warm daemon """
+    datadog = make_datadog(intake)
+    cache = DnsCache(os.path.join(workdir, 'single.sqlite'), dns_resolver=dns_server.resolver())
+
+    def one(i):
+        alarm = VcenterAlarm(ENV, environ=alarms[i], resolver=cache)
+        alarm.format_datadog_event()
+        datadog.post_event(**alarm.datadog_format)
+
+    started = time.perf_counter()
+    result = timed(one, len(alarms))
+    result['alarms_per_second'] = len(alarms) / (time.perf_counter() - started)
+    datadog.close()
+    cache.close()
+    return result
+
+
+def bench_storm(alarms, intake, dns_server, workdir, workers=8, window=200):
+    """ A storm pushed through the concurrent replay pipeline """
+    datadog = make_datadog(intake, max_in_flight=50)
+    cache = DnsCache(os.path.join(workdir, 'storm.sqlite'), dns_resolver=dns_server.resolver())
+    runner = ReplayRunner(datadog=datadog, resolver=cache, workers=workers, window=window, keep_time=False)
+    stats = runner.run({'env': ENV, 'alarm': a} for a in alarms)
+    result = summarize(datadog.sender.latencies) if datadog.sender.latencies else {}
+    result.update({'alarms_per_second': stats['alarms_per_second'], 'failed': stats['failed'],
+                   'retries': datadog.dispatcher.stats['retries']})
+    cache.close()
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """ :return: list of regression messages """
+    regressions = []
+    for section in ('stages', 'scenarios'):
+        for name, current in results[section].items():
+            previous = baseline.get(section, {}).get(name)
+            if not previous:
+                continue
+            if previous.get('p50_ms') and current.get('p50_ms', 0) > previous['p50_ms'] * (1 + tolerance):
+                regressions.append('{} p50 {:.3f} ms > baseline {:.3f} ms'.format(
+                    name, current['p50_ms'], previous['p50_ms']))
+            if previous.get('alarms_per_second') and \
+                    current.get('alarms_per_second', 0) < previous['alarms_per_second'] * (1 - tolerance):
+                regressions.append('{} {:.1f} alarms/s < baseline {:.1f} alarms/s'.format(
+                    name, current['alarms_per_second'], previous['alarms_per_second']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end alarm path benchmark")
+    parser.add_argument('--alarms', action='store', type=int, default=500, help='Alarms per stage / single shot')
+    parser.add_argument('--storm', action='store', type=int, default=5000, help='Alarms in the storm scenario')
+    parser.add_argument('--flap-rate', action='store', type=float, default=0.3)
+    parser.add_argument('--latency', action='store', type=float, default=0.005, help='Fake intake latency (s)')
+    parser.add_argument('--throttle-rate', action='store', type=float, default=0.0, help='Fraction of 429s')
+    parser.add_argument('--error-rate', action='store', type=float, default=0.0, help='Fraction of 5xx')
+    parser.add_argument('--dns-latency', action='store', type=float, default=0.002, help='Stub DNS latency (s)')
+    parser.add_argument('--seed', action='store', type=int, default=42)
+    parser.add_argument('--output', action='store', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', action='store', help='Compare with a previous results file')
+    parser.add_argument('--tolerance', action='store', type=float, default=0.25,
+                        help='Allowed relative regression against the baseline')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.ERROR)
+    generator = AlarmStormGenerator(targets=200, flap_rate=args.flap_rate, seed=args.seed)
+    alarms = list(generator.storm(args.alarms))
+    storm = list(generator.storm(args.storm))
+    # half of the targets resolve, the rest (like most datastore names) are NXDOMAIN
+    records = {a['VMWARE_ALARM_TARGET_NAME']: '10.0.0.{}'.format(i % 250 + 1)
+               for i, a in enumerate(alarms + storm) if i % 2 == 0}
+
+    intake = FakeIntake(latency=args.latency, throttle_rate=args.throttle_rate, error_rate=args.error_rate,
+                        seed=args.seed).start()
+    dns_server = FakeDns(records, latency=args.dns_latency).start()
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = {
+                'params': vars(args),
+                'stages': bench_stages(alarms, intake, dns_server, workdir),
+                'scenarios': {
+                    'single_shot': bench_single_shot(alarms, intake, dns_server, workdir),
+                    'storm': bench_storm(storm, intake, dns_server, workdir),
+                },
+                'intake_responses': intake.responses,
+            }
+    finally:
+        intake.stop()
+        dns_server.stop()
+
+    for section in ('stages', 'scenarios'):
+        for name, result in results[section].items():
+            line = '{:<30} p50 {:>9.3f} ms  p99 {:>9.3f} ms'.format(name, result.get('p50_ms', 0),
+                                                                     result.get('p99_ms', 0))
+            if 'alarms_per_second' in result:
+                line += '  {:>9.1f} alarms/s'.format(result['alarms_per_second'])
+            print(line)
+
+    if args.output:
+        with open(args.output, 'wt') as f:
+            json.dump(results, f, indent=2, default=str)
+
+    if args.baseline:
+        with open(args.baseline, 'rt') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for message in regressions:
+            print('REGRESSION: {}'.format(message))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
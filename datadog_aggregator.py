@@ -0,0 +1,147 @@
+#!/usr/bin/python
+
+# environment prep
+import os
+import sys
+import ssl
+import signal
+import logging
+import json
+import argparse
+import threading
+
+BASE_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(BASE_DIR)
+if os.environ.get('VMWARE_PYTHON_PATH' or None):
+    sys.path.extend(os.environ['VMWARE_PYTHON_PATH'].split(';'))
+
+from vcenterdd.log.setup import LoggerSetup
+from vcenterdd.datadog.sinks import SinkSet
+from vcenterdd.aggregator.sources import SourceRegistry
+from vcenterdd.alarm.rules import RuleSet
+from vcenterdd.aggregator.service import Aggregator
+from vcenterdd.aggregator.server import AggregatorServer
+from vcenterdd.telemetry import statsd
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Central aggregator receiving alarms from many vCenters")
+    parser.add_argument('-l', '--listen',
+                        required=False, action='store', default='0.0.0.0:8443',
+                        help='host:port to accept alarm submissions on')
+    parser.add_argument('--sources',
+                        required=True, action='store',
+                        help='JSON file of the sources allowed to submit alarms and their token hashes')
+    parser.add_argument('-c', '--config',
+                        required=False, action='store', default='{}/vcenterdd/datadog_config.conf'.format(BASE_DIR),
+                        help='Datadog config file, one set of credentials for every source')
+    parser.add_argument('--certfile',
+                        required=False, action='store',
+                        help='Certificate chain to serve HTTPS with')
+    parser.add_argument('--keyfile',
+                        required=False, action='store',
+                        help='Private key of the certificate')
+    parser.add_argument('-w', '--workers',
+                        required=False, action='store', type=int, default=os.cpu_count() or 1,
+                        help='Number of shard processes')
+    parser.add_argument('--max-pending-per-source',
+                        required=False, action='store', type=int, default=10000,
+                        help='Alarms of one source waiting for a shard before its submissions are rejected')
+    parser.add_argument('-o', '--outbox',
+                        required=False, action='store', default='{}/vcenterdd/.outbox'.format(BASE_DIR),
+                        help='Directory of the outbox spool for events that could not be delivered')
+    parser.add_argument('--replay-interval',
+                        required=False, action='store', type=float, default=5.0,
+                        help='Seconds between attempts to deliver spooled events')
+    parser.add_argument('--flap-window',
+                        required=False, action='store', type=float, default=30.0,
+                        help='Seconds transitions of the same alarm are coalesced for, 0 disables coalescing')
+    parser.add_argument('--dns-cache',
+                        required=False, action='store', default='{}/vcenterdd/.dnscache.sqlite'.format(BASE_DIR),
+                        help='SQLite file caching DNS lookups of alarm targets, shared by the shards')
+    parser.add_argument('--dns-timeout',
+                        required=False, action='store', type=float, default=1.0,
+                        help='Time budget in seconds for a DNS lookup')
+    parser.add_argument('--dns-negative-ttl',
+                        required=False, action='store', type=float, default=900,
+                        help='Seconds a failed DNS lookup is cached')
+    parser.add_argument('--breaker',
+                        required=False, action='store', default='{}/vcenterdd/.breaker.json'.format(BASE_DIR),
+                        help='Circuit breaker state file shared by every process posting to Datadog, '
+                             'empty to disable the breaker')
+    parser.add_argument('--lifecycle',
+                        required=False, action='store', default='{}/vcenterdd/.lifecycle.sqlite'.format(BASE_DIR),
+                        help='SQLite index of open alarms, links resolution events to their trigger')
+    parser.add_argument('--lifecycle-ttl',
+                        required=False, action='store', type=float, default=7 * 86400,
+                        help='Seconds an alarm that is not seen again stays in the lifecycle index')
+    parser.add_argument('--statsd',
+                        required=False, action='store', default=os.environ.get('VCENTERDD_STATSD'),
+                        help='host:port of a DogStatsD agent to send the aggregator\'s own timings and counters to')
+    parser.add_argument('--rules',
+                        required=False, action='store', default='{}/vcenterdd/alarm_rules.yml'.format(BASE_DIR),
+                        help='YAML routing and filter rules applied before any DNS or HTTP work, used when present')
+    parser.add_argument('-debug', '--debug',
+                        required=False, action='store_true',
+                        help='Used for Debug level information')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    cmd_args = parse_args()
+    if cmd_args.statsd:
+        statsd.configure(cmd_args.statsd, tags=['service:vcenterdd-aggregator']).start()
+
+    log_setup = LoggerSetup(yaml_file='{}/vcenterdd/logging_config.yml'.format(BASE_DIR))
+    log_setup.set_loglevel(loglevel='DEBUG' if cmd_args.debug else 'INFO')
+    log_setup.setup()
+
+    try:
+        logger.info("Starting datadog alarm aggregator")
+        with open(cmd_args.sources, 'rt') as f:
+            sources = SourceRegistry(json.load(f))
+        ssl_context = None
+        if cmd_args.certfile:
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(cmd_args.certfile, cmd_args.keyfile)
+        elif cmd_args.listen.split(':')[0] not in ('127.0.0.1', 'localhost'):
+            logger.warning('Serving plain HTTP, source tokens are sent in the clear')
+
+        sinks = SinkSet.from_config(cmd_args.config, outbox=cmd_args.outbox, lifecycle=cmd_args.lifecycle,
+                                    lifecycle_ttl=cmd_args.lifecycle_ttl, breaker=cmd_args.breaker)
+        replayers = sinks.replayers()
+        # compiled here so a broken rules file fails at startup, the shards compile their own copy
+        rules = RuleSet.load(cmd_args.rules) if os.path.exists(cmd_args.rules) else None
+        aggregator = Aggregator(sinks, sources, shards=cmd_args.workers,
+                                max_pending_per_source=cmd_args.max_pending_per_source,
+                                shard_options={'dns_cache': cmd_args.dns_cache,
+                                               'dns_timeout': cmd_args.dns_timeout,
+                                               'dns_negative_ttl': cmd_args.dns_negative_ttl,
+                                               'flap_window': cmd_args.flap_window,
+                                               'rules': rules.config if rules is not None else None,
+                                               'log_level': 'DEBUG' if cmd_args.debug else 'INFO'})
+        host, _, port = cmd_args.listen.rpartition(':')
+        server = AggregatorServer(aggregator, address=(host or '0.0.0.0', int(port)), ssl_context=ssl_context)
+
+        def _shutdown(signum, frame):
+            logger.info('Received signal %s, shutting down', signum)
+            # server.shutdown() blocks until serve_forever returns so it can't run on the serving thread
+            threading.Thread(target=server.shutdown).start()
+
+        signal.signal(signal.SIGTERM, _shutdown)
+        signal.signal(signal.SIGINT, _shutdown)
+
+        for replayer in replayers:
+            replayer.start(interval=cmd_args.replay_interval)
+        try:
+            server.serve_forever()
+        finally:
+            for replayer in replayers:
+                replayer.stop()
+            sinks.close()
+            statsd.telemetry().stop()
+    except BaseException as e:
+        logger.exception('Exception: %s \n Args: %s', e, e.args)
+        raise e
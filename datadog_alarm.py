@@ -1,76 +1,273 @@
 #!/usr/bin/python
 
 # environment prep
+import time
+_started = time.perf_counter()
 import os
 import sys
-import logging
-import logging.config
-import logging.handlers
-import yaml
-
-with open('/root/vcenterdd/logging_config.yml', 'rt') as f:
-    conf = yaml.safe_load(f.read())
-    f.close()
-dictConfig = conf
-logging.config.dictConfig(dictConfig)
-logger = logging.getLogger(__name__)
-
-logger.info('Starting imports of custom modules')
-
 import argparse
+
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 parent_dir = BASE_DIR.replace(os.path.basename(BASE_DIR), '')
 sys.path.append(BASE_DIR)
 if os.environ.get('VMWARE_PYTHON_PATH' or None):
     sys.path.extend(os.environ['VMWARE_PYTHON_PATH'].split(';'))
 
-logger.debug(sys.path)
+# the daemon client only depends on the standard library, everything heavy is imported in run_inprocess()
+from vcenterdd.daemon.client import ForwarderClient, DEFAULT_SOCKET_PATH
+from vcenterdd.profiling.startup import StartupProfile
+profile_imports = time.perf_counter() - _started
 
-# Continue setup
-logger.debug("Importing LoggerSetup")
-from vcenterdd.log.setup import LoggerSetup
-logger.debug("Importing Datadog")
-from vcenterdd.datadog.handle import Datadog
-logger.debug("Importing VcenterAlarm")
-from vcenterdd.alarm.handle import VcenterAlarm
+# maximum number of spooled events a single run delivers on top of its own alarm
+REPLAY_PER_RUN = 50
 
-try:
+# the in-process post makes one quick retry at most, a longer outage is left to the outbox replay
+ONE_SHOT_RETRY = {'max_attempts': 2, 'max_delay': 1.0, 'max_total': 2.0}
+
+
+def parse_args():
     parser = argparse.ArgumentParser(description="Arguments passed in from vCenter")
     parser.add_argument('-e', '--env',
                         required=True, action='store')
     parser.add_argument('-debug', '--debug',
                         required=False, action='store_true',
                         help='Used for Debug level information')
-    cmd_args = parser.parse_args()
-except BaseException as e:
-    logger.exception('Exception: {} \n Args: {}'.format(e, e.args))
-
-if cmd_args.debug:
-    LOGLEVEL = 'DEBUG'
-else:
-    LOGLEVEL = 'INFO'
-
-try:
-    logger.debug("LoggerSetup")
-    log_setup = LoggerSetup(yaml_file='{}/vcenterdd/logging_config.yml'.format(BASE_DIR))
-    log_setup.set_loglevel(loglevel=LOGLEVEL)
-    log_setup.setup()
-    logger.debug("LoggerSetup Complete")
-except BaseException as e:
-    logger.exception('Exception: {} \n Args: {}'.format(e, e.args))
+    parser.add_argument('-s', '--socket',
+                        required=False, action='store', default=DEFAULT_SOCKET_PATH,
+                        help='Unix socket of the forwarder daemon')
+    parser.add_argument('--no-daemon',
+                        required=False, action='store_true',
+                        help='Always process the alarm in this process, do not try the forwarder daemon')
+    parser.add_argument('--aggregator',
+                        required=False, action='store', default=os.environ.get('VCENTERDD_AGGREGATOR'),
+                        help='URL of a central aggregator to hand the alarm to (or set VCENTERDD_AGGREGATOR)')
+    parser.add_argument('--source',
+                        required=False, action='store', default=os.environ.get('VCENTERDD_SOURCE'),
+                        help='Name of this vCenter at the aggregator (or set VCENTERDD_SOURCE)')
+    parser.add_argument('--token',
+                        required=False, action='store', default=os.environ.get('VCENTERDD_TOKEN'),
+                        help='Token of this vCenter at the aggregator, prefer setting VCENTERDD_TOKEN')
+    parser.add_argument('-o', '--outbox',
+                        required=False, action='store', default='{}/vcenterdd/.outbox'.format(BASE_DIR),
+                        help='Directory of the outbox spool for events that could not be delivered')
+    parser.add_argument('--dns-cache',
+                        required=False, action='store', default='{}/vcenterdd/.dnscache.sqlite'.format(BASE_DIR),
+                        help='SQLite file caching DNS lookups of alarm targets')
+    parser.add_argument('--dns-timeout',
+                        required=False, action='store', type=float, default=1.0,
+                        help='Time budget in seconds for a DNS lookup')
+    parser.add_argument('--breaker',
+                        required=False, action='store', default='{}/vcenterdd/.breaker.json'.format(BASE_DIR),
+                        help='Circuit breaker state file shared by every process posting to Datadog, '
+                             'empty to disable the breaker')
+    parser.add_argument('--lifecycle',
+                        required=False, action='store', default='{}/vcenterdd/.lifecycle.sqlite'.format(BASE_DIR),
+                        help='SQLite index of open alarms, links resolution events to their trigger')
+    parser.add_argument('--rules',
+                        required=False, action='store', default='{}/vcenterdd/alarm_rules.yml'.format(BASE_DIR),
+                        help='YAML routing and filter rules applied before any DNS or HTTP work, used when present')
+    parser.add_argument('--metrics',
+                        required=False, action='store_true',
+                        help='Also submit the alarm state series (vsphere.alarm.status / transitions)')
+    parser.add_argument('--capture',
+                        required=False, action='store', default=os.environ.get('VCENTERDD_CAPTURE'),
+                        help='Append the alarm to this JSONL file for later replay when it is handled in process, '
+                             'the daemon captures the alarms forwarded to it (or set VCENTERDD_CAPTURE)')
+    parser.add_argument('--statsd',
+                        required=False, action='store', default=os.environ.get('VCENTERDD_STATSD'),
+                        help='host:port of a DogStatsD agent to send this run\'s timings and counters to')
+    parser.add_argument('--profile',
+                        required=False, action='store', nargs='?', type=int, const=1, default=None,
+                        help='Profile 1 in N runs (default every run) into --profile-dir, or set VCENTERDD_PROFILE=N')
+    parser.add_argument('--profile-dir',
+                        required=False, action='store',
+                        default=os.environ.get('VCENTERDD_PROFILE_DIR', '{}/vcenterdd/.profiles'.format(BASE_DIR)),
+                        help='Directory of the profiled runs (or set VCENTERDD_PROFILE_DIR)')
+    parser.add_argument('--startup-profile',
+                        required=False, action='store_true',
+                        help='Report the time spent in each startup phase on stderr')
+    args = parser.parse_args()
+    if args.profile is None:
+        args.profile = profile_sample(os.environ.get('VCENTERDD_PROFILE'))
+    return args
+
+
+def profile_sample(value):
+    """
+    Parse VCENTERDD_PROFILE leniently, a bad value must not cost the alarm (argparse would exit on it)
+    :param value: the environment variable, N to profile 1 in N runs
+    :return: N, or None to not profile (unset, empty or 0)
+    """
+    if not value or not value.strip():
+        return None
+    try:
+        sample = int(value)
+    except ValueError:
+        sample = -1
+    if sample < 0:
+        sys.stderr.write('Ignoring VCENTERDD_PROFILE={!r}, expected a number, profiling is off\n'.format(value))
+    return sample if sample > 0 else None
+
+
+def run_inprocess(cmd_args, profile):
+    """ Fallback path when no forwarder daemon is available, the alarm is handled and posted by this process """
+    import logging
+    from vcenterdd.config.snapshot import ConfigSnapshot
+    from vcenterdd.telemetry import statsd
+
+    if cmd_args.statsd:
+        # nothing is flushed in the background, everything recorded by this run is sent once on the way out
+        try:
+            statsd.configure(cmd_args.statsd, tags=['service:vcenterdd-alarm'], flush_interval=0)
+        except (ValueError, OSError) as e:
+            # telemetry must never cost an alarm, the run goes on without it
+            sys.stderr.write('Unable to configure statsd telemetry {}: {}\n'.format(cmd_args.statsd, e))
+    profile.attach_telemetry()
+
+    logging_file = '{}/vcenterdd/logging_config.yml'.format(BASE_DIR)
+    datadog_file = '{}/vcenterdd/datadog_config.conf'.format(BASE_DIR)
+
+    with profile.phase('config snapshot'):
+        try:
+            snapshot = ConfigSnapshot(logging_file=logging_file, datadog_file=datadog_file,
+                                      rules_file=cmd_args.rules).load()
+        except BaseException:
+            # fall back to reading the config files directly so the errors get logged below
+            snapshot = None
+
+    if cmd_args.debug:
+        LOGLEVEL = 'DEBUG'
+    else:
+        LOGLEVEL = 'INFO'
 
-if __name__ == "__main__":
     logger = logging.getLogger(__name__)
+    with profile.phase('LoggerSetup'):
+        try:
+            from vcenterdd.log.setup import LoggerSetup
+            if snapshot:
+                log_setup = LoggerSetup(dict_config=snapshot.logging_config)
+            else:
+                log_setup = LoggerSetup(yaml_file=logging_file)
+            log_setup.set_loglevel(loglevel=LOGLEVEL)
+            log_setup.setup()
+            logger.debug("LoggerSetup Complete")
+        except BaseException as e:
+            logger.exception('Exception: %s \n Args: %s', e, e.args)
+
     try:
         logger.info("Starting datadog alarm forwarder")
-
-        alarm = VcenterAlarm(env=cmd_args.env)
-        alarm.format_datadog_event()
-        dd = Datadog('{}/vcenterdd/datadog_config.conf'.format(BASE_DIR))
-        logger.info("Sending JSON Data: \n{}".format(alarm.datadog_format.__str__()))
-        dd.post_event(**alarm.datadog_format)
+        logger.debug('sys.path: %s', sys.path)
+        handle_alarm(cmd_args, profile, snapshot, datadog_file, logger)
         logger.info("Alarm Forwarder complete")
     except BaseException as e:
-        logger.exception('Exception: {} \n Args: {}'.format(e, e.args))
+        logger.exception('Exception: %s \n Args: %s', e, e.args)
         raise e
+    finally:
+        statsd.telemetry().stop()
+
 
+def handle_alarm(cmd_args, profile, snapshot, datadog_file, logger):
+    """ Build the alarm from the environment, apply the rules and post what they let through """
+    with profile.phase('import VcenterAlarm'):
+        from vcenterdd.alarm.handle import VcenterAlarm
+        from vcenterdd.alarm.dnscache import DnsCache
+        from vcenterdd.alarm.rules import RuleSet, DEFAULT_DECISION
+        from vcenterdd.alarm.exceptions import RuleError
+    resolver = DnsCache(cmd_args.dns_cache, timeout=cmd_args.dns_timeout)
+    try:
+        with profile.phase('VcenterAlarm'):
+            alarm = VcenterAlarm(env=cmd_args.env, resolver=resolver)
+        with profile.phase('rules'):
+            try:
+                if snapshot:
+                    rules = RuleSet(snapshot.rules_config) if snapshot.rules_config else None
+                else:
+                    rules = RuleSet.load(cmd_args.rules) if os.path.exists(cmd_args.rules) else None
+            except (RuleError, Exception) as e:
+                # a broken rules file must not lose the alarm, it is posted as if there were no rules
+                logger.error("Unable to load the rules, using the defaults: %s", e)
+                rules = None
+            decision = rules.apply(alarm) if rules is not None else DEFAULT_DECISION
+        # dropped alarms never pay for DNS, key decryption or HTTP
+        if decision is None:
+            logger.info("Alarm %s dropped by the rules", alarm.name)
+            return
+        post_event = 'events' in decision.destinations
+        post_metric = cmd_args.metrics and 'metrics' in decision.destinations
+        if not post_event and not post_metric:
+            logger.info("Alarm %s routed to no destination this script handles", alarm.name)
+            return
+
+        if post_event:
+            with profile.phase('format_datadog_event'):
+                alarm.format_datadog_event()
+    finally:
+        resolver.close()
+    with profile.phase('import Datadog'):
+        from vcenterdd.datadog.sinks import SinkSet, FAILED
+        from vcenterdd.outbox.replay import SPOOLED
+    with profile.phase('Datadog'):
+        sinks = SinkSet.from_config(datadog_file, config=snapshot.datadog_config if snapshot else None,
+                                    outbox=cmd_args.outbox, lifecycle=cmd_args.lifecycle, breaker=cmd_args.breaker,
+                                    retry=ONE_SHOT_RETRY)
+    try:
+        if post_event:
+            logger.info("Sending JSON Data: \n%s", alarm.datadog_format.__str__())
+            with profile.phase('post_event'):
+                results = sinks.post(alarm.datadog_format)
+            for name, result in results.items():
+                logger.info("Sink %s: %s in %.1f ms", name, result.status, result.latency * 1000)
+            # a failed post is left in the outbox for the next run (or the daemon) that finds the endpoint healthy
+            healthy = [name for name, result in results.items() if result.status not in (SPOOLED, FAILED)]
+            if healthy:
+                with profile.phase('outbox replay'):
+                    sinks.replay(max_records=REPLAY_PER_RUN, names=healthy)
+        if post_metric:
+            from vcenterdd.datadog.metrics import MetricsBuffer
+            with profile.phase('post_metric'):
+                metrics = MetricsBuffer(sinks.primary.datadog, flush_interval=0)
+                metrics.record_alarm(alarm)
+                # stop() flushes and logs a failed submission instead of failing the run
+                metrics.stop()
+    finally:
+        sinks.close()
+
+
+if __name__ == "__main__":
+    cmd_args = parse_args()
+    profile = None
+    if cmd_args.profile:
+        try:
+            from vcenterdd.profiling.runs import RunProfiler
+            profile = RunProfiler(cmd_args.profile_dir, sample=int(cmd_args.profile),
+                                  print_phases=cmd_args.startup_profile).start()
+        except Exception as e:
+            # profiling must never cost an alarm, the run goes on unprofiled
+            sys.stderr.write('Unable to start profiling: {}\n'.format(e))
+    if profile is None:
+        profile = StartupProfile(enabled=cmd_args.startup_profile)
+    profile.record('imports', profile_imports)
+    try:
+        if cmd_args.aggregator:
+            with profile.phase('aggregator client'):
+                from vcenterdd.aggregator.client import AggregatorClient
+                forwarded = AggregatorClient(cmd_args.aggregator, source=cmd_args.source,
+                                             token=cmd_args.token).forward(env=cmd_args.env)
+            if forwarded:
+                sys.exit(0)
+        if not cmd_args.no_daemon:
+            with profile.phase('daemon client'):
+                forwarded = ForwarderClient(socket_path=cmd_args.socket).forward(env=cmd_args.env)
+            if forwarded:
+                sys.exit(0)
+        # an alarm forwarded to the daemon is captured there (forwarderd --capture), so it is written only once
+        if cmd_args.capture:
+            with profile.phase('capture'):
+                try:
+                    from vcenterdd.replay.capture import capture_alarm
+                    capture_alarm(cmd_args.capture, env=cmd_args.env)
+                except OSError as e:
+                    sys.stderr.write('Unable to capture alarm to {}: {}\n'.format(cmd_args.capture, e))
+        run_inprocess(cmd_args, profile)
+    finally:
+        profile.report()
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+
+# environment prep
+import os
+import sys
+import signal
+import logging
+import json
+import argparse
+import threading
+
+BASE_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(BASE_DIR)
+if os.environ.get('VMWARE_PYTHON_PATH' or None):
+    sys.path.extend(os.environ['VMWARE_PYTHON_PATH'].split(';'))
+
+from vcenterdd.log.setup import LoggerSetup
+from vcenterdd.datadog.sinks import SinkSet
+from vcenterdd.daemon.client import ForwarderClient, DEFAULT_SOCKET_PATH
+from vcenterdd.daemon.pipeline import AlarmPipeline
+from vcenterdd.daemon.server import ForwarderDaemon
+from vcenterdd.alarm.coalesce import FlapCoalescer
+from vcenterdd.alarm.rollup import StormRollup
+from vcenterdd.alarm.dnscache import DnsCache
+from vcenterdd.alarm.rules import RuleSet
+from vcenterdd.datadog.metrics import MetricsBuffer
+from vcenterdd.datadog.logs import LogShipper, DatadogLogHandler
+from vcenterdd.collector.collector import load_collectors
+from vcenterdd.snmp.listener import TrapListener, parse_address
+from vcenterdd.telemetry import statsd
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="vCenter alarm forwarder daemon")
+    parser.add_argument('-s', '--socket',
+                        required=False, action='store', default=DEFAULT_SOCKET_PATH,
+                        help='Unix socket to listen on for alarms from datadog_alarm.py')
+    parser.add_argument('-c', '--config',
+                        required=False, action='store',
+                        default='{}/vcenterdd/datadog_config.conf'.format(BASE_DIR),
+                        help='Datadog config file')
+    parser.add_argument('-o', '--outbox',
+                        required=False, action='store', default='{}/vcenterdd/.outbox'.format(BASE_DIR),
+                        help='Directory of the outbox spool for events that could not be delivered')
+    parser.add_argument('--replay-interval',
+                        required=False, action='store', type=float, default=5.0,
+                        help='Seconds between attempts to replay the outbox')
+    parser.add_argument('--flap-window',
+                        required=False, action='store', type=float, default=30.0,
+                        help='Hold-down window in seconds to coalesce flapping alarms, 0 disables coalescing')
+    parser.add_argument('--storm-threshold',
+                        required=False, action='store', type=int, default=10,
+                        help='Transitions of one alarm to one status within --storm-window after which further '
+                             'targets are rolled up into one summary event, 0 disables the rollup')
+    parser.add_argument('--storm-window',
+                        required=False, action='store', type=float, default=10.0,
+                        help='Sliding window in seconds of the storm rollup, a storm ends after as long without '
+                             'transitions')
+    parser.add_argument('--dns-cache',
+                        required=False, action='store', default='{}/vcenterdd/.dnscache.sqlite'.format(BASE_DIR),
+                        help='SQLite file caching DNS lookups of alarm targets')
+    parser.add_argument('--dns-timeout',
+                        required=False, action='store', type=float, default=1.0,
+                        help='Time budget in seconds for a DNS lookup')
+    parser.add_argument('--dns-negative-ttl',
+                        required=False, action='store', type=int, default=900,
+                        help='Seconds to cache names that do not resolve')
+    parser.add_argument('--metrics-interval',
+                        required=False, action='store', type=float, default=10.0,
+                        help='Seconds between submissions of the alarm state series, 0 disables metrics')
+    parser.add_argument('--log-forwarding',
+                        required=False, action='store_true',
+                        help='Ship alarm records and forwarder warnings to the Datadog logs intake')
+    parser.add_argument('--no-events',
+                        required=False, action='store_true',
+                        help='Do not post events, alarms are only shipped as logs and metrics')
+    parser.add_argument('--collectors',
+                        required=False, action='store',
+                        help='JSON file listing vCenters to collect alarm state updates from directly')
+    parser.add_argument('--snmp',
+                        required=False, action='store',
+                        help='host:port to receive the SNMP traps of vCenter alarms on, e.g. 0.0.0.0:162')
+    parser.add_argument('--snmp-community',
+                        required=False, action='append', default=[], metavar='COMMUNITY=ENV',
+                        help='Accept SNMP traps sent with COMMUNITY and tag their alarms with ENV, repeatable')
+    parser.add_argument('--capture',
+                        required=False, action='store', default=os.environ.get('VCENTERDD_CAPTURE'),
+                        help='Append every alarm to this JSONL file for later replay')
+    parser.add_argument('--breaker',
+                        required=False, action='store', default='{}/vcenterdd/.breaker.json'.format(BASE_DIR),
+                        help='Circuit breaker state file shared by every process posting to Datadog, '
+                             'empty to disable the breaker')
+    parser.add_argument('--lifecycle',
+                        required=False, action='store', default='{}/vcenterdd/.lifecycle.sqlite'.format(BASE_DIR),
+                        help='SQLite index of open alarms, links resolution events to their trigger')
+    parser.add_argument('--lifecycle-ttl',
+                        required=False, action='store', type=float, default=7 * 86400,
+                        help='Seconds an alarm that is not seen again stays in the lifecycle index')
+    parser.add_argument('--statsd',
+                        required=False, action='store', default=os.environ.get('VCENTERDD_STATSD'),
+                        help='host:port of a DogStatsD agent to send the forwarder\'s own timings and counters to')
+    parser.add_argument('--rules',
+                        required=False, action='store', default='{}/vcenterdd/alarm_rules.yml'.format(BASE_DIR),
+                        help='YAML routing and filter rules applied before any DNS or HTTP work, used when present')
+    parser.add_argument('--stats',
+                        required=False, action='store_true',
+                        help='Print the queue stats (queued, downgraded, shed, rejected) of the running daemon')
+    parser.add_argument('-debug', '--debug',
+                        required=False, action='store_true',
+                        help='Used for Debug level information')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    cmd_args = parse_args()
+    if cmd_args.stats:
+        print(json.dumps(ForwarderClient(socket_path=cmd_args.socket).stats(), indent=2, sort_keys=True))
+        sys.exit(0)
+    if cmd_args.statsd:
+        statsd.configure(cmd_args.statsd, tags=['service:vcenterdd-forwarder']).start()
+
+    log_setup = LoggerSetup(yaml_file='{}/vcenterdd/logging_config.yml'.format(BASE_DIR))
+    log_setup.set_loglevel(loglevel='DEBUG' if cmd_args.debug else 'INFO')
+    log_setup.setup()
+
+    try:
+        logger.info("Starting datadog alarm forwarder daemon")
+        sinks = SinkSet.from_config(cmd_args.config, outbox=cmd_args.outbox, lifecycle=cmd_args.lifecycle,
+                                    lifecycle_ttl=cmd_args.lifecycle_ttl, breaker=cmd_args.breaker)
+        dd = sinks.primary.datadog
+        replayers = sinks.replayers()
+        resolver = DnsCache(cmd_args.dns_cache, negative_ttl=cmd_args.dns_negative_ttl, timeout=cmd_args.dns_timeout)
+        metrics = MetricsBuffer(dd, flush_interval=cmd_args.metrics_interval) if cmd_args.metrics_interval else None
+        shipper = None
+        if cmd_args.log_forwarding:
+            shipper = LogShipper(dd)
+            logging.getLogger('vcenterdd').addHandler(DatadogLogHandler(shipper))
+        rules = RuleSet.load(cmd_args.rules) if os.path.exists(cmd_args.rules) else None
+        pipeline = AlarmPipeline(dd, coalescer=FlapCoalescer(window=cmd_args.flap_window),
+                                 resolver=resolver, metrics=metrics, shipper=shipper,
+                                 events=not cmd_args.no_events, capture=cmd_args.capture, rules=rules,
+                                 sinks=sinks,
+                                 rollup=StormRollup(threshold=cmd_args.storm_threshold, window=cmd_args.storm_window))
+        daemon = ForwarderDaemon(pipeline=pipeline, socket_path=cmd_args.socket)
+
+        def _shutdown(signum, frame):
+            logger.info('Received signal %s, shutting down', signum)
+            # server.shutdown() blocks until serve_forever returns so it can't run on the serving thread
+            threading.Thread(target=daemon.shutdown).start()
+
+        signal.signal(signal.SIGTERM, _shutdown)
+        signal.signal(signal.SIGINT, _shutdown)
+        collectors = []
+        if cmd_args.collectors:
+            with open(cmd_args.collectors, 'rt') as f:
+                collectors = load_collectors(json.load(f), submit=pipeline.submit)
+        traps = None
+        if cmd_args.snmp:
+            communities = dict(c.split('=', 1) for c in cmd_args.snmp_community)
+            if not communities:
+                raise ValueError('--snmp requires at least one --snmp-community COMMUNITY=ENV')
+            traps = TrapListener(pipeline.submit, communities, address=parse_address(cmd_args.snmp))
+
+        for replayer in replayers:
+            replayer.start(interval=cmd_args.replay_interval)
+        for collector in collectors:
+            collector.start()
+        if traps is not None:
+            traps.start()
+        try:
+            daemon.serve_forever()
+        finally:
+            if traps is not None:
+                traps.stop()
+            for collector in collectors:
+                collector.stop()
+            for replayer in replayers:
+                replayer.stop()
+            sinks.close()
+            statsd.telemetry().stop()
+    except BaseException as e:
+        logger.exception('Exception: %s \n Args: %s', e, e.args)
+        raise e
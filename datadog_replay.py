@@ -0,0 +1,80 @@
+#!/usr/bin/python
+
+# environment prep
+import os
+import sys
+import json
+import logging
+import argparse
+
+BASE_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(BASE_DIR)
+if os.environ.get('VMWARE_PYTHON_PATH' or None):
+    sys.path.extend(os.environ['VMWARE_PYTHON_PATH'].split(';'))
+
+from vcenterdd.log.setup import LoggerSetup
+from vcenterdd.replay.runner import ReplayRunner, read_captures
+from vcenterdd.alarm.rules import RuleSet
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay captured vCenter alarms through the Datadog pipeline")
+    parser.add_argument('captures', nargs='+', action='store',
+                        help='JSONL capture files (.gz supported)')
+    parser.add_argument('-c', '--config',
+                        required=False, action='store',
+                        default='{}/vcenterdd/datadog_config.conf'.format(BASE_DIR),
+                        help='Datadog config file')
+    parser.add_argument('-e', '--env',
+                        required=False, action='store',
+                        help='Override the env tag of the captured alarms')
+    parser.add_argument('--dry-run',
+                        required=False, action='store_true',
+                        help='Only build and format the alarms (without DNS) and report the throughput')
+    parser.add_argument('--workers',
+                        required=False, action='store', type=int, default=8,
+                        help='Threads formatting alarms and resolving DNS')
+    parser.add_argument('--window',
+                        required=False, action='store', type=int, default=200,
+                        help='Maximum number of alarms in progress')
+    parser.add_argument('--now',
+                        required=False, action='store_true',
+                        help='Post with the current time instead of the captured time')
+    parser.add_argument('--dns-cache',
+                        required=False, action='store', default='{}/vcenterdd/.dnscache.sqlite'.format(BASE_DIR),
+                        help='SQLite file caching DNS lookups of alarm targets')
+    parser.add_argument('--rules',
+                        required=False, action='store', default='{}/vcenterdd/alarm_rules.yml'.format(BASE_DIR),
+                        help='YAML routing and filter rules applied before any DNS or HTTP work, used when present')
+    parser.add_argument('-debug', '--debug',
+                        required=False, action='store_true',
+                        help='Used for Debug level information')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    cmd_args = parse_args()
+
+    log_setup = LoggerSetup(yaml_file='{}/vcenterdd/logging_config.yml'.format(BASE_DIR))
+    log_setup.set_loglevel(loglevel='DEBUG' if cmd_args.debug else 'INFO')
+    log_setup.setup()
+
+    try:
+        datadog = resolver = None
+        if not cmd_args.dry_run:
+            from vcenterdd.datadog.handle import Datadog
+            from vcenterdd.alarm.dnscache import DnsCache
+
+            datadog = Datadog(cmd_args.config)
+            resolver = DnsCache(cmd_args.dns_cache)
+        runner = ReplayRunner(datadog=datadog, resolver=resolver, workers=cmd_args.workers,
+                              window=cmd_args.window, dry_run=cmd_args.dry_run, env=cmd_args.env,
+                              keep_time=not cmd_args.now,
+                              rules=RuleSet.load(cmd_args.rules) if os.path.exists(cmd_args.rules) else None)
+        stats = runner.run(read_captures(cmd_args.captures))
+        print(json.dumps(stats, indent=2))
+    except BaseException as e:
+        logger.exception('Exception: %s \n Args: %s', e, e.args)
+        raise e
@@ -0,0 +1,66 @@
+import asyncio
+import pytest
+from vcenterdd.aggregator.service import Aggregator
+from vcenterdd.datadog.exceptions import DatadogConnectionError, DatadogHTTPError
+from vcenterdd.datadog.sender import SenderResponse
+from vcenterdd.outbox.spool import Outbox
+
+
+class FakeDatadog(object):
+
+    def __init__(self, error=None):
+        self.error = error
+
+    async def post_event_async(self, **kwargs):
+        if self.error is not None:
+            raise self.error
+        return SenderResponse('', 202, 'Accepted', {}, b'{"event": {"id": 1}}', 0.0)
+
+    @staticmethod
+    def event_id(response):
+        return response.json()['event']['id']
+
+
+class FakeSink(object):
+
+    def __init__(self, datadog, outbox):
+        self.name = 'primary'
+        self.datadog = datadog
+        self.outbox = outbox
+        self.lifecycle = None
+
+
+class FakeSinkSet(object):
+
+    def __init__(self, sink):
+        self.primary = sink
+        self.names = [sink.name]
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    outbox = Outbox(str(tmp_path / 'outbox'))
+    yield outbox
+    outbox.close()
+
+
+def post_or_spool(error, outbox):
+    sink = FakeSink(FakeDatadog(error), outbox)
+    aggregator = Aggregator(FakeSinkSet(sink), sources=None, shards=1)
+    return asyncio.run(aggregator._post_or_spool(sink, {'title': 't', 'text': ''}))
+
+
+def test_posted(outbox):
+    assert post_or_spool(None, outbox) == 'posted'
+    assert not outbox.pending()
+
+
+def test_connection_error_spooled(outbox):
+    assert post_or_spool(DatadogConnectionError('down'), outbox) == 'spooled'
+    assert outbox.pending()
+
+
+def test_refused_event_not_spooled(outbox):
+    response = SenderResponse('', 400, 'Bad Request', {}, b'', 0.0)
+    assert post_or_spool(DatadogHTTPError('400 Bad Request', response=response), outbox) == 'failed'
+    assert not outbox.pending()
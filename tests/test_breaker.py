@@ -0,0 +1,111 @@
+import json
+import pytest
+from vcenterdd.datadog.breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def breaker(tmp_path, clock):
+    def make():
+        return CircuitBreaker(str(tmp_path / 'breaker.json'), threshold=3, reset_timeout=30, probe_timeout=10,
+                              clock=clock)
+    return make
+
+
+def test_opens_after_threshold_failures(breaker):
+    circuit = breaker()
+    for _ in range(2):
+        circuit.record_failure()
+    assert circuit.state == CLOSED
+    assert circuit.allow()
+    circuit.record_failure()
+    assert circuit.state == OPEN
+    assert not circuit.allow()
+
+
+def test_success_resets_consecutive_failures(breaker):
+    circuit = breaker()
+    circuit.record_failure()
+    circuit.record_failure()
+    circuit.record_success()
+    circuit.record_failure()
+    assert circuit.state == CLOSED
+
+
+def test_probe_success_closes(breaker, clock):
+    circuit = breaker()
+    for _ in range(3):
+        circuit.record_failure()
+    clock.now += 29
+    assert not circuit.allow()
+    clock.now += 1
+    assert circuit.allow()
+    assert circuit.state == HALF_OPEN
+    # a single probe, the other callers keep failing fast
+    assert not circuit.allow()
+    circuit.record_success()
+    assert circuit.state == CLOSED
+    assert circuit.allow()
+
+
+def test_probe_failure_reopens(breaker, clock):
+    circuit = breaker()
+    for _ in range(3):
+        circuit.record_failure()
+    clock.now += 30
+    assert circuit.allow()
+    circuit.record_failure()
+    assert circuit.state == OPEN
+    assert not circuit.allow()
+    clock.now += 30
+    assert circuit.allow()
+
+
+def test_unanswered_probe_retried(breaker, clock):
+    circuit = breaker()
+    for _ in range(3):
+        circuit.record_failure()
+    clock.now += 30
+    assert circuit.allow()
+    clock.now += 9
+    assert not circuit.allow()
+    clock.now += 1
+    assert circuit.allow()
+
+
+def test_state_shared_between_processes(breaker, clock, tmp_path):
+    script, daemon = breaker(), breaker()
+    assert daemon.allow()
+    for _ in range(3):
+        script.record_failure()
+    # the daemon trusts its closed state for refresh seconds, then reads the open state of the script
+    clock.now += 2
+    assert not daemon.allow()
+    clock.now += 30
+    assert script.allow()
+    assert not daemon.allow()
+    daemon.record_success()
+    assert script.state == CLOSED
+    with open(str(tmp_path / 'breaker.json')) as f:
+        assert json.load(f)['state'] == CLOSED
+
+
+def test_corrupt_state_file_is_closed(breaker, tmp_path):
+    (tmp_path / 'breaker.json').write_text('not json')
+    circuit = breaker()
+    assert circuit.allow()
+    circuit.record_failure()
+    assert circuit.state == CLOSED
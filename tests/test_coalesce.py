@@ -0,0 +1,83 @@
+import datetime
+from vcenterdd.alarm.coalesce import FlapCoalescer, format_timeline
+
+
+class Alarm(object):
+    """ The attributes of a VcenterAlarm the coalescer reads """
+
+    def __init__(self, key, oldstatus, newstatus, second=0):
+        self.alarm_key_hash = key
+        self.oldstatus = oldstatus
+        self.newstatus = newstatus
+        self.date_time = datetime.datetime(2026, 1, 1, 12, 0, second)
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_flap_released_as_final_state_with_timeline():
+    clock = Clock()
+    coalescer = FlapCoalescer(window=30, clock=clock)
+    first = Alarm('a', 'Gray', 'Yellow', 0)
+    assert coalescer.add(first) == [(first, None)]
+    last = None
+    for second, (old, new) in enumerate([('Yellow', 'Red'), ('Red', 'Yellow')], 1):
+        clock.now += 1
+        last = Alarm('a', old, new, second)
+        assert coalescer.add(last) == []
+    assert coalescer.coalesced == 2
+    assert coalescer.next_due() == 28
+    clock.now = 30
+    [(alarm, timeline)] = coalescer.due()
+    assert alarm is last
+    assert timeline == [(first.date_time, 'Gray', 'Yellow'), (datetime.datetime(2026, 1, 1, 12, 0, 1), 'Yellow', 'Red'),
+                        (last.date_time, 'Red', 'Yellow')]
+    assert coalescer.next_due() is None
+
+
+def test_single_transition_not_released_again():
+    clock = Clock()
+    coalescer = FlapCoalescer(window=30, clock=clock)
+    alarm = Alarm('a', 'Green', 'Red')
+    assert coalescer.add(alarm) == [(alarm, None)]
+    clock.now = 30
+    assert coalescer.due() == []
+    # the window closed, the next transition opens a new one and is released right away
+    recovery = Alarm('a', 'Red', 'Green')
+    assert coalescer.add(recovery) == [(recovery, None)]
+
+
+def test_oldest_window_closed_when_full():
+    coalescer = FlapCoalescer(window=30, max_keys=2, clock=Clock())
+    coalescer.add(Alarm('a', 'Green', 'Red'))
+    held = Alarm('a', 'Red', 'Green')
+    coalescer.add(held)
+    coalescer.add(Alarm('b', 'Green', 'Red'))
+    released = coalescer.add(Alarm('c', 'Green', 'Red'))
+    assert released[0][0] is held and len(released[0][1]) == 2
+    assert released[1][0].alarm_key_hash == 'c'
+    assert coalescer.evicted == 1
+    assert list(coalescer.windows) == ['b', 'c']
+
+
+def test_flush_and_disabled():
+    coalescer = FlapCoalescer(window=30, clock=Clock())
+    coalescer.add(Alarm('a', 'Green', 'Red'))
+    coalescer.add(Alarm('a', 'Red', 'Green'))
+    assert [alarm.newstatus for alarm, _ in coalescer.flush()] == ['Green']
+    assert not coalescer.windows
+    alarm = Alarm('a', 'Green', 'Red')
+    assert FlapCoalescer(window=0).add(alarm) == [(alarm, None)]
+
+
+def test_format_timeline_keeps_latest_entries():
+    timeline = [(datetime.datetime(2026, 1, 1, 12, 0, n), 'Red', 'Green') for n in range(5)]
+    text = format_timeline(timeline, max_entries=2)
+    assert text.splitlines() == ['Coalesced 5 transitions between 12:00:00 and 12:00:04:',
+                                 '  ... 3 earlier transitions', '  12:00:03 Red -> Green', '  12:00:04 Red -> Green']
@@ -0,0 +1,87 @@
+import json
+from vcenterdd.collector.collector import AlarmCollector
+from vcenterdd.collector.source import RecordedVcenter
+
+
+def state(key, status, entity_name='datastore01'):
+    alarm, entity = key.split('.')
+    return {'key': key, 'alarm': alarm, 'alarm_name': 'Datastore usage on disk', 'alarm_system_name': None,
+            'entity': entity, 'entity_name': entity_name, 'status': status, 'time': '2026-01-01T00:00:00'}
+
+
+RECORDING = [
+    # the initial update set of the filter, alarm-7 was already triggered on datastore-444
+    {'version': '1', 'changes': [
+        {'op': 'assign', 'name': 'triggeredAlarmState', 'val': [state('alarm-7.datastore-444', 'Yellow')]},
+    ]},
+    {'version': '2', 'changes': [
+        {'op': 'add', 'name': 'triggeredAlarmState["alarm-7.datastore-445"]',
+         'val': state('alarm-7.datastore-445', 'Red', entity_name='datastore02')},
+        {'op': 'assign', 'name': 'triggeredAlarmState["alarm-7.datastore-444"]',
+         'val': state('alarm-7.datastore-444', 'Red')},
+    ]},
+    {'version': '3', 'changes': [
+        {'op': 'remove', 'name': 'triggeredAlarmState["alarm-7.datastore-445"]'},
+    ]},
+    # a reconnect starts a new filter, its complete assign is diffed against the table
+    {'version': '1', 'changes': [
+        {'op': 'assign', 'name': 'triggeredAlarmState', 'val': [state('alarm-8.host-12', 'Red', 'esx01')]},
+    ]},
+]
+
+
+def replay(recording):
+    submitted = []
+    collector = AlarmCollector(RecordedVcenter(recording), lambda env, environ: submitted.append((env, environ)),
+                               env='env:test', max_wait=0)
+    while not collector.source.exhausted:
+        collector.poll()
+    return collector, submitted
+
+
+def transitions(submitted):
+    return [(env, environ['VMWARE_ALARM_TARGET_ID'], environ['VMWARE_ALARM_OLDSTATUS'],
+             environ['VMWARE_ALARM_NEWSTATUS']) for env, environ in submitted]
+
+
+def test_replay_submits_transitions():
+    collector, submitted = replay(RECORDING)
+    assert transitions(submitted) == [
+        ('env:test', 'datastore-445', 'Gray', 'Red'),
+        ('env:test', 'datastore-444', 'Yellow', 'Red'),
+        ('env:test', 'datastore-445', 'Red', 'Green'),
+        ('env:test', 'host-12', 'Gray', 'Red'),
+        ('env:test', 'datastore-444', 'Red', 'Green'),
+    ]
+    assert collector.transitions == 5
+    assert collector.version == '1'
+
+
+def test_replay_environ():
+    _, submitted = replay(RECORDING[:2])
+    assert submitted[0][1] == {
+        'VMWARE_ALARM_ID': 'alarm-7',
+        'VMWARE_ALARM_NAME': 'Datastore usage on disk',
+        'VMWARE_ALARM_TARGET_ID': 'datastore-445',
+        'VMWARE_ALARM_TARGET_NAME': 'datastore02',
+        'VMWARE_ALARM_OLDSTATUS': 'Gray',
+        'VMWARE_ALARM_NEWSTATUS': 'Red',
+        'VMWARE_ALARM_EVENTDESCRIPTION': "Alarm 'Datastore usage on disk' on datastore02 changed from Gray to Red",
+        'VMWARE_ALARM_TRIGGERINGSUMMARY': '',
+        'VMWARE_ALARM_DECLARINGSUMMARY': '',
+        'VMWARE_ALARM_ALARMVALUE': '',
+        'VMWARE_ALARM_EVENT_TIME': '2026-01-01T00:00:00',
+    }
+
+
+def test_initial_assign_only_seeds():
+    collector, submitted = replay(RECORDING[:1])
+    assert submitted == []
+    assert list(collector.table.states) == ['alarm-7.datastore-444']
+
+
+def test_replay_from_file(tmp_path):
+    path = tmp_path / 'updates.json'
+    path.write_text(json.dumps(RECORDING))
+    _, submitted = replay(str(path))
+    assert len(submitted) == 5
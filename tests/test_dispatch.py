@@ -0,0 +1,129 @@
+import asyncio
+import pytest
+from vcenterdd.datadog.dispatch import TokenBucket, RetryBudget, Dispatcher, retry_after_seconds
+from vcenterdd.datadog.exceptions import DatadogConnectionError
+from vcenterdd.datadog.sender import SenderResponse
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class Sender(object):
+    """ AsyncSender answering with a list of status codes, or exceptions """
+
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.requests = 0
+
+    async def request(self, method, path, body=None, headers=None):
+        self.requests += 1
+        answer = self.answers.pop(0)
+        if isinstance(answer, BaseException):
+            raise answer
+        status, headers = answer if isinstance(answer, tuple) else (answer, {})
+        return SenderResponse('https://api.datadoghq.com/api/v1/' + path, status, '', headers, b'{}', 0.0)
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def sleeps(monkeypatch, clock):
+    """ Delays slept by the code under test, sleeping advances the clock instead of waiting """
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+        clock.now += delay
+
+    monkeypatch.setattr(asyncio, 'sleep', sleep)
+    return delays
+
+
+def test_token_bucket_refills_up_to_capacity(clock):
+    bucket = TokenBucket(rate=10, capacity=2, clock=clock)
+    for _ in range(2):
+        asyncio.run(bucket.acquire())
+    assert bucket.saturated()
+    clock.now += 0.2
+    assert not bucket.saturated()
+    clock.now += 10
+    bucket._refill()
+    assert bucket.tokens == 2
+
+
+def test_token_bucket_follows_rate_limit_headers(clock):
+    bucket = TokenBucket(clock=clock)
+    bucket.update_from_headers({'x-ratelimit-limit': '50', 'x-ratelimit-period': '10',
+                                'x-ratelimit-remaining': '3'})
+    assert (bucket.capacity, bucket.rate, bucket.tokens) == (50, 5, 3)
+    bucket.update_from_headers({'x-ratelimit-remaining': '0', 'x-ratelimit-reset': '7'})
+    assert bucket.blocked_until == clock.now + 7
+    assert bucket.saturated()
+    clock.now += 7.5
+    assert not bucket.saturated()
+    bucket.update_from_headers({'x-ratelimit-limit': 'many', 'x-ratelimit-period': '10'})
+    assert bucket.capacity == 50
+
+
+def test_retry_budget_floor_and_ratio(clock):
+    budget = RetryBudget(ratio=0.5, min_per_second=0.2, ttl=10, clock=clock)
+    assert [budget.try_withdraw() for _ in range(3)] == [True, True, False]
+    for _ in range(4):
+        budget.record_request()
+    assert [budget.try_withdraw() for _ in range(3)] == [True, True, False]
+    clock.now += 11
+    assert budget.try_withdraw()
+
+
+@pytest.mark.parametrize('headers, expected', [
+    ({'retry-after': '3'}, 3.0),
+    ({'retry-after': '-1'}, 0.0),
+    ({'retry-after': 'soon', 'x-ratelimit-reset': '4'}, 4.0),
+    ({'x-ratelimit-reset': '5'}, 5.0),
+    ({}, 1.5),
+])
+def test_retry_after_seconds(headers, expected):
+    assert retry_after_seconds(headers, default=1.5) == expected
+
+
+def test_429_waits_for_retry_after(clock, sleeps):
+    sender = Sender((429, {'retry-after': '60'}), 202)
+    dispatcher = Dispatcher(sender, bucket=TokenBucket(clock=clock), max_delay=5.0)
+    started = clock.now
+    assert asyncio.run(dispatcher.post('events', b'{}')).status_code == 202
+    assert sender.requests == 2
+    assert clock.now - started == 5.0
+    assert dispatcher.stats['throttled'] == 1
+
+
+def test_server_errors_retried_until_max_attempts(sleeps):
+    sender = Sender(503, 502, 500, 202)
+    dispatcher = Dispatcher(sender, max_attempts=3, base_delay=0.1)
+    assert asyncio.run(dispatcher.post('events', b'{}')).status_code == 500
+    assert sender.requests == 3
+    assert dispatcher.stats['gave_up'] == 1
+    assert all(0 <= delay <= dispatcher.max_delay for delay in sleeps)
+
+
+def test_client_error_not_retried(sleeps):
+    sender = Sender(400, 202)
+    assert asyncio.run(Dispatcher(sender).post('events', b'{}')).status_code == 400
+    assert sender.requests == 1
+
+
+def test_max_total_stops_retries(sleeps):
+    sender = Sender(DatadogConnectionError('down'), 202)
+    dispatcher = Dispatcher(sender, max_total=1.0)
+    dispatcher.backoff = lambda attempt: 5.0
+    with pytest.raises(DatadogConnectionError):
+        asyncio.run(dispatcher.post('events', b'{}'))
+    assert sender.requests == 1
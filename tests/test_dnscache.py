@@ -0,0 +1,80 @@
+import time
+import pytest
+import dns.name
+import dns.resolver
+from vcenterdd.alarm.dnscache import DnsCache
+
+
+class Answer(object):
+
+    def __init__(self, fqdn, ttl):
+        self.canonical_name = dns.name.from_text(fqdn)
+        self.rrset = type('RRset', (object,), {'ttl': ttl})()
+
+
+class Resolver(object):
+    """ dns.resolver.Resolver answering from a dict of name to Answer or exception """
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.queries = []
+
+    def resolve(self, name, search=False):
+        self.queries.append(name)
+        answer = self.answers[name]
+        if isinstance(answer, BaseException):
+            raise answer
+        return answer
+
+
+@pytest.fixture
+def resolver():
+    return Resolver({
+        'esx01': Answer('esx01.example.com.', 300),
+        'short': Answer('short.example.com.', 5),
+        'datastore01': dns.resolver.NXDOMAIN(),
+        'bad..name': dns.name.EmptyLabel(),
+        'unreachable': OSError('Network is unreachable'),
+    })
+
+
+@pytest.fixture
+def cache(tmp_path, resolver):
+    cache = DnsCache(str(tmp_path / 'dns.sqlite'), negative_ttl=900, min_ttl=60, dns_resolver=resolver)
+    yield cache
+    cache.close()
+
+
+def test_positive_answer_cached_with_bounded_ttl(cache, resolver):
+    assert cache.lookup('esx01') == 'esx01.example.com'
+    assert cache.lookup('esx01') == 'esx01.example.com'
+    assert resolver.queries == ['esx01']
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.resolve('short') == ('short.example.com', 60)
+
+
+def test_nxdomain_cached_for_negative_ttl(cache, resolver, monkeypatch):
+    assert cache.lookup('datastore01') is None
+    assert cache.lookup('datastore01') is None
+    assert resolver.queries == ['datastore01']
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 901)
+    assert cache.lookup('datastore01') is None
+    assert resolver.queries == ['datastore01', 'datastore01']
+
+
+@pytest.mark.parametrize('name', ['bad..name', 'unreachable'])
+def test_unexpected_failure_not_cached(cache, resolver, name):
+    assert cache.resolve(name) == (None, None)
+    assert cache.lookup(name) is None
+    assert cache.lookup(name) is None
+    assert resolver.queries == [name] * 3
+
+
+def test_prewarm(cache, resolver):
+    assert cache.prewarm(['esx01', 'datastore01', 'unreachable', ' ']) == (1, 2)
+    resolver.queries = []
+    assert cache.lookup('esx01') == 'esx01.example.com'
+    assert cache.lookup('datastore01') is None
+    cache.lookup('unreachable')
+    assert resolver.queries == ['unreachable']
@@ -0,0 +1,97 @@
+import time
+import pytest
+from vcenterdd.alarm.lifecycle import AlarmLifecycle
+from vcenterdd.outbox.replay import OutboxReplayer, event_sender, post_or_spool, SPOOLED, QUEUED
+from vcenterdd.outbox.spool import Outbox
+
+
+@pytest.fixture
+def lifecycle(tmp_path):
+    lifecycle = AlarmLifecycle(str(tmp_path / 'lifecycle.sqlite'), ttl=3600, prune_probability=0)
+    yield lifecycle
+    lifecycle.close()
+
+
+def event(alert_type, key='key-1'):
+    return {'aggregation_key': key, 'alert_type': alert_type, 'title': alert_type}
+
+
+def post(lifecycle, datadog_format, event_id, when):
+    """ What a sink does around a post: link the event, then record it """
+    lifecycle.link(datadog_format)
+    lifecycle.record(datadog_format, event_id=event_id, when=when)
+    return datadog_format
+
+
+def test_escalation_and_resolution_linked_to_trigger(lifecycle):
+    now = time.time()
+    trigger = post(lifecycle, event('warning'), 101, now)
+    assert 'related_event_id' not in trigger
+    escalation = post(lifecycle, event('error'), 102, now + 1)
+    assert escalation['related_event_id'] == 101
+    resolution = post(lifecycle, event('success'), 103, now + 2)
+    assert resolution['related_event_id'] == 101
+    entry = lifecycle.get('key-1')
+    assert (entry.event_id, entry.status, entry.first_seen, entry.last_seen) == (101, 'success', now, now + 2)
+    assert not entry.is_open
+
+
+def test_trigger_after_resolution_reopens(lifecycle):
+    now = time.time()
+    post(lifecycle, event('warning'), 101, now)
+    post(lifecycle, event('success'), 102, now + 1)
+    retrigger = post(lifecycle, event('error'), 201, now + 2)
+    assert 'related_event_id' not in retrigger
+    entry = lifecycle.get('key-1')
+    assert (entry.event_id, entry.status, entry.first_seen) == (201, 'error', now + 2)
+    assert entry.is_open
+    assert post(lifecycle, event('success'), 202, now + 3)['related_event_id'] == 201
+
+
+def test_spooled_trigger_adopts_first_posted_id(lifecycle):
+    now = time.time()
+    lifecycle.record(event('warning'), event_id=None, when=now)
+    assert lifecycle.link(event('error')).event_id is None
+    lifecycle.record(event('error'), event_id=301, when=now + 1)
+    assert lifecycle.get('key-1').event_id == 301
+
+
+def test_replayed_events_linked_to_replayed_trigger(lifecycle, tmp_path):
+    class Datadog(object):
+        down = True
+        events = []
+
+        def post_event(self, **datadog_format):
+            if self.down:
+                raise OSError('Connection refused')
+            self.events.append(datadog_format)
+            return 400 + len(self.events)
+
+    datadog = Datadog()
+    outbox = Outbox(str(tmp_path / 'outbox'), fsync_every=1)
+    assert post_or_spool(datadog, outbox, event('warning'), lifecycle=lifecycle) == SPOOLED
+    assert post_or_spool(datadog, outbox, event('success'), lifecycle=lifecycle) == QUEUED
+    datadog.down = False
+    assert OutboxReplayer(outbox, event_sender(datadog, lifecycle=lifecycle)).drain() == 2
+    outbox.close()
+    assert 'related_event_id' not in datadog.events[0]
+    assert datadog.events[1]['related_event_id'] == 401
+    assert lifecycle.get('key-1').event_id == 401
+
+
+def test_expired_entries_ignored_and_pruned(lifecycle):
+    old = time.time() - 7200
+    lifecycle.record(event('warning', key='old'), event_id=1, when=old)
+    lifecycle.record(event('warning', key='new'), event_id=2)
+    assert lifecycle.get('old') is None
+    assert 'related_event_id' not in post(lifecycle, event('error', key='old'), 3, time.time())
+    # the expired incident is not continued, the new trigger is the parent of the next one
+    assert lifecycle.get('old').event_id == 3
+    lifecycle.record(event('warning', key='stale'), event_id=4, when=old)
+    assert lifecycle.prune() == 1
+    assert lifecycle.get('new').event_id == 2
+
+
+def test_event_without_key_not_recorded(lifecycle):
+    lifecycle.record({'alert_type': 'error'}, event_id=1)
+    assert lifecycle.link({'alert_type': 'error'}) is None
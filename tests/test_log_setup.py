@@ -0,0 +1,87 @@
+import logging
+import threading
+import pytest
+from vcenterdd.log.setup import LoggerSetup
+
+
+class BlockingHandler(logging.Handler):
+    """ Holds the listener thread until released """
+
+    def __init__(self):
+        super().__init__()
+        self.unblocked = threading.Event()
+        self.records = []
+
+    def emit(self, record):
+        self.unblocked.wait(5)
+        self.records.append(record.getMessage())
+
+
+def config(tmp_path, level='INFO'):
+    return {
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {'plain': {'format': '%(name)s %(levelname)s %(message)s'}},
+        'handlers': {
+            'alarms': {'class': 'logging.FileHandler', 'filename': str(tmp_path / 'logs' / 'alarms.log'),
+                       'formatter': 'plain', 'level': 'INFO'},
+            'errors': {'class': 'logging.FileHandler', 'filename': str(tmp_path / 'logs' / 'errors.log'),
+                       'formatter': 'plain', 'level': 'ERROR'},
+        },
+        'loggers': {
+            'test.alarm': {'handlers': ['alarms', 'errors'], 'level': level, 'propagate': False},
+            'test.other': {'handlers': ['errors'], 'level': 'DEBUG', 'propagate': False},
+        },
+    }
+
+
+@pytest.fixture
+def teardown_loggers():
+    # the setup also swaps the handlers of the root logger, pytest's own among them
+    root = logging.getLogger()
+    root_handlers = list(root.handlers)
+    yield
+    root.handlers[:] = root_handlers
+    for name in ('test.alarm', 'test.other'):
+        logger = logging.getLogger(name)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+
+
+def test_records_routed_to_their_handlers(tmp_path, teardown_loggers):
+    setup = LoggerSetup(dict_config=config(tmp_path), auto_setup=True)
+    logging.getLogger('test.alarm').info('Alarm %s posted', 'alarm-7')
+    logging.getLogger('test.alarm').error('Alarm %s failed', 'alarm-8')
+    logging.getLogger('test.other').warning('not an error')
+    logging.getLogger('test.other').error('other error')
+    setup.stop()
+    assert (tmp_path / 'logs' / 'alarms.log').read_text().splitlines() == [
+        'test.alarm INFO Alarm alarm-7 posted', 'test.alarm ERROR Alarm alarm-8 failed']
+    assert (tmp_path / 'logs' / 'errors.log').read_text().splitlines() == [
+        'test.alarm ERROR Alarm alarm-8 failed', 'test.other ERROR other error']
+    assert setup.dropped == 0
+
+
+def test_set_loglevel(tmp_path, teardown_loggers):
+    setup = LoggerSetup(dict_config=config(tmp_path))
+    setup.set_loglevel('debug', exclude_loggers=['test.other'])
+    assert setup.dictConfig['loggers']['test.alarm']['level'] == 'DEBUG'
+    with pytest.raises(TypeError):
+        setup.set_loglevel('debug', exclude_loggers='test.other')
+
+
+def test_full_queue_drops_instead_of_blocking(tmp_path, teardown_loggers):
+    setup = LoggerSetup(dict_config=config(tmp_path), queue_size=2, auto_setup=False)
+    setup.setup()
+    logger = logging.getLogger('test.alarm')
+    blocking = BlockingHandler()
+    logger.handlers[0].targets = (blocking,)
+    for n in range(10):
+        logger.info('record %s', n)
+    blocking.unblocked.set()
+    setup.stop()
+    # one record in the handler and two in the queue at most, the others were dropped rather than waited for
+    assert setup.dropped >= 7
+    assert blocking.records == ['record {}'.format(n) for n in range(len(blocking.records))]
+    assert 1 <= len(blocking.records) <= 3
@@ -0,0 +1,73 @@
+import json
+import logging
+from vcenterdd.datadog.logs import LogShipper, DatadogLogHandler
+
+
+class FakeDatadog(object):
+
+    def __init__(self, fail=0):
+        self.batches = []
+        self.fail = fail
+
+    def post_logs(self, batch, compression=None):
+        if self.fail:
+            self.fail -= 1
+            raise OSError('down')
+        self.batches.append(batch)
+
+
+def record(n, size=10):
+    return {'message': 'x' * size, 'n': n}
+
+
+def test_batches_respect_record_count():
+    datadog = FakeDatadog()
+    shipper = LogShipper(datadog, max_batch_records=3)
+    for n in range(7):
+        shipper.submit(record(n))
+    assert shipper.flush() == 7
+    assert [[r['n'] for r in batch] for batch in datadog.batches] == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+def test_batches_respect_byte_limit():
+    datadog = FakeDatadog()
+    size = len(json.dumps(record(0, 100)).encode())
+    shipper = LogShipper(datadog, max_batch_bytes=2 + 2 * (size + 1))
+    for n in range(5):
+        shipper.submit(record(n, 100))
+    shipper.flush()
+    assert [len(batch) for batch in datadog.batches] == [2, 2, 1]
+
+
+def test_oversized_record_truncated():
+    shipper = LogShipper(FakeDatadog(), max_record_bytes=1000)
+    shipper.submit({'message': 'x' * 5000, 'alarm': {'a': 1}})
+    [sent] = shipper.next_batch()
+    assert sent['truncated'] and 'alarm' not in sent
+    assert len(json.dumps(sent).encode()) <= 1000
+
+
+def test_full_buffer_drops_oldest():
+    shipper = LogShipper(FakeDatadog(), max_buffer=3)
+    for n in range(5):
+        shipper.submit(record(n))
+    assert shipper.dropped == 2
+    assert [r['n'] for r in shipper.next_batch()] == [2, 3, 4]
+
+
+def test_failed_batch_counted():
+    datadog = FakeDatadog(fail=1)
+    shipper = LogShipper(datadog, max_batch_records=2)
+    for n in range(3):
+        shipper.submit(record(n))
+    assert shipper.flush() == 1
+    assert (shipper.sent, shipper.failed) == (1, 2)
+
+
+def test_handler_skips_delivery_loggers():
+    shipper = LogShipper(FakeDatadog())
+    handler = DatadogLogHandler(shipper, hostname='forwarder01')
+    for name in ('vcenterdd.daemon.pipeline', 'vcenterdd.datadog.sender', 'vcenterdd.datadogx'):
+        handler.handle(logging.LogRecord(name, logging.ERROR, __file__, 1, 'failed %s', ('x',), None))
+    assert [(r['logger']['name'], r['message'], r['status']) for r in shipper.buffer] == [
+        ('vcenterdd.daemon.pipeline', 'failed x', 'error'), ('vcenterdd.datadogx', 'failed x', 'error')]
@@ -0,0 +1,85 @@
+import gzip
+import zlib
+import datetime
+import pytest
+from vcenterdd.datadog.handle import compress_body
+from vcenterdd.datadog.metrics import MetricsBuffer, STATUS_METRIC, TRANSITIONS_METRIC
+
+
+class Alarm(object):
+    """ The attributes of a VcenterAlarm the metrics read """
+
+    def __init__(self, target, newstatus, env='env:test'):
+        self.alarm_name = 'alarm.DatastoreDiskUsageAlarm'
+        self.target_name = target
+        self.newstatus = newstatus
+        self.env = env
+        self.date_time = datetime.datetime(2026, 1, 1, 12, 0, 0)
+
+
+class FakeDatadog(object):
+
+    def __init__(self):
+        self.posted = []
+
+    def post_metric(self, payload, compression=None):
+        self.posted.append((payload, compression))
+
+
+def test_alarm_points():
+    buffer = MetricsBuffer(FakeDatadog(), flush_interval=10, host='vc01')
+    buffer.record_alarm(Alarm('ds1', 'Red'))
+    buffer.record_alarm(Alarm('ds1', 'Green'))
+    buffer.record_alarm(Alarm('ds2', 'Purple'))
+    series = {(s['metric'], s['tags'][1]): s for s in buffer.drain()}
+    tags = ['alarm_name:alarm.DatastoreDiskUsageAlarm', 'target:ds1', 'env:test']
+    assert series[STATUS_METRIC, 'target:ds1']['tags'] == tags
+    assert [value for _, value in series[STATUS_METRIC, 'target:ds1']['points']] == [2, 0]
+    assert series[STATUS_METRIC, 'target:ds2']['points'][0][1] == -1
+    assert series[TRANSITIONS_METRIC, 'target:ds1']['points'][0][1] == 2
+    assert series[TRANSITIONS_METRIC, 'target:ds1']['interval'] == 10
+    assert series[STATUS_METRIC, 'target:ds1']['host'] == 'vc01'
+    assert buffer.drain() == []
+
+
+def test_series_and_points_bounded():
+    buffer = MetricsBuffer(FakeDatadog(), max_series=2, max_points_per_series=3)
+    for n in range(5):
+        buffer.gauge('m', n, tags=['a'], timestamp=n + 1)
+    buffer.increment('c', tags=['a'])
+    buffer.gauge('m', 1, tags=['b'])
+    assert buffer.dropped == 1
+    series = buffer.drain()
+    assert [s['points'] for s in series if s['metric'] == 'm'] == [[[3, 2], [4, 3], [5, 4]]]
+
+
+def test_flush_batches():
+    datadog = FakeDatadog()
+    buffer = MetricsBuffer(datadog, series_per_request=2, compression='deflate')
+    for n in range(5):
+        buffer.gauge('m', n, tags=['n:{}'.format(n)])
+    assert buffer.flush() == 5
+    assert [len(payload['series']) for payload, _ in datadog.posted] == [2, 2, 1]
+    assert {compression for _, compression in datadog.posted} == {'deflate'}
+    assert buffer.flush() == 0
+
+
+def test_stop_logs_a_failed_flush():
+    class FailingDatadog(object):
+        def post_metric(self, payload, compression=None):
+            raise OSError('down')
+
+    buffer = MetricsBuffer(FailingDatadog())
+    buffer.gauge('m', 1)
+    buffer.stop()
+
+
+@pytest.mark.parametrize('compression, decompress, encoding', [
+    ('gzip', gzip.decompress, {'Content-Encoding': 'gzip'}),
+    ('deflate', zlib.decompress, {'Content-Encoding': 'deflate'}),
+    (None, bytes, {}),
+])
+def test_compress_body(compression, decompress, encoding):
+    body, headers = compress_body(b'{"series": []}' * 10, compression)
+    assert decompress(body) == b'{"series": []}' * 10
+    assert headers == encoding
@@ -0,0 +1,139 @@
+import os
+import json
+import datetime
+import pytest
+from vcenterdd.datadog.exceptions import DatadogConnectionError, DatadogHTTPError
+from vcenterdd.datadog.sender import SenderResponse
+from vcenterdd.outbox.spool import Outbox, encode_event, decode_event
+from vcenterdd.outbox.replay import OutboxReplayer, post_or_spool, retryable, POSTED, QUEUED, SPOOLED
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    outbox = Outbox(str(tmp_path / 'outbox'), fsync_every=1)
+    yield outbox
+    outbox.close()
+
+
+def http_error(status):
+    response = SenderResponse('https://api.datadoghq.com/api/v1/events', status, 'Error', {}, b'', 0.0)
+    return DatadogHTTPError('{} Error'.format(status), response=response)
+
+
+def test_append_read_ack(outbox):
+    for n in range(5):
+        outbox.append({'n': n})
+    records = outbox.read(max_records=3)
+    assert [r for _, r in records] == [{'n': 0}, {'n': 1}, {'n': 2}]
+    outbox.ack(records[-1][0])
+    assert [r for _, r in outbox.read()] == [{'n': 3}, {'n': 4}]
+    outbox.ack(outbox.read()[-1][0])
+    assert not outbox.pending()
+    assert outbox.read() == []
+
+
+def test_corrupt_record_skipped(outbox):
+    outbox.append({'n': 0})
+    outbox.append({'n': 1})
+    path = os.path.join(outbox.path, sorted(os.listdir(outbox.path))[-1])
+    with open(path, 'r+b') as f:
+        data = f.read()
+        # flip a byte in the body of the first record, its crc no longer matches
+        f.seek(data.index(b'"n":0') + 4)
+        f.write(b'7')
+    assert [r for _, r in outbox.read()] == [{'n': 1}]
+
+
+def test_size_cap_drops_oldest_segments(tmp_path):
+    outbox = Outbox(str(tmp_path / 'outbox'), segment_bytes=200, max_bytes=600)
+    try:
+        for n in range(100):
+            outbox.append({'n': n, 'padding': 'x' * 40})
+        assert outbox.dropped_segments > 0
+        assert outbox.stats()['bytes'] <= 600 + 200
+        records = [r['n'] for _, r in outbox.read(max_records=1000)]
+        assert records[-1] == 99
+        assert records == sorted(records)
+    finally:
+        outbox.close()
+
+
+def test_event_encoding_round_trip():
+    event = {'title': 't', 'text': 'x', 'date_happened': datetime.datetime(2026, 1, 1, 12, 30)}
+    assert decode_event(json.loads(json.dumps(encode_event(event)))) == event
+
+
+@pytest.mark.parametrize('error, expected', [
+    (DatadogConnectionError('refused'), True),
+    (ConnectionResetError(), True),
+    (http_error(429), True),
+    (http_error(408), True),
+    (http_error(503), True),
+    (http_error(400), False),
+    (http_error(403), False),
+    (ValueError('bad payload'), False),
+])
+def test_retryable(error, expected):
+    assert retryable(error) is expected
+
+
+def test_poisoned_record_does_not_block_replay(outbox):
+    outbox.append(encode_event({'title': 'poisoned', 'text': ''}))
+    outbox.append(encode_event({'title': 'good', 'text': ''}))
+    posted = []
+
+    def send(record):
+        if record['payload']['title'] == 'poisoned':
+            raise http_error(400)
+        posted.append(record['payload']['title'])
+
+    replayer = OutboxReplayer(outbox, send)
+    assert replayer.drain() == 1
+    assert posted == ['good']
+    assert replayer.dead_lettered == 1
+    assert not outbox.pending()
+    with open(outbox.dead_letter_file) as f:
+        dead = [json.loads(line) for line in f]
+    assert [d['record']['payload']['title'] for d in dead] == ['poisoned']
+    assert '400' in dead[0]['reason']
+
+
+def test_unhealthy_endpoint_stops_replay(outbox):
+    outbox.append(encode_event({'title': 'first', 'text': ''}))
+    outbox.append(encode_event({'title': 'second', 'text': ''}))
+
+    def send(record):
+        raise http_error(503)
+
+    replayer = OutboxReplayer(outbox, send)
+    assert replayer.drain() == 0
+    assert [r['payload']['title'] for _, r in outbox.read()] == ['first', 'second']
+
+
+class FakeDatadog(object):
+
+    def __init__(self, error=None):
+        self.error = error
+        self.posted = []
+
+    def post_event(self, **kwargs):
+        if self.error is not None:
+            raise self.error
+        self.posted.append(kwargs['title'])
+        return len(self.posted)
+
+
+def test_post_or_spool(outbox):
+    assert post_or_spool(FakeDatadog(), outbox, {'title': 'a', 'text': ''}) == POSTED
+    assert post_or_spool(FakeDatadog(DatadogConnectionError('down')), outbox, {'title': 'b', 'text': ''}) == SPOOLED
+    # spooled behind b to keep the order, even though the endpoint answers again
+    datadog = FakeDatadog()
+    assert post_or_spool(datadog, outbox, {'title': 'c', 'text': ''}) == QUEUED
+    assert datadog.posted == []
+    assert [r['payload']['title'] for _, r in outbox.read()] == ['b', 'c']
+
+
+def test_post_or_spool_raises_refused_events(outbox):
+    with pytest.raises(DatadogHTTPError):
+        post_or_spool(FakeDatadog(http_error(400)), outbox, {'title': 'a', 'text': ''})
+    assert not outbox.pending()
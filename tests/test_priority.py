@@ -0,0 +1,103 @@
+import queue
+import pytest
+from vcenterdd.alarm.record import AlarmRecord
+from vcenterdd.daemon.priority import PriorityAlarmQueue, QUEUED, DOWNGRADED, SHED, REJECTED
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def record(target, newstatus, alarm_name='alarm.DatastoreDiskUsageAlarm'):
+    return AlarmRecord(alarm_name=alarm_name, target_name=target, newstatus=newstatus, eventdescription='', time=0)
+
+
+def drain(alarms):
+    taken = []
+    while True:
+        try:
+            env, rec, low = alarms.get(timeout=0)
+        except queue.Empty:
+            return taken
+        taken.append((rec.target_name, rec.newstatus, low))
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def test_urgent_alarms_overtake_within_their_delay(clock):
+    alarms = PriorityAlarmQueue(clock=clock)
+    alarms.put('env:prod', record('ds1', 'Green'))
+    clock.now = 25
+    # the Green transition waited longer than the difference in delays, it goes before the Yellow one
+    alarms.put('env:prod', record('ds2', 'Yellow'))
+    alarms.put('env:prod', record('esx1', 'Red'))
+    clock.now = 40
+    alarms.put('env:prod', record('ds3', 'Red'))
+    assert [t for t, _, _ in drain(alarms)] == ['esx1', 'ds1', 'ds2', 'ds3']
+
+
+def test_transitions_of_one_alarm_keep_their_order(clock):
+    alarms = PriorityAlarmQueue(clock=clock)
+    alarms.put('env:prod', record('ds1', 'Yellow'))
+    alarms.put('env:prod', record('ds1', 'Red'))
+    alarms.put('env:prod', record('ds2', 'Red'))
+    assert drain(alarms) == [('ds2', 'Red', False), ('ds1', 'Yellow', False), ('ds1', 'Red', False)]
+
+
+def test_alarm_name_adjustment(clock):
+    alarms = PriorityAlarmQueue.from_config({'alarm_names': {'alarm.HostConnectionLostAlarm': -30}}, clock=clock)
+    alarms.put('env:prod', record('ds1', 'Red'))
+    alarms.put('env:prod', record('esx1', 'Yellow', alarm_name='alarm.HostConnectionLostAlarm'))
+    assert [t for t, _, _ in drain(alarms)] == ['esx1', 'ds1']
+    with pytest.raises(ValueError):
+        PriorityAlarmQueue.from_config({'delay': {}})
+
+
+def test_low_value_transitions_shed_under_pressure(clock):
+    draws = iter([0.05, 0.5, 0.5])
+    alarms = PriorityAlarmQueue(maxsize=10, shed_above=0.2, shed_sample=0.1, rng=lambda: next(draws), clock=clock)
+    assert alarms.put('env:prod', record('ds1', 'Green')) == QUEUED
+    assert alarms.put('env:prod', record('ds2', 'Yellow')) == QUEUED
+    assert alarms.put('env:prod', record('ds3', 'Green')) == DOWNGRADED
+    assert alarms.put('env:prod', record('ds4', 'Green')) == SHED
+    assert alarms.put('env:prod', record('ds5', 'Gray')) == SHED
+    assert alarms.put('env:prod', record('ds6', 'Red')) == QUEUED
+    assert ('ds3', 'Green', True) in drain(alarms)
+    assert (alarms.stats[SHED], alarms.stats['shed:success'], alarms.stats['shed:info']) == (2, 1, 1)
+
+
+def test_saturated_rate_budget_sheds(clock):
+    alarms = PriorityAlarmQueue(saturated=lambda: True, shed_sample=0, clock=clock)
+    assert alarms.put('env:prod', record('ds1', 'Green')) == SHED
+    assert alarms.put('env:prod', record('ds1', 'Red')) == QUEUED
+
+
+def test_full_queue_evicts_least_urgent(clock):
+    alarms = PriorityAlarmQueue(maxsize=3, shed_above=2, clock=clock)
+    alarms.put('env:prod', record('ds1', 'Yellow'))
+    alarms.put('env:prod', record('ds2', 'Green'))
+    alarms.put('env:prod', record('ds3', 'Green'))
+    assert alarms.put('env:prod', record('ds4', 'Red')) == QUEUED
+    assert alarms.stats['evicted:success'] == 1
+    assert alarms.put('env:prod', record('ds5', 'Green')) == REJECTED
+    assert alarms.qsize() == 3
+    assert [t for t, _, _ in drain(alarms)] == ['ds4', 'ds1', 'ds2']
+
+
+def test_put_last_comes_after_alarms(clock):
+    alarms = PriorityAlarmQueue(clock=clock)
+    stop = object()
+    alarms.put_last(stop)
+    alarms.put('env:prod', record('ds1', 'Green'))
+    assert alarms.get(timeout=0)[1].target_name == 'ds1'
+    assert alarms.get(timeout=0) is stop
+    with pytest.raises(queue.Empty):
+        alarms.get(timeout=0.01)
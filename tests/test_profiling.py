@@ -0,0 +1,84 @@
+import io
+import os
+import json
+import pytest
+from vcenterdd.profiling.runs import RunProfiler, StageTelemetry, run_directories, aggregate, STAGES_FILE
+from vcenterdd.telemetry import statsd
+
+
+@pytest.fixture
+def telemetry():
+    # the profiler swaps the process wide telemetry, put the original back whatever the test did
+    previous = statsd.telemetry()
+    yield previous
+    statsd.install(previous)
+
+
+def profiled_run(directory, **kwargs):
+    profile = RunProfiler(str(directory), **kwargs).start()
+    with profile.phase('imports'):
+        pass
+    with statsd.telemetry().timer('datadog.post'):
+        pass
+    statsd.telemetry().timing('datadog.post', 0.5)
+    profile.report()
+    return profile
+
+
+@pytest.mark.parametrize('sample,draw,sampled', [(1, 0.99, True), (4, 0.2, True), (4, 0.3, False), (0, 0.0, False)])
+def test_sampling(sample, draw, sampled):
+    assert RunProfiler('unused', sample=sample, rng=lambda: draw).sampled == sampled
+
+
+def test_sampled_run_writes_directory(tmp_path, telemetry):
+    profiled_run(tmp_path)
+    runs = run_directories(str(tmp_path))
+    assert len(runs) == 1
+    assert sorted(os.listdir(runs[0])) == ['cprofile.pstats', 'memory.json', 'stages.json']
+    with open(os.path.join(runs[0], STAGES_FILE)) as f:
+        stages = json.load(f)['stages']
+    assert set(stages) == {'imports', 'datadog.post'}
+    assert stages['datadog.post'] >= 0.5
+    assert statsd.telemetry() is telemetry
+
+
+def test_run_not_sampled_writes_nothing(tmp_path, telemetry):
+    profile = profiled_run(tmp_path, sample=10, rng=lambda: 0.5)
+    assert not profile.sampled
+    assert os.listdir(str(tmp_path)) == []
+    assert not isinstance(statsd.telemetry(), StageTelemetry)
+
+
+def test_stage_telemetry_sums_timers():
+    stages = {}
+    stage_telemetry = StageTelemetry(statsd.NullTelemetry(), stages)
+    stage_telemetry.timing('dns.resolve', 0.25)
+    stage_telemetry.timing('dns.resolve', 0.5)
+    assert stages == {'dns.resolve': [2, 0.75]}
+
+
+def test_rotate_keeps_newest(tmp_path):
+    for stamp in ('20260101T120000', '20260101T120001', '20260101T120002', '20260101T120003'):
+        os.makedirs(str(tmp_path / 'run-{}-1'.format(stamp)))
+    os.makedirs(str(tmp_path / 'run-20260101T120004-1.partial'))
+    RunProfiler(str(tmp_path), keep=2).rotate()
+    assert [os.path.basename(run) for run in run_directories(str(tmp_path))] == [
+        'run-20260101T120002-1', 'run-20260101T120003-1']
+    assert (tmp_path / 'run-20260101T120004-1.partial').exists()
+
+
+def test_aggregate(tmp_path, telemetry):
+    profiled_run(tmp_path)
+    os.makedirs(str(tmp_path / 'run-00000000T000000-1'))
+    stream = io.StringIO()
+    assert aggregate(str(tmp_path), top=5, stream=stream) == 1
+    report = stream.getvalue()
+    assert 'Skipping' in report
+    assert report.count('\ndatadog.post ') == 1
+    assert 'imports' in report
+
+
+def test_aggregate_empty_directory(tmp_path):
+    stream = io.StringIO()
+    assert aggregate(str(tmp_path / 'missing'), stream=stream) == 0
+    assert stream.getvalue().startswith('No profiled runs in ')
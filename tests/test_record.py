@@ -0,0 +1,77 @@
+import pytest
+from vcenterdd.alarm.exceptions import AlarmRecordError
+from vcenterdd.alarm.handle import VcenterAlarm
+from vcenterdd.alarm.record import AlarmRecord
+
+ENVIRON = {
+    'VMWARE_ALARM_ID': 'alarm-7',
+    'VMWARE_ALARM_NAME': 'alarm.DatastoreDiskUsageAlarm',
+    'VMWARE_ALARM_TARGET_ID': 'datastore-444',
+    'VMWARE_ALARM_TARGET_NAME': 'CL0990NTNXP002_CTR-RF2',
+    'VMWARE_ALARM_NEWSTATUS': 'Yellow',
+    'VMWARE_ALARM_OLDSTATUS': 'Gray',
+    'VMWARE_ALARM_EVENTDESCRIPTION': "Alarm 'Datastore usage on disk' on CL0990NTNXP002_CTR-RF2 changed from Gray to "
+                                     "Yellow",
+    'VMWARE_ALARM_TRIGGERINGSUMMARY': 'Metric Disk Space actually used = 78% ✓',
+    'VMWARE_ALARM_EVENT_USERNAME': 'VSPHERE.LOCAL\\admin',
+    'HOME': '/root',
+}
+
+
+@pytest.fixture
+def record():
+    return AlarmRecord.from_env(ENVIRON, time=1767268800.5)
+
+
+def test_from_env(record):
+    assert record.alarm_name == 'alarm.DatastoreDiskUsageAlarm'
+    assert record.declaringsummary is None
+    assert record.extra == {'VMWARE_ALARM_EVENT_USERNAME': 'VSPHERE.LOCAL\\admin'}
+    assert record.get_extra('event_username') == 'VSPHERE.LOCAL\\admin'
+    assert record.to_env() == {k: v for k, v in ENVIRON.items() if k != 'HOME'}
+
+
+def test_bytes_round_trip(record):
+    data = record.to_bytes()
+    assert AlarmRecord.from_bytes(data) == record
+    assert AlarmRecord.from_bytes(data).time == 1767268800.5
+    bare = AlarmRecord(alarm_name='a', target_name='t', newstatus='Red', eventdescription='d', time=1.0)
+    assert AlarmRecord.from_bytes(bare.to_bytes()) == bare
+
+
+def test_dict_round_trip(record):
+    assert AlarmRecord.from_dict(record.to_dict()) == record
+
+
+@pytest.mark.parametrize('data', [b'', b'\x02\x00\x00', b'\x01\x00\x01\x7f'])
+def test_corrupt_bytes(data):
+    with pytest.raises(AlarmRecordError):
+        AlarmRecord.from_bytes(data)
+
+
+def test_truncated_bytes(record):
+    with pytest.raises(AlarmRecordError):
+        AlarmRecord.from_bytes(record.to_bytes()[:-3])
+
+
+def test_validation():
+    with pytest.raises(AlarmRecordError):
+        AlarmRecord.from_env({'VMWARE_ALARM_NAME': 'alarm.Test'})
+    with pytest.raises(AlarmRecordError):
+        AlarmRecord(status='Red')
+
+
+def test_values_interned(record):
+    other = AlarmRecord.from_bytes(record.to_bytes())
+    assert other.target_name is record.target_name
+    assert not hasattr(record, '__dict__')
+
+
+def test_alarm_reads_the_record(record):
+    alarm = VcenterAlarm('env:prod', record=record)
+    assert alarm.newstatus == 'Yellow'
+    assert alarm.event_username == 'VSPHERE.LOCAL\\admin'
+    assert alarm.summary == "Alarm 'Datastore usage on disk' on CL0990NTNXP002_CTR-RF2"
+    assert alarm.alert_type == 'warning'
+    with pytest.raises(AttributeError):
+        alarm.not_a_variable
@@ -0,0 +1,77 @@
+import gzip
+import json
+import datetime
+import pytest
+from vcenterdd.alarm.rules import RuleSet
+from vcenterdd.replay.capture import capture_alarm
+from vcenterdd.replay.runner import ReplayRunner, read_captures
+
+ENVIRON = {
+    'VMWARE_ALARM_NAME': 'alarm.DatastoreDiskUsageAlarm',
+    'VMWARE_ALARM_TARGET_NAME': 'ds01',
+    'VMWARE_ALARM_NEWSTATUS': 'Red',
+    'VMWARE_ALARM_OLDSTATUS': 'Yellow',
+    'VMWARE_ALARM_EVENTDESCRIPTION': "Alarm 'Datastore usage on disk' on ds01 changed from Yellow to Red",
+    'PATH': '/usr/bin',
+}
+
+
+class FakeDatadog(object):
+
+    def __init__(self):
+        self.events = []
+
+    async def post_event_async(self, **event):
+        if event['host'] == 'fail':
+            raise OSError('down')
+        self.events.append(event)
+
+
+class Resolver(object):
+
+    @staticmethod
+    def lookup(name):
+        return 'fail' if name == 'bad' else '{}.example.com'.format(name)
+
+
+@pytest.fixture
+def capture_file(tmp_path):
+    path = str(tmp_path / 'alarms.jsonl')
+    for n, target in enumerate(['ds01', 'ds02', 'bad']):
+        capture_alarm(path, 'env:prod', environ=dict(ENVIRON, VMWARE_ALARM_TARGET_NAME=target),
+                      captured=1767268800.0 + n)
+    with open(path, 'a') as f:
+        f.write('not json\n\n{"alarm": "no mapping"}\n')
+    return path
+
+
+def test_capture_keeps_only_alarm_variables(capture_file):
+    with open(capture_file) as f:
+        capture = json.loads(f.readline())
+    assert capture['env'] == 'env:prod'
+    assert capture['captured'] == 1767268800.0
+    assert 'PATH' not in capture['alarm']
+    assert capture['alarm']['VMWARE_ALARM_TARGET_NAME'] == 'ds01'
+
+
+def test_read_captures_skips_bad_lines(capture_file, tmp_path):
+    gz_file = str(tmp_path / 'more.jsonl.gz')
+    with open(capture_file, 'rb') as src, gzip.open(gz_file, 'wb') as dst:
+        dst.write(src.read())
+    captures = list(read_captures([capture_file, gz_file]))
+    assert [c['alarm']['VMWARE_ALARM_TARGET_NAME'] for c in captures] == ['ds01', 'ds02', 'bad'] * 2
+
+
+def test_replay_posts_with_captured_time(capture_file):
+    datadog = FakeDatadog()
+    stats = ReplayRunner(datadog, resolver=Resolver(), workers=2, window=2).run(read_captures([capture_file]))
+    assert (stats['read'], stats['formatted'], stats['posted'], stats['failed']) == (3, 3, 2, 1)
+    assert sorted(e['host'] for e in datadog.events) == ['ds01.example.com', 'ds02.example.com']
+    assert {e['date_happened'] for e in datadog.events} == {datetime.datetime.fromtimestamp(1767268800.0),
+                                                            datetime.datetime.fromtimestamp(1767268801.0)}
+
+
+def test_replay_dry_run_with_rules(capture_file):
+    rules = RuleSet({'rules': [{'name': 'ds02', 'match': {'target_name': '^ds02$'}, 'drop': True}]})
+    stats = ReplayRunner(dry_run=True, rules=rules, env='env:test').run(read_captures([capture_file]))
+    assert (stats['read'], stats['dropped'], stats['formatted'], stats['posted']) == (3, 1, 2, 0)
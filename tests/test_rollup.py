@@ -0,0 +1,110 @@
+import datetime
+from vcenterdd.alarm.handle import VcenterAlarm
+from vcenterdd.alarm.rollup import StormRollup, StormSummary
+
+
+class Alarm(object):
+    """ The attributes of a VcenterAlarm the rollup reads """
+
+    def __init__(self, target, newstatus, oldstatus='Green', alarm_name='Datastore usage on disk', env='env:test'):
+        self.alarm_name = alarm_name
+        self.target_name = target
+        self.newstatus = newstatus
+        self.oldstatus = oldstatus
+        self.env = env
+        self.date_time = datetime.datetime(2026, 1, 1)
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def add(rollup, clock, alarms, step=0.1):
+    released = []
+    for alarm in alarms:
+        clock.now += step
+        released.extend(rollup.add([(alarm, None)]))
+    return released
+
+
+def test_storm_rolled_up():
+    clock = Clock()
+    rollup = StormRollup(threshold=3, window=10, clock=clock)
+    released = add(rollup, clock, [Alarm('ds{}'.format(n), 'Red') for n in range(10)])
+    assert [a.target_name for a, _ in released] == ['ds0', 'ds1']
+    clock.now += 10
+    summaries = rollup.due()
+    assert len(summaries) == 1
+    summary = summaries[0][0]
+    assert isinstance(summary, StormSummary)
+    assert [t[0] for t in summary.targets] == ['ds{}'.format(n) for n in range(2, 10)]
+    assert summary.sent == 2
+
+
+def test_sent_counts_only_the_window_that_started_the_storm():
+    clock = Clock()
+    rollup = StormRollup(threshold=3, window=10, clock=clock)
+    # a steady trickle below the threshold keeps the key tracked without starting a storm
+    released = add(rollup, clock, [Alarm('old{}'.format(n), 'Red') for n in range(5)], step=6)
+    assert len(released) == 5
+    assert add(rollup, clock, [Alarm('ds{}'.format(n), 'Red') for n in range(5)]) == []
+    summary = rollup.flush()[0][0]
+    assert [t[0] for t in summary.targets] == ['ds{}'.format(n) for n in range(5)]
+    # only old3 and old4 went out individually within the window that started the storm
+    assert summary.sent == 2
+
+
+def test_recovery_releases_trigger_summary_first():
+    clock = Clock()
+    rollup = StormRollup(threshold=3, window=10, clock=clock)
+    add(rollup, clock, [Alarm('ds{}'.format(n), 'Red') for n in range(6)])
+    released = add(rollup, clock, [Alarm('ds0', 'Green', oldstatus='Red')])
+    assert isinstance(released[0][0], StormSummary)
+    assert released[0][0].first.newstatus == 'Red'
+    assert released[1][0].target_name == 'ds0'
+    # the trigger storm goes on, its next summary only holds the targets that came after the recovery
+    add(rollup, clock, [Alarm('ds6', 'Red')])
+    summary = rollup.flush()[0][0]
+    assert [t[0] for t in summary.targets] == ['ds6']
+    assert summary.sent == 0
+
+
+def test_other_alarms_not_released():
+    clock = Clock()
+    rollup = StormRollup(threshold=3, window=10, clock=clock)
+    add(rollup, clock, [Alarm('ds{}'.format(n), 'Red') for n in range(6)])
+    released = add(rollup, clock, [Alarm('esx01', 'Green', oldstatus='Red', alarm_name='Host CPU usage')])
+    assert [a.target_name for a, _ in released] == ['esx01']
+
+
+def test_disabled():
+    rollup = StormRollup(threshold=0)
+    ready = [(Alarm('ds{}'.format(n), 'Red'), None) for n in range(50)]
+    assert rollup.add(ready) == ready
+
+
+def test_summary_event_needs_no_dns():
+    class Resolver(object):
+        def lookup(self, name):
+            raise AssertionError('{} looked up'.format(name))
+
+    def alarm(target):
+        return VcenterAlarm('env:test', resolver=Resolver(), environ={
+            'VMWARE_ALARM_NAME': 'alarm.DatastoreDiskUsageAlarm', 'VMWARE_ALARM_TARGET_NAME': target,
+            'VMWARE_ALARM_NEWSTATUS': 'Red', 'VMWARE_ALARM_OLDSTATUS': 'Yellow',
+            'VMWARE_ALARM_EVENTDESCRIPTION': "Alarm 'Datastore usage on disk' on {} changed from Yellow to Red".format(
+                target)})
+
+    first = alarm('ds0')
+    summary = StormSummary(first, [('ds{}'.format(n), 'Yellow', first.date_time) for n in range(3)])
+    event = summary.format_datadog_event()
+    assert event['title'] == "[Triggered] Alarm 'Datastore usage on disk' on 3 targets"
+    assert event['host'] == '' and event['device_name'] == ''
+    assert event['alert_type'] == 'error'
+    assert 'inf.vsphere.alarm.DatastoreDiskUsageAlarm' in event['tags']
+    assert first.datadog_format == {}
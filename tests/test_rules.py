@@ -0,0 +1,82 @@
+import pytest
+from vcenterdd.alarm.exceptions import RuleError
+from vcenterdd.alarm.rules import RuleSet, DEFAULT_DECISION
+
+
+class Alarm(object):
+    """ The attributes of a VcenterAlarm the rules read """
+
+    def __init__(self, alarm_name='alarm.DatastoreDiskUsageAlarm', target_name='CL01-DS01', newstatus='Red',
+                 oldstatus='Green', env='env:prod'):
+        self.alarm_name = alarm_name
+        self.target_name = target_name
+        self.newstatus = newstatus
+        self.oldstatus = oldstatus
+        self.env = env
+        self.decision = None
+
+
+CONFIG = {
+    'rules': [
+        {'name': 'gray-green-noise', 'match': {'transition': ['Gray->Green']}, 'drop': True},
+        {'name': 'datastores', 'match': {'alarm_name': ['alarm.DatastoreDiskUsageAlarm'], 'target_name': '^CL\\d+',
+                                         'newstatus': ['Yellow', 'Red'], 'env': ['env:prod']},
+         'priority': 'low', 'destinations': ['events']},
+        {'name': 'hosts', 'match': {'alarm_name_pattern': 'Host', 'transition': ['*->Red']}, 'alert_type': 'error'},
+    ],
+}
+
+
+@pytest.mark.parametrize('alarm, rule', [
+    (Alarm(), 'datastores'),
+    (Alarm(newstatus='red', oldstatus='green'), 'datastores'),
+    (Alarm(oldstatus='Gray', newstatus='Green'), None),
+    (Alarm(target_name='ESX01-DS01'), 'default'),
+    (Alarm(env='env:dev'), 'default'),
+    (Alarm(newstatus='Green', oldstatus='Red'), 'default'),
+    (Alarm(alarm_name='alarm.HostConnectionStateAlarm', oldstatus='Yellow'), 'hosts'),
+    (Alarm(alarm_name='alarm.HostConnectionStateAlarm', newstatus='Yellow'), 'default'),
+])
+def test_first_matching_rule_decides(alarm, rule):
+    decision = RuleSet(CONFIG).apply(alarm)
+    assert alarm.decision is decision
+    assert (decision.rule if decision is not None else None) == rule
+
+
+def test_decision_inherits_defaults():
+    rules = RuleSet(CONFIG)
+    decision = rules.evaluate(Alarm())
+    assert decision.priority == 'low'
+    assert decision.destinations == frozenset(['events'])
+    assert decision.tags == DEFAULT_DECISION.tags
+    assert rules.evaluate(Alarm(target_name='other')) is DEFAULT_DECISION
+
+
+def test_candidates_indexed_by_alarm_name():
+    rules = RuleSet(CONFIG)
+    assert [r.name for r in rules.candidates('alarm.DatastoreDiskUsageAlarm')] == \
+        ['gray-green-noise', 'datastores', 'hosts']
+    assert [r.name for r in rules.candidates('alarm.HostConnectionStateAlarm')] == ['gray-green-noise', 'hosts']
+
+
+@pytest.mark.parametrize('draw, kept', [(0.0, True), (0.49, True), (0.5, False), (0.99, False)])
+def test_sampling(draw, kept):
+    config = {'rules': [{'name': 'half', 'sample': 0.5}]}
+    decision = RuleSet(config, rng=lambda: draw).evaluate(Alarm())
+    assert (decision is not None) is kept
+
+
+@pytest.mark.parametrize('rule', [
+    {'name': 'typo', 'matches': {}},
+    {'name': 'typo', 'match': {'status': ['Red']}},
+    {'name': 'regex', 'match': {'target_name': '('}},
+    {'name': 'transition', 'match': {'transition': ['Red']}},
+    {'name': 'sample', 'sample': 2},
+    {'name': 'sample', 'sample': 'half'},
+    {'name': 'priority', 'priority': 'urgent'},
+    {'name': 'destinations', 'destinations': ['pager']},
+    {'name': 'template', 'title': '{unknown_field}'},
+])
+def test_invalid_rule(rule):
+    with pytest.raises(RuleError):
+        RuleSet({'rules': [rule]})
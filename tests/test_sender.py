@@ -0,0 +1,91 @@
+import socket
+import asyncio
+import threading
+import pytest
+from vcenterdd.datadog.exceptions import DatadogConnectionError
+from vcenterdd.datadog.sender import AsyncSender, _Connection
+
+
+class FakeWriter(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def serve(requests, answer):
+    """
+    Accept one connection and answer the requests on it, answer(n) decides whether the n-th request gets a response
+    :return: port of the server
+    """
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+
+    def run():
+        conn, _ = server.accept()
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            requests.append(data)
+            if not answer(len(requests)):
+                break
+            conn.sendall(b'HTTP/1.1 202 Accepted\r\nContent-Length: 2\r\n\r\n{}')
+        conn.close()
+        server.close()
+
+    threading.Thread(target=run, daemon=True).start()
+    return server.getsockname()[1]
+
+
+@pytest.mark.parametrize('written, received, error, expected', [
+    (False, False, EOFError(), True),
+    (True, False, ConnectionResetError(), True),
+    (True, False, BrokenPipeError(), True),
+    (True, False, asyncio.IncompleteReadError(b'', None), False),
+    (True, True, ConnectionResetError(), False),
+])
+def test_retryable(written, received, error, expected):
+    conn = _Connection(None, FakeWriter())
+    conn.written = written
+    conn.received = received
+    assert AsyncSender._retryable(conn, error) is expected
+
+
+def test_request_read_by_server_not_sent_twice():
+    requests = []
+    port = serve(requests, answer=lambda n: n < 2)
+    sender = AsyncSender('http://127.0.0.1:{}/api/'.format(port), timeout=2.0)
+    try:
+        assert sender.run(sender.post_json('events', {})).status_code == 202
+        with pytest.raises(DatadogConnectionError):
+            sender.run(sender.post_json('events', {}))
+    finally:
+        sender.close()
+    assert len(requests) == 2
+
+
+def test_retry_connection_closed_when_retry_fails():
+    sender = AsyncSender('http://127.0.0.1:1/api/')
+    stale = _Connection(None, FakeWriter())
+    fresh = []
+
+    async def connect():
+        fresh.append(_Connection(None, FakeWriter()))
+        return fresh[-1]
+
+    async def exchange(conn, method, path, body, headers):
+        if conn is stale:
+            raise ConnectionResetError('Connection closed by the server')
+        raise asyncio.CancelledError()
+
+    sender._acquire = lambda: stale
+    sender._connect = connect
+    sender._exchange = exchange
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(sender._request('POST', 'events', b'{}', None))
+    assert stale.writer.closed
+    assert len(fresh) == 1 and fresh[0].writer.closed
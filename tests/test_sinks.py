@@ -0,0 +1,99 @@
+import datetime
+import pytest
+from vcenterdd.alarm.lifecycle import AlarmLifecycle
+from vcenterdd.datadog.exceptions import DatadogConnectionError
+from vcenterdd.datadog.sinks import Sink, SinkSet, sink_path, FAILED
+from vcenterdd.outbox.replay import POSTED, QUEUED, SPOOLED
+from vcenterdd.outbox.spool import Outbox
+
+EVENT = {'title': '[Triggered] Datastore usage on disk', 'text': 'ds01', 'alert_type': 'error',
+         'aggregation_key': 'key-1', 'date_happened': datetime.datetime(2026, 1, 1, 12, 0, 0)}
+
+
+class FakeDatadog(object):
+
+    def __init__(self, down=False):
+        self.down = down
+        self.events = []
+        self.closed = False
+
+    def post_event(self, **datadog_format):
+        if self.down:
+            raise DatadogConnectionError('Connection refused')
+        self.events.append(datadog_format)
+        return 1000 + len(self.events)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def sinks(tmp_path):
+    created = []
+
+    def make(*specs, inline=False):
+        for name, datadog, spool, max_pending in specs:
+            outbox = Outbox(str(tmp_path / 'outbox-{}'.format(name)), fsync_every=1) if spool else None
+            lifecycle = AlarmLifecycle(str(tmp_path / 'lifecycle-{}.sqlite'.format(name)), prune_probability=0)
+            created.append(Sink(name, datadog, outbox=outbox, lifecycle=lifecycle, max_pending=max_pending,
+                                inline=inline))
+        return SinkSet(created)
+
+    yield make
+    SinkSet(created).close() if created else None
+
+
+def test_fan_out_isolates_a_failing_sink(sinks):
+    primary, eu = FakeDatadog(), FakeDatadog(down=True)
+    sink_set = sinks(('primary', primary, True, 100), ('eu', eu, True, 100))
+    results = sink_set.post(dict(EVENT))
+    assert {name: r.status for name, r in results.items()} == {'primary': POSTED, 'eu': SPOOLED}
+    assert all(r.ok for r in results.values())
+    assert primary.events == [EVENT]
+    # the next event waits behind the spooled one so the eu org gets them in order
+    assert sink_set.post(dict(EVENT, alert_type='success'))['eu'].status == QUEUED
+    eu.down = False
+    assert sink_set.replay() == {'primary': 0, 'eu': 2}
+    assert [e['alert_type'] for e in eu.events] == ['error', 'success']
+    # event ids are per org, the eu resolution links to the eu trigger
+    assert eu.events[1]['related_event_id'] == 1001
+    assert primary.events[-1]['related_event_id'] == 1001
+
+
+def test_sink_without_outbox_fails(sinks):
+    sink_set = sinks(('primary', FakeDatadog(down=True), False, 100), inline=True)
+    result = sink_set.post(dict(EVENT))['primary']
+    assert result.status == FAILED
+    assert not result.ok
+    assert isinstance(result.error, DatadogConnectionError)
+    assert result.to_dict()['error'] == 'Connection refused'
+
+
+def test_backlog_spills_to_outbox(sinks):
+    slow = FakeDatadog()
+    sink_set = sinks(('primary', FakeDatadog(), True, 100), ('slow', slow, True, 0))
+    results = sink_set.post(dict(EVENT))
+    assert results['slow'].status == QUEUED
+    assert slow.events == []
+    assert sink_set.replay(names=['slow']) == {'slow': 1}
+    assert slow.events[0]['title'] == EVENT['title']
+
+
+def test_close_releases_every_sink(tmp_path):
+    datadogs = [FakeDatadog(), FakeDatadog()]
+    sink_set = SinkSet([Sink(str(n), datadog) for n, datadog in enumerate(datadogs)])
+    assert sink_set.flush(timeout=5)
+    sink_set.close()
+    assert all(datadog.closed for datadog in datadogs)
+
+
+def test_sink_names_must_be_unique():
+    with pytest.raises(ValueError):
+        SinkSet.from_config(None, config={'api_key': 'x', 'sinks': [{'name': 'primary', 'api_key': 'y'}]})
+    with pytest.raises(ValueError):
+        SinkSet([])
+
+
+def test_sink_path():
+    assert sink_path('vcenterdd/.outbox/', 'eu') == 'vcenterdd/.outbox-eu'
+    assert sink_path('vcenterdd/.lifecycle.sqlite', 'eu') == 'vcenterdd/.lifecycle-eu.sqlite'
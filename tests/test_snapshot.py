@@ -0,0 +1,43 @@
+import json
+import pytest
+from vcenterdd.config.snapshot import ConfigSnapshot
+
+
+@pytest.fixture
+def config_dir(tmp_path):
+    (tmp_path / 'logging_config.yml').write_text('version: 1\nroot: {level: INFO}\n')
+    (tmp_path / 'datadog_config.conf').write_text(json.dumps({'api_key': 'secret-api-key', 'app_key': 'secret-app-key',
+                                                              'sinks': [{'name': 'eu', 'api_key': 'secret-eu'}]}))
+    (tmp_path / 'rules.yml').write_text('rules: [{name: noise, drop: true}]\n')
+    return tmp_path
+
+
+def snapshot(config_dir):
+    return ConfigSnapshot(logging_file=str(config_dir / 'logging_config.yml'),
+                          datadog_file=str(config_dir / 'datadog_config.conf'),
+                          rules_file=str(config_dir / 'rules.yml')).load()
+
+
+def test_snapshot_reused_until_a_source_changes(config_dir):
+    first = snapshot(config_dir)
+    assert not first.from_cache
+    second = snapshot(config_dir)
+    assert second.from_cache
+    assert second.logging_config == first.logging_config == {'version': 1, 'root': {'level': 'INFO'}}
+    assert second.rules_config == {'rules': [{'name': 'noise', 'drop': True}]}
+    (config_dir / 'rules.yml').write_text('rules: []\n')
+    third = snapshot(config_dir)
+    assert not third.from_cache
+    assert third.rules_config == {'rules': []}
+
+
+def test_credentials_not_written_to_snapshot(config_dir):
+    first = snapshot(config_dir)
+    content = (config_dir / '.config_snapshot.json').read_text()
+    assert 'secret' not in content
+    assert first.datadog_config['api_key'] == 'secret-api-key'
+    # the keys are read from the Datadog config on every run, a new key is picked up by the next one
+    (config_dir / 'datadog_config.conf').write_text(json.dumps({'api_key': 'rotated-api-key'}))
+    second = snapshot(config_dir)
+    assert second.from_cache
+    assert second.datadog_config == {'api_key': 'rotated-api-key'}
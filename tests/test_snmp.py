@@ -0,0 +1,112 @@
+import socket
+import pytest
+from vcenterdd.alarm.handle import VcenterAlarm
+from vcenterdd.snmp.ber import read_tlv, read_children, decode_integer, TRAP_V2
+from vcenterdd.snmp.exceptions import TrapDecodeError
+from vcenterdd.snmp.listener import TrapListener
+from vcenterdd.snmp.trap import encode_trap, decode_trap, RESPONSE, INFORM, V1, V2C
+
+
+@pytest.mark.parametrize('version', [V1, V2C])
+def test_trap_round_trip(version):
+    datagram = encode_trap('Host CPU usage', 'esx01.example.com', 'Green', 'Red', community='lab', value='95%',
+                           version=version)
+    community, environ, request_id = decode_trap(datagram)
+    assert community == 'lab'
+    assert request_id is None
+    alarm = VcenterAlarm(env='env:lab', environ=environ)
+    assert alarm.alarm_name == 'Host CPU usage'
+    assert alarm.target_name == 'esx01.example.com'
+    assert alarm.target_id == 'esx01.example.com'
+    assert alarm.oldstatus == 'Green'
+    assert alarm.newstatus == 'Red'
+    assert alarm.alarmvalue == '95%'
+    assert alarm.eventdescription == "Alarm 'Host CPU usage' on esx01.example.com changed from Green to Red"
+    assert alarm.alert_type == 'error'
+
+
+def test_trap_target_prefers_vm():
+    datagram = encode_trap('VM memory usage', 'vm01', 'Yellow', 'Green', host='esx01', vm='vm01',
+                           target_type='VirtualMachine')
+    alarm = VcenterAlarm(env='env:lab', environ=decode_trap(datagram)[1])
+    assert alarm.target_name == 'vm01'
+    assert alarm.alert_type == 'success'
+
+
+def test_trap_without_alarm_varbinds():
+    datagram = encode_trap('', 'esx01', '', '')
+    assert decode_trap(datagram)[1] is None
+
+
+@pytest.mark.parametrize('datagram', [b'', b'\x02\x01\x00', b'\x30\x05\x02\x01\x01\x04\x00'])
+def test_malformed_trap(datagram):
+    with pytest.raises(TrapDecodeError):
+        decode_trap(datagram)
+
+
+def inform(name, target):
+    datagram = bytearray(encode_trap(name, target, 'Green', 'Red'))
+    # swap the Trap-PDU tag for an InformRequest-PDU, the layout is the same
+    datagram[datagram.index(bytes((TRAP_V2,)), 2)] = INFORM
+    return bytes(datagram)
+
+
+@pytest.fixture
+def manager():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(0.5)
+    yield sock
+    sock.close()
+
+
+def receive(sock):
+    try:
+        return sock.recvfrom(65535)[0]
+    except socket.timeout:
+        return None
+
+
+def test_inform_acknowledged_after_submit(manager):
+    submitted = []
+    listener = TrapListener(lambda env, environ: submitted.append((env, environ)) or True, {'public': 'env:prod'},
+                            address=('127.0.0.1', 0)).start()
+    datagram = inform('Host CPU usage', 'esx01')
+    try:
+        manager.sendto(datagram, listener.address)
+        response = receive(manager)
+    finally:
+        listener.stop()
+    assert response is not None
+    _, start, end = read_tlv(response, 0)
+    pdu, start, end = read_children(response, start, end)[2]
+    assert pdu == RESPONSE
+    request_id = read_children(response, start, end)[0]
+    assert decode_integer(response, request_id[1], request_id[2]) == decode_trap(datagram)[2]
+    assert [(env, environ['VMWARE_ALARM_TARGET_NAME']) for env, environ in submitted] == [('env:prod', 'esx01')]
+    assert listener.stats['submitted'] == 1
+
+
+def test_rejected_inform_not_acknowledged(manager):
+    listener = TrapListener(lambda env, environ: False, {'public': 'env:prod'}, address=('127.0.0.1', 0)).start()
+    try:
+        manager.sendto(inform('Host CPU usage', 'esx01'), listener.address)
+        response = receive(manager)
+    finally:
+        listener.stop()
+    assert response is None
+    assert listener.stats['rejected'] == 1
+
+
+def test_unknown_community_dropped(manager):
+    submitted = []
+    listener = TrapListener(lambda env, environ: submitted.append(env) or True, {'lab': 'env:lab'},
+                            address=('127.0.0.1', 0)).start()
+    try:
+        manager.sendto(inform('Host CPU usage', 'esx01'), listener.address)
+        response = receive(manager)
+    finally:
+        listener.stop()
+    assert response is None
+    assert submitted == []
+    assert listener.stats['unauthorized'] == 1
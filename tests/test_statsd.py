@@ -0,0 +1,93 @@
+import socket
+import pytest
+from vcenterdd.telemetry import statsd
+from vcenterdd.telemetry.statsd import StatsdTelemetry, NullTelemetry
+
+
+@pytest.fixture
+def agent():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(2.0)
+    yield sock
+    sock.close()
+
+
+@pytest.fixture
+def restore_telemetry():
+    previous = statsd.install(NullTelemetry())
+    yield
+    statsd.install(previous)
+
+
+def receive_lines(sock):
+    data, _ = sock.recvfrom(65535)
+    return data.decode('utf-8').split('\n')
+
+
+def test_flush_sends_aggregate(agent):
+    telemetry = StatsdTelemetry(port=agent.getsockname()[1], tags=['service:test'], flush_interval=0)
+    try:
+        telemetry.increment('dns.hit')
+        telemetry.increment('dns.hit', 2)
+        telemetry.gauge('queue.depth', 7, tags=['queue:alarms'])
+        telemetry.timing('alarm.parse', 0.0015)
+        telemetry.timing('alarm.parse', 0.0025)
+        telemetry.flush()
+        lines = receive_lines(agent)
+    finally:
+        telemetry.stop()
+    assert sorted(lines) == sorted([
+        'vcenterdd.dns.hit:3|c|#service:test',
+        'vcenterdd.queue.depth:7|g|#service:test,queue:alarms',
+        'vcenterdd.alarm.parse:1.5:2.5|ms|#service:test',
+    ])
+
+
+def test_flush_resets_aggregate(agent):
+    telemetry = StatsdTelemetry(port=agent.getsockname()[1], flush_interval=0)
+    try:
+        telemetry.increment('dns.miss')
+        telemetry.flush()
+        assert receive_lines(agent) == ['vcenterdd.dns.miss:1|c']
+        telemetry.increment('dns.miss')
+        telemetry.flush()
+        assert receive_lines(agent) == ['vcenterdd.dns.miss:1|c']
+    finally:
+        telemetry.stop()
+
+
+def test_flush_splits_packets(agent):
+    telemetry = StatsdTelemetry(port=agent.getsockname()[1], flush_interval=0, max_packet=100)
+    try:
+        for n in range(20):
+            telemetry.increment('counter.{}'.format(n))
+        telemetry.flush()
+        lines = []
+        while len(lines) < 20:
+            data, _ = agent.recvfrom(65535)
+            assert len(data) <= 100
+            lines.extend(data.decode('utf-8').split('\n'))
+    finally:
+        telemetry.stop()
+    assert sorted(lines) == sorted('vcenterdd.counter.{}:1|c'.format(n) for n in range(20))
+
+
+@pytest.mark.parametrize('address, expected', [
+    ('statsd.example.com:9125', ('statsd.example.com', 9125)),
+    ('statsd.example.com', ('statsd.example.com', 8125)),
+    (':9125', ('127.0.0.1', 9125)),
+    (None, ('127.0.0.1', 8125)),
+])
+def test_configure_address(restore_telemetry, address, expected):
+    telemetry = statsd.configure(address, flush_interval=0)
+    try:
+        assert telemetry.address == expected
+        assert statsd.telemetry() is telemetry
+    finally:
+        telemetry.stop()
+
+
+def test_configure_rejects_bad_port(restore_telemetry):
+    with pytest.raises(ValueError):
+        statsd.configure('localhost:statsd')
@@ -0,0 +1,50 @@
+import pytest
+from vcenterdd.datadog.encryption import PKCS7Encoder, AESCipher
+from vcenterdd.datadog.vault import CredentialVault
+
+
+@pytest.mark.parametrize('text', ['', 'a', 'x' * 15, 'x' * 16, 'x' * 17, 'abc' + chr(1), 'a' * 14 + chr(2) * 2])
+def test_pkcs7_round_trip(text):
+    encoder = PKCS7Encoder()
+    padded = encoder.encode(text)
+    assert len(padded) % 16 == 0
+    assert encoder.decode(padded) == text
+
+
+def test_pkcs7_bytes_helpers():
+    encoder = PKCS7Encoder(k=8)
+    assert encoder.get_text(encoder.get_bytes('key\x05')) == 'key\x05'
+    assert encoder.get_text(b'\xff') == '\xff'
+    with pytest.raises(Exception):
+        encoder.decode('odd')
+
+
+def test_cipher_round_trip():
+    cipher = AESCipher()
+    encrypted = cipher.encrypt('0123456789abcdef0123456789abcdef')
+    assert b'0123456789abcdef' not in encrypted
+    assert cipher.decrypt(encrypted, key=cipher.AES_KEY) == '0123456789abcdef0123456789abcdef'
+    with pytest.raises(ValueError):
+        cipher.encrypt(b'not a str')
+
+
+def test_vault_headers_decrypted_once(monkeypatch):
+    vault = CredentialVault('api-key-123', app_key='app-key-456')
+    calls = []
+    decrypt = AESCipher.decrypt
+    monkeypatch.setattr(AESCipher, 'decrypt', lambda self, *a, **k: calls.append(1) or decrypt(self, *a, **k))
+    headers = vault.api_headers
+    assert headers == {'DD-API-KEY': 'api-key-123'}
+    assert vault.api_headers is headers
+    assert vault.app_headers == {'DD-API-KEY': 'api-key-123', 'DD-APPLICATION-KEY': 'app-key-456'}
+    assert vault.app_headers is vault.app_headers
+    assert vault.api_key() == 'api-key-123'
+    assert len(calls) == 2
+
+
+def test_vault_masks_keys():
+    vault = CredentialVault('api-key-123')
+    assert not vault.has_app_key
+    assert vault.app_headers == {'DD-API-KEY': 'api-key-123'}
+    assert 'api-key-123' not in repr(vault)
+    assert repr(vault) == '<CredentialVault api_key=*** app_key=None>'
@@ -0,0 +1,60 @@
+"""
+Thin client used by datadog_alarm.py to hand an alarm over to a central aggregator.
+
+Like vcenterdd.daemon.client it is imported before anything else in the alarm script, only the standard library
+modules needed for one HTTP(S) request are imported here.
+"""
+import json
+import http.client
+from urllib.parse import urlsplit
+from vcenterdd.daemon.client import alarm_environ
+
+ALARMS_PATH = '/v1/alarms'
+SOURCE_HEADER = 'X-Vcenterdd-Source'
+
+
+class AggregatorClient(object):
+    """ Posts a single alarm to the aggregator, authenticated as source with its bearer token """
+
+    def __init__(self, url, source, token, timeout=2.0, ssl_context=None):
+        """
+        :param url: base URL of the aggregator, e.g. https://aggregator.example.com:8443
+        :param source: name of this vCenter in the aggregator's sources file
+        :param token: bearer token of the source
+        :param timeout: seconds for connecting and for the response
+        :param ssl_context: ssl.SSLContext for https URLs, defaults to certificate verification
+        """
+        self.url = urlsplit(url)
+        self.source = source
+        self.token = token
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self.status = None
+        self.response = None
+
+    def forward(self, env, environ=None):
+        """
+        Forward the alarm to the aggregator.
+        :param env: the env tag passed in from vCenter
+        :param environ: mapping holding the VMWARE_ALARM_* variables, defaults to os.environ
+        :return: True when the aggregator queued the alarm, False when the caller has to handle it in-process
+        """
+        body = json.dumps({'env': env, 'alarm': alarm_environ(environ)}).encode()
+        headers = {'Content-Type': 'application/json', SOURCE_HEADER: self.source,
+                   'Authorization': 'Bearer {}'.format(self.token)}
+        if self.url.scheme == 'https':
+            conn = http.client.HTTPSConnection(self.url.hostname, self.url.port, timeout=self.timeout,
+                                               context=self.ssl_context)
+        else:
+            conn = http.client.HTTPConnection(self.url.hostname, self.url.port, timeout=self.timeout)
+        try:
+            conn.request('POST', self.url.path.rstrip('/') + ALARMS_PATH, body=body, headers=headers)
+            response = conn.getresponse()
+            self.status = response.status
+            self.response = json.loads(response.read().decode() or '{}')
+        except (OSError, ValueError, http.client.HTTPException):
+            return False
+        finally:
+            conn.close()
+
+        return self.status == 202
@@ -0,0 +1,114 @@
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from vcenterdd.log.setup import addClassLogger
+from .service import QUEUED, UNAUTHORIZED, INVALID, REJECTED
+
+logger = logging.getLogger(__name__)
+
+ALARMS_PATH = '/v1/alarms'
+STATS_PATH = '/v1/stats'
+SOURCE_HEADER = 'X-Vcenterdd-Source'
+MAX_BODY = 1024 * 1024
+
+STATUS_CODES = {QUEUED: 202, UNAUTHORIZED: 401, INVALID: 400, REJECTED: 503}
+
+
+class _AggregatorRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /v1/alarms with a {"env": ..., "alarm": {VMWARE_ALARM_*}} body, the source in the X-Vcenterdd-Source
+    header and its token as a bearer token. GET /v1/stats returns the Aggregator stats to any authenticated source.
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _token(self):
+        auth = self.headers.get('Authorization', '')
+        return auth[7:] if auth.startswith('Bearer ') else None
+
+    def _reply(self, code, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != ALARMS_PATH:
+            return self._reply(404, {'status': 'not found'})
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY:
+            self.close_connection = True
+            return self._reply(413, {'status': 'too large'})
+        try:
+            request = json.loads(self.rfile.read(length).decode())
+            env, environ = request.get('env'), request['alarm']
+            if not isinstance(environ, dict):
+                raise TypeError('alarm must be an object')
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning('Invalid alarm request from %s: %s', self.client_address[0], e)
+            return self._reply(400, {'status': INVALID})
+        status = self.server.aggregator.submit(self.headers.get(SOURCE_HEADER), self._token(), env, environ)
+        headers = {'Retry-After': '1'} if status == REJECTED else None
+        self._reply(STATUS_CODES[status], {'status': status}, headers)
+
+    def do_GET(self):
+        if self.path != STATS_PATH:
+            return self._reply(404, {'status': 'not found'})
+        if self.server.aggregator.sources.authenticate(self.headers.get(SOURCE_HEADER), self._token()) is None:
+            return self._reply(401, {'status': UNAUTHORIZED})
+        self._reply(200, self.server.aggregator.stats())
+
+    def log_message(self, format, *args):
+        logger.debug('%s ' + format, self.client_address[0], *args)
+
+
+@addClassLogger
+class AggregatorServer(object):
+    """ HTTP(S) front end of an Aggregator """
+
+    def __init__(self, aggregator, address=('0.0.0.0', 8443), ssl_context=None):
+        """
+        :param aggregator: vcenterdd.aggregator.service.Aggregator
+        :param address: (host, port) to listen on
+        :param ssl_context: ssl.SSLContext to serve HTTPS, tokens travel in the clear without one
+        """
+        self.aggregator = aggregator
+        self.address = address
+        self.ssl_context = ssl_context
+        self.server = None
+
+    def bind(self):
+        self.server = ThreadingHTTPServer(self.address, _AggregatorRequestHandler)
+        self.server.daemon_threads = True
+        self.server.aggregator = self.aggregator
+        if self.ssl_context is not None:
+            self.server.socket = self.ssl_context.wrap_socket(self.server.socket, server_side=True)
+        self.address = self.server.server_address
+        return self
+
+    def serve_forever(self):
+        if self.server is None:
+            self.bind()
+        self.aggregator.start()
+        self.__log.info('Aggregator listening on %s:%s', *self.address[:2])
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
+
+    def shutdown(self):
+        """ Stop accepting alarms, must be called from a thread other than the one running serve_forever """
+        if self.server is not None:
+            self.server.shutdown()
+
+    def close(self):
+        if self.server is not None:
+            self.server.server_close()
+            self.server = None
+        self.__log.info('Draining shards')
+        self.aggregator.stop()
+        self.__log.info('Aggregator stopped')
@@ -0,0 +1,241 @@
+"""
+Fan-in of alarms from many vCenters into one Datadog connection pool.
+
+Aggregator authenticates alarm submissions per source, shards them across a ShardPool and posts the formatted
+events from the parent process through one Datadog instance per destination (see vcenterdd.datadog.sinks): one
+connection pool, one token bucket and one retry budget per destination for the whole shop. Posts of the same alarm
+(aggregation_key) are chained so they reach each destination in the order the alarm transitioned, unrelated alarms
+are posted concurrently.
+"""
+import time
+import asyncio
+import logging
+import threading
+import collections
+import concurrent.futures
+from vcenterdd.alarm.handle import VcenterAlarm
+from vcenterdd.alarm.record import AlarmRecord
+from vcenterdd.alarm.exceptions import AlarmRecordError
+from vcenterdd.datadog.exceptions import DatadogException
+from vcenterdd.outbox.replay import retryable
+from vcenterdd.telemetry.statsd import telemetry
+from vcenterdd.log.setup import addClassLogger
+from .shards import ShardPool
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+UNAUTHORIZED = 'unauthorized'
+INVALID = 'invalid'
+REJECTED = 'rejected'
+
+
+@addClassLogger
+class Aggregator(object):
+
+    def __init__(self, sinks, sources, shards=4, max_queue=10000, max_pending_per_source=10000,
+                 max_posts_in_flight=1000, shard_options=None):
+        """
+        :param sinks: vcenterdd.datadog.sinks.SinkSet every event is posted to, each sink with its own outbox and
+                      lifecycle index
+        :param sources: vcenterdd.aggregator.sources.SourceRegistry
+        :param shards: number of shard processes
+        :param max_queue: alarms waiting per shard
+        :param max_pending_per_source: alarms of one source accepted but not yet handled by a shard, keeps one
+                                       noisy vCenter from filling every shard
+        :param max_posts_in_flight: formatted events waiting to be posted per sink. Beyond that a sink with an
+                                    outbox spools new events, a sink without one slows the shards down
+        :param shard_options: see ShardPool
+        """
+        self.sinks = sinks
+        self.sources = sources
+        self.max_pending_per_source = max_pending_per_source
+        self.pool = ShardPool(shards, max_queue=max_queue, options=shard_options)
+        self.counts = collections.defaultdict(collections.Counter)
+        self.shard_counts = [collections.Counter() for _ in range(shards)]
+        self.sink_counts = dict((name, collections.Counter()) for name in sinks.names)
+        self._lock = threading.Lock()
+        self._posts = dict((name, threading.BoundedSemaphore(max_posts_in_flight)) for name in sinks.names)
+        self._inflight = set()
+        self._tails = {}
+        self._reader = None
+
+    def start(self):
+        self.pool.start()
+        self._reader = threading.Thread(target=self._read_results, name='aggregator-results', daemon=True)
+        self._reader.start()
+        for shard in range(self.pool.shards):
+            telemetry().register_gauge('queue.depth', lambda s=shard: self.pool.depths()[s],
+                                       tags=('queue:shard', 'shard:{}'.format(shard)))
+        for name in self.sources.sources:
+            telemetry().register_gauge('queue.depth', lambda n=name: self.depth(n),
+                                       tags=('queue:source', 'source:{}'.format(name)))
+
+    def submit(self, source_name, token, env, environ):
+        """
+        Authenticate and queue an alarm, called from the front end threads
+        :param source_name: source sent by the client
+        :param token: bearer token sent by the client
+        :param env: env tag sent by the client, replaced by the source's env when it has one
+        :param environ: dict of the VMWARE_ALARM_* variables
+        :return: QUEUED, UNAUTHORIZED, INVALID or REJECTED
+        """
+        source = self.sources.authenticate(source_name, token)
+        if source is None:
+            telemetry().increment('aggregator.unauthorized')
+            self.__log.warning('Rejecting alarm from unauthenticated source %s', source_name)
+            return UNAUTHORIZED
+        try:
+            record = AlarmRecord.from_env(environ)
+            env = source.env or env
+            key = VcenterAlarm(env=env, record=record).alarm_key_hash
+        except (AlarmRecordError, AttributeError, TypeError) as e:
+            self.__log.warning('Invalid alarm from %s: %s', source.name, e)
+            self._count(source.name, 'invalid')
+            return INVALID
+
+        with self._lock:
+            counts = self.counts[source.name]
+            if counts['submitted'] - counts['processed'] >= self.max_pending_per_source:
+                counts['rejected'] += 1
+                return REJECTED
+            counts['submitted'] += 1
+        shard = self.pool.submit(key, (source.name, env, record.to_bytes()))
+        if shard is None:
+            with self._lock:
+                counts['submitted'] -= 1
+                counts['rejected'] += 1
+            self.__log.warning('Shard queue full, rejecting alarm from %s', source.name)
+            return REJECTED
+        telemetry().increment('aggregator.received', tags=('source:{}'.format(source.name),))
+        return QUEUED
+
+    def _count(self, source_name, counter, value=1):
+        with self._lock:
+            self.counts[source_name][counter] += value
+
+    def depth(self, source_name):
+        """ :return: alarms of a source accepted but not yet handled by a shard """
+        with self._lock:
+            counts = self.counts[source_name]
+            return counts['submitted'] - counts['processed']
+
+    def _read_results(self):
+        stopped = 0
+        while stopped < self.pool.shards:
+            shard, source_name, events = self.pool.results.get()
+            if events is None:
+                stopped += 1
+                continue
+            if source_name is not None:
+                self._count(source_name, 'processed')
+            with self._lock:
+                self.shard_counts[shard]['processed'] += 1
+                self.shard_counts[shard]['events'] += len(events)
+            for datadog_format in events:
+                for sink in self.sinks.sinks:
+                    self._submit(sink, source_name, datadog_format)
+
+    def _submit(self, sink, source_name, datadog_format):
+        posts = self._posts[sink.name]
+        if not posts.acquire(blocking=sink.outbox is None):
+            # this sink is too far behind, keep its copy on disk so the other sinks and the shards carry on
+            self._spool(sink, dict(datadog_format))
+            self._outcome(sink, source_name, 'spooled')
+            return
+        # without an outbox acquire() blocks once too many posts are outstanding, the shards then block on the
+        # results queue
+        future = sink.datadog.sender.submit(self._post(sink, source_name, dict(datadog_format)))
+        with self._lock:
+            self._inflight.add(future)
+        future.add_done_callback(lambda f: self._posted(posts, f))
+
+    def _posted(self, posts, future):
+        with self._lock:
+            self._inflight.discard(future)
+        posts.release()
+
+    async def _post(self, sink, source_name, datadog_format):
+        # chain the posts of one alarm, tasks start in submission order so the chain follows the shard's order
+        key = (sink.name, datadog_format.get('aggregation_key'))
+        previous = self._tails.get(key)
+        current = asyncio.current_task()
+        self._tails[key] = current
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            self._outcome(sink, source_name, await self._post_or_spool(sink, datadog_format))
+        finally:
+            if self._tails.get(key) is current:
+                del self._tails[key]
+
+    def _outcome(self, sink, source_name, outcome):
+        telemetry().increment('aggregator.events', tags=('outcome:{}'.format(outcome), 'sink:{}'.format(sink.name)))
+        with self._lock:
+            self.sink_counts[sink.name][outcome] += 1
+        # per source outcomes are those of the primary destination
+        if source_name is not None and sink is self.sinks.primary:
+            self._count(source_name, outcome)
+
+    async def _post_or_spool(self, sink, datadog_format):
+        """ Same as vcenterdd.outbox.replay.post_or_spool, on the sink's sender loop """
+        loop = asyncio.get_running_loop()
+        if sink.lifecycle is not None:
+            await loop.run_in_executor(None, sink.lifecycle.link, datadog_format)
+        event_id = None
+        if sink.outbox is not None and await loop.run_in_executor(None, sink.outbox.pending):
+            # keep the order behind events already waiting in the outbox
+            await loop.run_in_executor(None, self._spool, sink, datadog_format)
+            outcome = 'spooled'
+        else:
+            try:
+                response = await sink.datadog.post_event_async(**datadog_format)
+                event_id = sink.datadog.event_id(response)
+                outcome = 'posted'
+            except (Exception, DatadogException) as e:
+                if sink.outbox is None or not retryable(e):
+                    # a refused event (400, 403) would fail the same way on replay and block the outbox
+                    self.__log.error('Unable to post event %s to %s: %s', datadog_format.get('title'), sink.name, e)
+                    return 'failed'
+                self.__log.warning('Unable to post event to %s, spooling to outbox %s: %s', sink.name,
+                                   sink.outbox.path, e)
+                await loop.run_in_executor(None, self._spool, sink, datadog_format)
+                outcome = 'spooled'
+        if sink.lifecycle is not None:
+            await loop.run_in_executor(None, sink.lifecycle.record, datadog_format, event_id)
+        return outcome
+
+    @staticmethod
+    def _spool(sink, datadog_format):
+        from vcenterdd.outbox.spool import encode_event
+
+        sink.outbox.append(encode_event(datadog_format))
+
+    def stats(self):
+        """ :return: dict with per source and per shard counts and queue depths """
+        depths = self.pool.depths()
+        with self._lock:
+            sources = dict((name, dict(counts, depth=counts['submitted'] - counts['processed']))
+                           for name, counts in self.counts.items())
+            shards = [dict(counts, depth=depths[i]) for i, counts in enumerate(self.shard_counts)]
+            sinks = dict((name, dict(counts)) for name, counts in self.sink_counts.items())
+            posting = len(self._inflight)
+        return {'sources': sources, 'shards': shards, 'sinks': sinks, 'posts_in_flight': posting}
+
+    def stop(self, timeout=30.0):
+        """
+        Flush the shards and wait for the outstanding posts
+        :param timeout: seconds to wait for the shards and for the posts
+        """
+        self.pool.stop()
+        if self._reader is not None:
+            self._reader.join(timeout)
+            self._reader = None
+        self.pool.join(timeout)
+        with self._lock:
+            inflight = list(self._inflight)
+        started = time.monotonic()
+        done, pending = concurrent.futures.wait(inflight, timeout=timeout)
+        if pending:
+            self.__log.warning('%s posts still pending after %.1fs', len(pending),
+                               time.monotonic() - started)
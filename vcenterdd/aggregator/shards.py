@@ -0,0 +1,147 @@
+"""
+Worker processes of the aggregator.
+
+Alarms are sharded on VcenterAlarm.alarm_key_hash, every shard is a process with its own inbox queue so the
+transitions of one alarm are always handled by the same process, in order, while unrelated alarms are formatted in
+parallel on all cores. A shard builds the alarm, coalesces flaps (a shard sees every transition of its alarms),
+resolves the target through the shared DNS cache and returns the formatted events to the parent process, which
+does all the posting.
+
+Alarms travel to the shards in the compact AlarmRecord binary encoding.
+"""
+import queue
+import signal
+import logging
+import multiprocessing
+from vcenterdd.alarm.handle import VcenterAlarm
+from vcenterdd.alarm.record import AlarmRecord
+from vcenterdd.alarm.coalesce import FlapCoalescer
+from vcenterdd.alarm.rules import RuleSet
+from vcenterdd.daemon.pipeline import format_alarm
+from vcenterdd.log.setup import addClassLogger
+
+logger = logging.getLogger(__name__)
+
+def shard_for(alarm_key_hash, shards):
+    """ :return: index of the shard handling an alarm key """
+    return int(alarm_key_hash[:8], 16) % shards
+
+
+def _format_ready(ready):
+    events = []
+    for alarm, timeline in ready:
+        try:
+            events.append(format_alarm(alarm, timeline))
+        except BaseException as e:
+            logger.exception('Exception: %s \n Args: %s', e, e.args)
+    return events
+
+
+def _shard_worker(shard, inbox, results, options):
+    """
+    Main loop of a shard process. Every inbox item is answered with one (shard, source, events) result so the
+    parent can keep per source counts, events released later by the coalescer are sent with source None. The last
+    result of a shard is (shard, None, None).
+    """
+    # the parent handles SIGINT/SIGTERM and stops the shards through their inbox after draining the front end
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # shards log to stderr, the parent's rotating file handlers must not be shared between processes
+    logging.basicConfig(level=options.get('log_level', 'INFO'),
+                        format='%(asctime)s shard-{} %(name)s %(levelname)s %(message)s'.format(shard))
+    resolver = None
+    if options.get('dns_cache'):
+        from vcenterdd.alarm.dnscache import DnsCache
+
+        resolver = DnsCache(options['dns_cache'], negative_ttl=options.get('dns_negative_ttl', 900),
+                            timeout=options.get('dns_timeout', 1.0))
+    coalescer = FlapCoalescer(window=options.get('flap_window', 0))
+    rules = RuleSet(options['rules']) if options.get('rules') else None
+    try:
+        while True:
+            try:
+                item = inbox.get(timeout=coalescer.next_due())
+            except queue.Empty:
+                results.put((shard, None, _format_ready(coalescer.due())))
+                continue
+            if item is None:
+                results.put((shard, None, _format_ready(coalescer.flush())))
+                return
+            source, env, data = item
+            try:
+                alarm = VcenterAlarm(env=env, record=AlarmRecord.from_bytes(data), resolver=resolver)
+                decision = rules.apply(alarm) if rules is not None else None
+                if rules is not None and (decision is None or 'events' not in decision.destinations):
+                    events = []
+                else:
+                    events = _format_ready(coalescer.add(alarm))
+            except BaseException as e:
+                logger.exception('Exception: %s \n Args: %s', e, e.args)
+                events = []
+            results.put((shard, source, events))
+    finally:
+        if resolver is not None:
+            resolver.close()
+        results.put((shard, None, None))
+
+
+@addClassLogger
+class ShardPool(object):
+    """ A fixed number of shard processes, each fed through its own bounded inbox """
+
+    def __init__(self, shards, max_queue=10000, options=None):
+        """
+        :param shards: number of worker processes
+        :param max_queue: alarms waiting per shard before submit() rejects new ones
+        :param options: dict passed to the shard processes: dns_cache, dns_timeout, dns_negative_ttl,
+                        flap_window, log_level, rules (config dict of a RuleSet)
+        """
+        # spawn, the parent runs threads (HTTP server, sender loop) that must not be forked
+        self._ctx = multiprocessing.get_context('spawn')
+        self.shards = shards
+        self.options = options or {}
+        self.inboxes = [self._ctx.Queue(maxsize=max_queue) for _ in range(shards)]
+        self.results = self._ctx.Queue(maxsize=shards * 1000)
+        self.processes = []
+
+    def start(self):
+        for shard, inbox in enumerate(self.inboxes):
+            process = self._ctx.Process(target=_shard_worker, name='alarm-shard-{}'.format(shard),
+                                        args=(shard, inbox, self.results, self.options), daemon=True)
+            process.start()
+            self.processes.append(process)
+        self.__log.info('Started %s shard processes', self.shards)
+
+    def submit(self, alarm_key_hash, item):
+        """
+        :param alarm_key_hash: key the alarm is sharded on
+        :param item: (source, env, AlarmRecord bytes)
+        :return: shard index, or None when the shard's inbox is full
+        """
+        shard = shard_for(alarm_key_hash, self.shards)
+        try:
+            self.inboxes[shard].put_nowait(item)
+            return shard
+        except queue.Full:
+            return None
+
+    def depths(self):
+        """ :return: list of alarms waiting per shard """
+        depths = []
+        for inbox in self.inboxes:
+            try:
+                depths.append(inbox.qsize())
+            except NotImplementedError:
+                # macOS has no sem_getvalue
+                depths.append(None)
+        return depths
+
+    def stop(self):
+        """ Ask every shard to flush and exit once its inbox is drained """
+        for inbox in self.inboxes:
+            inbox.put(None)
+
+    def join(self, timeout=None):
+        for process in self.processes:
+            process.join(timeout)
+        self.processes = []
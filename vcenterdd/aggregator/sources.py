@@ -0,0 +1,74 @@
+"""
+Alarm sources (vCenter appliances) allowed to submit to the aggregator.
+
+Every source has a name and a bearer token, only the SHA-256 of the token is kept in the sources file:
+
+    {
+        "vc01": {"token_sha256": "9f86d08...", "env": "env:prod"},
+        "vc02": {"token_sha256": "60303ae..."}
+    }
+
+When a source has an env it overrides the env tag sent with its alarms. Hash a new token with:
+
+    python -m vcenterdd.aggregator.sources hash-token
+"""
+import sys
+import hmac
+import getpass
+import hashlib
+import argparse
+
+
+def hash_token(token):
+    """ :return: hex SHA-256 of a token """
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+class Source(object):
+    __slots__ = ('name', 'token_sha256', 'env')
+
+    def __init__(self, name, token_sha256, env=None):
+        self.name = name
+        self.token_sha256 = token_sha256
+        self.env = env
+
+    def __repr__(self):
+        return '<Source {}>'.format(self.name)
+
+
+class SourceRegistry(object):
+
+    def __init__(self, sources):
+        """
+        :param sources: dict of source name to {'token_sha256': ..., 'env': ...}
+        """
+        self.sources = dict((name, Source(name, conf['token_sha256'], conf.get('env')))
+                            for name, conf in sources.items())
+
+    def authenticate(self, name, token):
+        """
+        :param name: source name sent by the client
+        :param token: bearer token sent by the client
+        :return: Source or None when the source is unknown or the token does not match
+        """
+        source = self.sources.get(name)
+        if source is None or token is None:
+            return None
+        if not hmac.compare_digest(hash_token(token), source.token_sha256):
+            return None
+        return source
+
+    def __len__(self):
+        return len(self.sources)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Aggregator source tokens")
+    parser.add_argument('command', choices=['hash-token'])
+    parser.parse_args(argv)
+    print(hash_token(getpass.getpass('Token: ')))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
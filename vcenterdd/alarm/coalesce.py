@@ -0,0 +1,128 @@
+import time
+import logging
+import collections
+from vcenterdd.log.setup import addClassLogger
+
+logger = logging.getLogger(__name__)
+
+
+class _FlapWindow(object):
+    __slots__ = ('opened', 'first', 'last', 'transitions')
+
+    def __init__(self, opened, alarm):
+        self.opened = opened
+        # only the (date_time, oldstatus, newstatus) of a transition is kept, the last alarm is the one released
+        self.first = _transition(alarm)
+        self.last = None
+        self.transitions = []
+
+
+def _transition(alarm):
+    return alarm.date_time, getattr(alarm, 'oldstatus', None), getattr(alarm, 'newstatus', None)
+
+
+@addClassLogger
+class FlapCoalescer(object):
+    """
+    Coalesces repeated transitions of the same alarm (keyed on VcenterAlarm.alarm_key_hash).
+
+    The first transition of an alarm is released right away and opens a hold-down window. Every further transition
+    of that alarm inside the window is held back, when the window closes they are released as a single alarm
+    carrying the final state and the timeline of the held transitions. A Gray->Yellow->Red->Yellow flap therefore
+    results in two events instead of four.
+
+    Windows are kept in an OrderedDict bounded by max_keys, when it is full the oldest window is closed early.
+    """
+
+    def __init__(self, window=30.0, max_keys=10000, clock=time.monotonic):
+        """
+        :param window: hold-down window in seconds, 0 disables coalescing
+        :param max_keys: maximum number of open windows
+        :param clock: monotonic clock, replaceable for testing
+        """
+        self.window = window
+        self.max_keys = max_keys
+        self.clock = clock
+        self.windows = collections.OrderedDict()
+        self.coalesced = 0
+        self.evicted = 0
+
+    def add(self, alarm):
+        """
+        Add an alarm transition
+        :param alarm: VcenterAlarm
+        :return: list of (alarm, timeline) ready to be sent, timeline is None for a single transition
+        """
+        if not self.window:
+            return [(alarm, None)]
+
+        now = self.clock()
+        ready = self.due(now)
+        key = alarm.alarm_key_hash
+        flap = self.windows.get(key)
+        if flap is None:
+            while len(self.windows) >= self.max_keys:
+                self.evicted += 1
+                ready.extend(self._close(self.windows.popitem(last=False)[1]))
+            self.windows[key] = _FlapWindow(now, alarm)
+            ready.append((alarm, None))
+        else:
+            if not flap.transitions:
+                flap.transitions.append(flap.first)
+            flap.transitions.append(_transition(alarm))
+            flap.last = alarm
+            self.coalesced += 1
+        return ready
+
+    def due(self, now=None):
+        """
+        Close the windows that expired
+        :return: list of (alarm, timeline) ready to be sent
+        """
+        now = self.clock() if now is None else now
+        ready = []
+        # windows are in insertion order, which is the order they were opened in
+        while self.windows:
+            key, flap = next(iter(self.windows.items()))
+            if now - flap.opened < self.window:
+                break
+            del self.windows[key]
+            ready.extend(self._close(flap))
+        return ready
+
+    def next_due(self):
+        """ :return: seconds until the oldest window closes, None if no window is open """
+        if not self.windows:
+            return None
+        flap = next(iter(self.windows.values()))
+        return max(0.0, self.window - (self.clock() - flap.opened))
+
+    def flush(self):
+        """ Close every window, used at shutdown """
+        ready = []
+        while self.windows:
+            ready.extend(self._close(self.windows.popitem(last=False)[1]))
+        return ready
+
+    def _close(self, flap):
+        if flap.last is None:
+            return []
+        timeline = flap.transitions
+        self.__log.info('Coalesced %s transitions of %s', len(timeline), flap.last.alarm_key_hash)
+        return [(flap.last, timeline)]
+
+
+def format_timeline(timeline, max_entries=50):
+    """
+    Render a coalesced timeline for the event text
+    :param timeline: list of (datetime, oldstatus, newstatus)
+    :param max_entries: only the most recent entries are listed
+    :return: str
+    """
+    lines = ['Coalesced {} transitions between {:%H:%M:%S} and {:%H:%M:%S}:'.format(
+        len(timeline), timeline[0][0], timeline[-1][0])]
+    if len(timeline) > max_entries:
+        lines.append('  ... {} earlier transitions'.format(len(timeline) - max_entries))
+    for date_time, oldstatus, newstatus in timeline[-max_entries:]:
+        lines.append('  {:%H:%M:%S} {} -> {}'.format(date_time, oldstatus, newstatus))
+    return '\n'.join(lines)
@@ -0,0 +1,196 @@
+"""
+Persistent DNS cache for VcenterAlarm._get_fqdn.
+
+Lookups are cached in a small SQLite file shared by every alarm run (and the daemon). Positive answers are cached
+for the TTL of the DNS answer, NXDOMAIN, empty answers and timeouts are cached for a configurable negative TTL so
+names like datastores that never resolve do not cost a round trip per alarm. Other failures (a malformed name, an
+unreachable resolver) are not cached.
+
+Prewarm the cache with the inventory names:
+
+    python -m vcenterdd.alarm.dnscache --cache vcenterdd/.dnscache.sqlite prewarm names.txt
+"""
+import os
+import sys
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from vcenterdd.log.setup import addClassLogger
+from vcenterdd.telemetry.statsd import telemetry
+
+logger = logging.getLogger(__name__)
+
+
+@addClassLogger
+class DnsCache(object):
+
+    def __init__(self, path, negative_ttl=900, timeout=1.0, min_ttl=60, max_ttl=86400, dns_resolver=None):
+        """
+        :param path: SQLite file of the cache
+        :param negative_ttl: seconds to cache NXDOMAIN, empty answers and timeouts
+        :param timeout: total time budget in seconds for a single DNS query
+        :param min_ttl: lower bound applied to the TTL of positive answers
+        :param max_ttl: upper bound applied to the TTL of positive answers
+        :param dns_resolver: dns.resolver.Resolver to use instead of one configured from /etc/resolv.conf
+        """
+        self.path = path
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._resolver = dns_resolver
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False,
+                                       isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS dns_cache ('
+                             'name TEXT PRIMARY KEY, fqdn TEXT, expires REAL NOT NULL)')
+        return self._db
+
+    @property
+    def resolver(self):
+        if self._resolver is None:
+            import dns.resolver
+
+            self._resolver = dns.resolver.Resolver()
+            self._resolver.lifetime = self.timeout
+            self._resolver.timeout = self.timeout
+        return self._resolver
+
+    def lookup(self, name):
+        """
+        Resolve name to its canonical name, served from the cache when possible
+        :param name: name to resolve
+        :return: fqdn or None when the name does not resolve
+        """
+        try:
+            with self._lock:
+                row = self.db.execute('SELECT fqdn, expires FROM dns_cache WHERE name = ?', (name,)).fetchone()
+        except sqlite3.Error as e:
+            self.__log.warning('DNS cache unavailable: %s', e)
+            row = None
+
+        if row and row[1] > time.time():
+            self.hits += 1
+            telemetry().increment('dns.hit')
+            return row[0]
+
+        self.misses += 1
+        telemetry().increment('dns.miss')
+        fqdn, ttl = self.resolve(name)
+        if ttl is not None:
+            self.store([(name, fqdn, ttl)])
+        return fqdn
+
+    def resolve(self, name):
+        """
+        Query DNS without touching the cache
+        :return: (fqdn or None, seconds to cache the result), the seconds are None for an unexpected failure that
+                 is not cached
+        """
+        import dns.exception
+        import dns.resolver
+
+        try:
+            if hasattr(self.resolver, 'resolve'):
+                answer = self.resolver.resolve(name, search=True)
+            else:
+                # dnspython < 2.0
+                answer = self.resolver.query(name)
+            ttl = min(max(answer.rrset.ttl, self.min_ttl), self.max_ttl)
+            return answer.canonical_name.__str__().strip('.'), ttl
+        except dns.resolver.NXDOMAIN as e:
+            telemetry().increment('dns.nxdomain')
+            self.__log.warning('Unable to locate a DNS record for %s.\nException: %s \n Args: %s',
+                               name, e, e.args)
+        except (dns.resolver.NoAnswer, dns.resolver.NoNameservers, dns.exception.Timeout) as e:
+            telemetry().increment('dns.failure')
+            self.__log.warning('DNS lookup for %s failed: %s', name, e)
+        except (dns.exception.DNSException, OSError) as e:
+            # e.g. a malformed name or a resolver that can't be reached, the next alarm asks again
+            telemetry().increment('dns.failure')
+            self.__log.warning('DNS lookup for %s failed: %s', name, e)
+            return None, None
+        return None, self.negative_ttl
+
+    def store(self, results):
+        """
+        :param results: iterable of (name, fqdn, ttl)
+        :return: None
+        """
+        now = time.time()
+        try:
+            with self._lock:
+                self.db.executemany('INSERT OR REPLACE INTO dns_cache (name, fqdn, expires) VALUES (?, ?, ?)',
+                                    [(name, fqdn, now + ttl) for name, fqdn, ttl in results])
+        except sqlite3.Error as e:
+            self.__log.warning('Unable to update DNS cache: %s', e)
+
+    def prewarm(self, names, workers=32):
+        """
+        Resolve names concurrently and store the results
+        :param names: iterable of names
+        :param workers: number of concurrent queries
+        :return: (resolved, unresolved) counts
+        """
+        names = sorted(set(n.strip() for n in names if n.strip()))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = [(name, fqdn, ttl) for name, (fqdn, ttl) in zip(names, pool.map(self.resolve, names))]
+        self.store([result for result in results if result[2] is not None])
+        resolved = sum(1 for r in results if r[1])
+        return resolved, len(results) - resolved
+
+    def purge(self):
+        """ Remove expired entries """
+        with self._lock:
+            self.db.execute('DELETE FROM dns_cache WHERE expires <= ?', (time.time(),))
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the alarm DNS cache")
+    parser.add_argument('--cache', required=True, action='store', help='SQLite file of the cache')
+    parser.add_argument('--timeout', required=False, action='store', type=float, default=1.0,
+                        help='Time budget in seconds per query')
+    parser.add_argument('--negative-ttl', required=False, action='store', type=int, default=900,
+                        help='Seconds to cache names that do not resolve')
+    sub = parser.add_subparsers(dest='command')
+    prewarm = sub.add_parser('prewarm', help='Resolve a list of inventory names, one per line ("-" for stdin)')
+    prewarm.add_argument('names', action='store')
+    prewarm.add_argument('--workers', required=False, action='store', type=int, default=32)
+    sub.add_parser('purge', help='Remove expired entries')
+    args = parser.parse_args(argv)
+
+    cache = DnsCache(args.cache, negative_ttl=args.negative_ttl, timeout=args.timeout)
+    try:
+        if args.command == 'prewarm':
+            stream = sys.stdin if args.names == '-' else open(args.names, 'rt')
+            with stream:
+                resolved, unresolved = cache.prewarm(stream, workers=args.workers)
+            print('resolved: {} unresolved: {}'.format(resolved, unresolved))
+        elif args.command == 'purge':
+            cache.purge()
+        else:
+            parser.print_help()
+    finally:
+        cache.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+class AlarmException(BaseException):
+    pass
+
+
+class AlarmRecordError(AlarmException):
+    pass
+
+
+class RuleError(AlarmException):
+    pass
@@ -4,9 +4,10 @@ import os
 import datetime
 import hashlib
 import argparse
-import dns.resolver
-from dns.resolver import NXDOMAIN
 from vcenterdd.log.setup import addClassLogger
+from vcenterdd.telemetry.statsd import telemetry
+from .record import AlarmRecord, FIELDS
+from .rules import DEFAULT_DECISION, TITLE_LIMIT, TEXT_LIMIT, truncate
 
 logger = logging.getLogger(__name__)
 
@@ -15,9 +16,9 @@ logger = logging.getLogger(__name__)
 class VcenterAlarm(object):
     """
     This object is an object mapping of the alarm environment variables when a vCenter alarm is executing a script.
-    This object is a dynamically created object in which it will read in the environment variables and
-    dynamically create the attributes/properties of this object. This is due to the nature of what environment
-    variables are presented from one alarm to the other. Each alarm may have varying data accompanying the alarm.
+    The variables are read into an AlarmRecord (vcenterdd.alarm.record) with a fixed set of fields, each field is
+    available as a read only attribute of the same name. Variables outside that schema vary from one alarm to the
+    other, they are kept in the record's extra dict and are still reachable as attributes (e.g. alarm.event_username).
     VMWARE_ALARM_ID = alarm-7
     VMWARE_ALARM_DECLARINGSUMMARY = ([Yellow metric Is above 61%; Red metric Is above 85%])
     VMWARE_ALARM_ALARMVALUE = Current values for metric/state
@@ -28,28 +29,53 @@ class VcenterAlarm(object):
     VMWARE_ALARM_NEWSTATUS = Yellow
     VMWARE_ALARM_NAME = alarm.DatastoreDiskUsageAlarm
     VMWARE_ALARM_OLDSTATUS = Gray
+
+    When the alarm is not read from this process' environment (e.g. handed over by the forwarder daemon), the
+    VMWARE_ALARM_* mapping can be passed in with the environ parameter, or an already parsed AlarmRecord with the
+    record parameter instead. DNS lookups of the target go through resolver (a vcenterdd.alarm.dnscache.DnsCache)
+    when one is given. The tags, title and text templates of the event come from decision, set by
+    vcenterdd.alarm.rules.RuleSet.apply(), or the built-in defaults.
     """
+    __slots__ = ('env', 'record', 'resolver', 'name', 'summary', 'datadog_format', 'alert_type', 'alarm_key_hash',
+                 'date_time', 'decision')
 
-    def __init__(self, env):
+    def __init__(self, env, environ=None, resolver=None, record=None):
         self.env = env
+        self.resolver = resolver
         self.name = None
+        self.summary = None
+        self.decision = None
         self.datadog_format = {}
         self.alert_type = None
         self.alarm_key_hash = None
-        self.date_time = datetime.datetime.now()
-        self.__init_object()
+        with telemetry().timer('alarm.parse'):
+            self.record = record if record is not None else AlarmRecord.from_env(
+                environ if environ is not None else os.environ)
+            self.date_time = datetime.datetime.fromtimestamp(self.record.time)
+            self.__init_object()
+
+    @property
+    def prefix(self):
+        return "[Resolved]" if self.newstatus.lower() == "green" else "[Triggered]"
+
+    @property
+    def environ(self):
+        """ :return: dict of the VMWARE_ALARM_* variables of the alarm """
+        return self.record.to_env()
+
+    def __getattr__(self, name):
+        # only reached for names that are neither slots nor record fields: variables outside the record schema
+        value = self.record.get_extra(name) if name != 'record' else None
+        if value is None:
+            raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+        return value
 
     def __init_object(self):
-        for k, v in os.environ.items():
-            if k.startswith('VMWARE_ALARM'):
-                if k == 'VMWARE_ALARM_NAME':
-                    setattr(self, 'alarm_name', v)
-                else:
-                    setattr(self, k.lower().replace('vmware_alarm_', ''), v)
-        self.name = self.eventdescription.replace(" changed from {} to {}".format(self.oldstatus, self.newstatus), '')
-        _hash = hashlib.sha1("{},{},{}".format(self.name, self.target_name, self.target_id).encode())
+        self.summary = self.eventdescription.replace(
+            " changed from {} to {}".format(self.oldstatus, self.newstatus), '')
+        _hash = hashlib.sha1("{},{},{}".format(self.summary, self.target_name, self.target_id).encode())
         self.alarm_key_hash = _hash.hexdigest()
-        self.name = "{} {} [EventID: {}]".format("[Triggered]", self.name, self.alarm_key_hash)
+        self.name = "{} {} [EventID: {}]".format(self.prefix, self.summary, self.alarm_key_hash)
 
         if self.newstatus.lower() == 'yellow':
             self.alert_type = "warning"
@@ -86,28 +112,68 @@ class VcenterAlarm(object):
             device_name [optional, default=None]: A list of device names to post the event with.
         :return: None
         """
+        with telemetry().timer('alarm.format'):
+            self.__format_datadog_event()
 
-        self.datadog_format.update({
-            'title': self.name,
-            'text': "{}\n{}\n{}".format(self.eventdescription, self.triggeringsummary, self.declaringsummary),
+    def template_fields(self):
+        """ :return: dict of the values available to the title, text and tag templates of the rules """
+        fields = dict((f, getattr(self.record, f) or '') for f in FIELDS)
+        fields.update({'name': self.name, 'summary': self.summary, 'prefix': self.prefix,
+                       'alarm_key_hash': self.alarm_key_hash, 'env': self.env or ''})
+        return fields
+
+    def event_fields(self, host):
+        """
+        Datadog event of the alarm without a DNS lookup, see format_datadog_event
+        :param host: value of the host field
+        :return: dict
+        """
+        decision = self.decision or DEFAULT_DECISION
+        fields = self.template_fields()
+        tags = [t for t in (tag.format_map(fields) for tag in decision.tags) if t]
+        return {
+            'title': truncate(decision.title.format_map(fields), TITLE_LIMIT),
+            'text': truncate(decision.text.format_map(fields), TEXT_LIMIT),
             'date_happened': self.date_time,
-            'priority': 'normal',
-            'host': self._get_fqdn(self.target_name),
-            'tags': [self.env, "app:vsphere", "team:cig", "inf.vsphere.{}".format(self.alarm_name)],
-            'alert_type': self.alert_type,
+            'priority': decision.priority,
+            'host': host,
+            'tags': tags,
+            'alert_type': decision.alert_type or self.alert_type,
             'aggregation_key': self.alarm_key_hash,
             'source_type_name': 'Vsphere',
             'device_name': self.target_name
-        })
+        }
+
+    def __format_datadog_event(self):
+        self.datadog_format.update(self.event_fields(self._get_fqdn(self.target_name)))
 
     def _get_fqdn(self, name):
+        with telemetry().timer('alarm.dns'):
+            return self.__get_fqdn(name)
+
+    def __get_fqdn(self, name):
+        if self.resolver is not None:
+            return self.resolver.lookup(name)
+
+        import dns.resolver
+        from dns.resolver import NXDOMAIN
+
         fqdn = None
         try:
             dns_qry = dns.resolver.query(name)
             fqdn = dns_qry.canonical_name.__str__().strip('.')
 
         except NXDOMAIN as e:
+            telemetry().increment('dns.nxdomain')
             self.__log.warning(
-                'Unable to locate a DNS record for {}.\nException: {} \n Args: {}'.format(name, e, e.args))
+                'Unable to locate a DNS record for %s.\nException: %s \n Args: %s', name, e, e.args)
 
         return fqdn
+
+
+def _record_field(name):
+    return property(lambda self: getattr(self.record, name), doc='{} of the alarm record'.format(name))
+
+
+for _field in FIELDS:
+    setattr(VcenterAlarm, _field, _record_field(_field))
@@ -0,0 +1,152 @@
+"""
+Local lifecycle index of alarms, used to thread Datadog events together without searching the event stream.
+
+Every alarm (keyed on VcenterAlarm.alarm_key_hash, which is the event's aggregation_key) has one row holding the
+Datadog event id of the transition that opened the current incident, the latest status and the first and last
+time it was seen. Escalations and the [Resolved] event of an incident are posted with related_event_id pointing at
+that parent event. A resolution closes the incident, the next trigger opens a new one.
+
+The index is a SQLite file in WAL mode shared by every alarm run (and the daemon): lookups are primary key reads,
+updates are single atomic upserts so concurrent script invocations can't lose the parent of an incident, and rows
+not seen for ttl seconds are pruned.
+"""
+import os
+import time
+import random
+import sqlite3
+import logging
+import threading
+from vcenterdd.log.setup import addClassLogger
+
+logger = logging.getLogger(__name__)
+
+# VcenterAlarm posts Green transitions with this alert_type
+RESOLVED_ALERT_TYPE = 'success'
+
+_UPSERT = (
+    'INSERT INTO alarm_lifecycle (key, event_id, status, first_seen, last_seen) '
+    'VALUES (:key, :event_id, :status, :when, :when) '
+    'ON CONFLICT(key) DO UPDATE SET '
+    # a trigger after a resolution, or after the row expired, opens a new incident, otherwise the parent event of
+    # the incident is kept
+    'event_id = CASE WHEN (alarm_lifecycle.status = :resolved AND excluded.status != :resolved) '
+    '                     OR alarm_lifecycle.last_seen < :expired THEN excluded.event_id '
+    '                ELSE coalesce(alarm_lifecycle.event_id, excluded.event_id) END, '
+    'first_seen = CASE WHEN (alarm_lifecycle.status = :resolved AND excluded.status != :resolved) '
+    '                       OR alarm_lifecycle.last_seen < :expired THEN excluded.first_seen '
+    '                  ELSE alarm_lifecycle.first_seen END, '
+    'status = excluded.status, last_seen = excluded.last_seen'
+)
+
+
+class LifecycleEntry(object):
+    __slots__ = ('key', 'event_id', 'status', 'first_seen', 'last_seen')
+
+    def __init__(self, key, event_id, status, first_seen, last_seen):
+        self.key = key
+        self.event_id = event_id
+        self.status = status
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+
+    @property
+    def is_open(self):
+        return self.status != RESOLVED_ALERT_TYPE
+
+
+@addClassLogger
+class AlarmLifecycle(object):
+
+    def __init__(self, path, ttl=7 * 86400, timeout=5.0, prune_probability=0.01):
+        """
+        :param path: SQLite file of the index
+        :param ttl: seconds after which alarms that were not seen again are forgotten
+        :param timeout: seconds to wait for a concurrent writer
+        :param prune_probability: chance that an update also prunes expired rows
+        """
+        self.path = path
+        self.ttl = ttl
+        self.timeout = timeout
+        self.prune_probability = prune_probability
+        self._lock = threading.Lock()
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False,
+                                       isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS alarm_lifecycle ('
+                             'key TEXT PRIMARY KEY, event_id INTEGER, status TEXT NOT NULL, '
+                             'first_seen REAL NOT NULL, last_seen REAL NOT NULL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS alarm_lifecycle_last_seen ON alarm_lifecycle (last_seen)')
+        return self._db
+
+    def get(self, key):
+        """ :return: LifecycleEntry of an alarm key or None """
+        try:
+            with self._lock:
+                row = self.db.execute('SELECT key, event_id, status, first_seen, last_seen FROM alarm_lifecycle '
+                                      'WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error as e:
+            self.__log.warning('Alarm lifecycle index unavailable: %s', e)
+            return None
+        if row is None or row[4] < time.time() - self.ttl:
+            return None
+        return LifecycleEntry(*row)
+
+    def link(self, datadog_format):
+        """
+        Point an event at the parent event of its open incident
+        :param datadog_format: keyword arguments for Datadog.post_event, related_event_id is set in place
+        :return: the LifecycleEntry found, or None
+        """
+        entry = self.get(datadog_format.get('aggregation_key'))
+        if entry is not None and entry.is_open and entry.event_id:
+            datadog_format['related_event_id'] = entry.event_id
+        return entry
+
+    def record(self, datadog_format, event_id=None, when=None):
+        """
+        Record a transition after its event was posted (event_id known) or spooled (event_id None)
+        :param datadog_format: keyword arguments the event was posted with
+        :param event_id: id of the posted event, only kept when the event opened an incident
+        :param when: epoch seconds, defaults to now
+        :return: None
+        """
+        key = datadog_format.get('aggregation_key')
+        if not key:
+            return
+        status = datadog_format.get('alert_type')
+        if status == RESOLVED_ALERT_TYPE or datadog_format.get('related_event_id'):
+            # children of an incident are never its parent
+            event_id = None
+        when = time.time() if when is None else when
+        try:
+            with self._lock:
+                self.db.execute(_UPSERT, {'key': key, 'event_id': event_id, 'status': status, 'when': when,
+                                          'resolved': RESOLVED_ALERT_TYPE, 'expired': when - self.ttl})
+                if random.random() < self.prune_probability:
+                    self._prune(when)
+        except sqlite3.Error as e:
+            self.__log.warning('Unable to update alarm lifecycle index: %s', e)
+
+    def _prune(self, now):
+        pruned = self.db.execute('DELETE FROM alarm_lifecycle WHERE last_seen < ?', (now - self.ttl,)).rowcount
+        if pruned:
+            self.__log.debug('Pruned %s expired alarms from the lifecycle index', pruned)
+        return pruned
+
+    def prune(self):
+        """ :return: number of rows removed because they were not seen for ttl seconds """
+        with self._lock:
+            return self._prune(time.time())
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,197 @@
+"""
+Fixed schema record of a vCenter alarm.
+
+AlarmRecord holds the VMWARE_ALARM_* variables of one alarm transition in __slots__ (no per instance __dict__), low
+cardinality values such as statuses, alarm and target names are interned so a large number of queued or recent
+alarms share them. Variables outside the known schema are kept in the extra dict under their variable name.
+
+Records convert to and from the alarm environment, plain dicts (JSON) and a compact binary encoding used for IPC
+and storage:
+
+    version     1 byte
+    present     2 bytes, bit i is set when FIELDS[i] is not None
+    fields      varint length + UTF-8 for every present field, in FIELDS order
+    time        8 bytes, IEEE 754 double, epoch seconds
+    extra       varint count, then varint length + UTF-8 of each name and value
+"""
+import sys
+import time
+import struct
+from .exceptions import AlarmRecordError
+
+ENV_PREFIX = 'VMWARE_ALARM_'
+FIELDS = ('id', 'alarm_name', 'target_id', 'target_name', 'newstatus', 'oldstatus', 'eventdescription',
+          'triggeringsummary', 'declaringsummary', 'alarmvalue')
+REQUIRED = ('alarm_name', 'target_name', 'newstatus', 'eventdescription')
+# values repeated across many alarms, interned so the records share one string
+INTERNED = frozenset(('id', 'alarm_name', 'target_id', 'target_name', 'newstatus', 'oldstatus'))
+ENV_NAMES = dict((f, ENV_PREFIX + ('NAME' if f == 'alarm_name' else f.upper())) for f in FIELDS)
+FIELD_NAMES = dict((v, k) for k, v in ENV_NAMES.items())
+
+VERSION = 1
+_HEADER = struct.Struct('!BH')
+_TIME = struct.Struct('!d')
+
+
+class AlarmRecord(object):
+    __slots__ = FIELDS + ('time', 'extra')
+
+    def __init__(self, time=None, extra=None, **fields):
+        """
+        :param time: epoch seconds the alarm was received, defaults to now
+        :param extra: dict of VMWARE_ALARM_* variables outside the schema
+        :param fields: values of FIELDS, missing fields are None
+        """
+        unknown = set(fields).difference(FIELDS)
+        if unknown:
+            raise AlarmRecordError('Unknown alarm record fields: {}'.format(sorted(unknown)))
+        for name in FIELDS:
+            value = fields.get(name)
+            if value is not None and name in INTERNED:
+                value = sys.intern(value)
+            setattr(self, name, value)
+        self.time = _now() if time is None else float(time)
+        self.extra = extra or None
+
+    @classmethod
+    def from_env(cls, environ, time=None):
+        """
+        :param environ: mapping of the alarm environment, only VMWARE_ALARM_* variables are read
+        :param time: epoch seconds the alarm was received, defaults to now
+        :return: AlarmRecord, raises AlarmRecordError when a required variable is missing
+        """
+        fields = {}
+        extra = {}
+        for k, v in environ.items():
+            if not k.startswith(ENV_PREFIX):
+                continue
+            name = FIELD_NAMES.get(k)
+            if name is not None:
+                fields[name] = v
+            else:
+                extra[k] = v
+        record = cls(time=time, extra=extra, **fields)
+        record.validate()
+        return record
+
+    @classmethod
+    def from_dict(cls, data):
+        """ :param data: dict as returned by to_dict() """
+        data = dict(data)
+        return cls(time=data.pop('time', None), extra=data.pop('extra', None), **data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ :param data: bytes as returned by to_bytes() """
+        try:
+            version, present = _HEADER.unpack_from(data, 0)
+            if version != VERSION:
+                raise AlarmRecordError('Unsupported alarm record version {}'.format(version))
+            offset = _HEADER.size
+            fields = {}
+            for i, name in enumerate(FIELDS):
+                if present & (1 << i):
+                    fields[name], offset = _read_str(data, offset)
+            (timestamp,) = _TIME.unpack_from(data, offset)
+            offset += _TIME.size
+            count, offset = _read_varint(data, offset)
+            extra = {}
+            for _ in range(count):
+                key, offset = _read_str(data, offset)
+                extra[key], offset = _read_str(data, offset)
+        except (struct.error, IndexError, UnicodeDecodeError) as e:
+            raise AlarmRecordError('Corrupt alarm record: {}'.format(e))
+        return cls(time=timestamp, extra=extra, **fields)
+
+    def validate(self):
+        missing = [ENV_NAMES[f] for f in REQUIRED if getattr(self, f) is None]
+        if missing:
+            raise AlarmRecordError('Alarm is missing {}'.format(', '.join(missing)))
+
+    def to_env(self):
+        """ :return: dict of the VMWARE_ALARM_* variables """
+        env = dict((ENV_NAMES[f], getattr(self, f)) for f in FIELDS if getattr(self, f) is not None)
+        if self.extra:
+            env.update(self.extra)
+        return env
+
+    def to_dict(self):
+        """ :return: JSON serializable dict """
+        data = dict((f, getattr(self, f)) for f in FIELDS if getattr(self, f) is not None)
+        data['time'] = self.time
+        if self.extra:
+            data['extra'] = dict(self.extra)
+        return data
+
+    def to_bytes(self):
+        """ :return: compact binary encoding of the record """
+        present = 0
+        parts = [b'']
+        for i, name in enumerate(FIELDS):
+            value = getattr(self, name)
+            if value is not None:
+                present |= 1 << i
+                parts.append(_str_bytes(value))
+        parts[0] = _HEADER.pack(VERSION, present)
+        parts.append(_TIME.pack(self.time))
+        extra = self.extra or {}
+        parts.append(_varint(len(extra)))
+        for key, value in extra.items():
+            parts.append(_str_bytes(key))
+            parts.append(_str_bytes(value))
+        return b''.join(parts)
+
+    def get_extra(self, name):
+        """
+        :param name: variable name without the VMWARE_ALARM_ prefix, in any case
+        :return: value of an extra variable or None
+        """
+        if not self.extra:
+            return None
+        return self.extra.get(ENV_PREFIX + name.upper())
+
+    def __eq__(self, other):
+        if not isinstance(other, AlarmRecord):
+            return NotImplemented
+        return all(getattr(self, s) == getattr(other, s) for s in self.__slots__)
+
+    def __repr__(self):
+        return '<AlarmRecord {} {} {}->{}>'.format(self.alarm_name, self.target_name, self.oldstatus, self.newstatus)
+
+
+def _now():
+    return time.time()
+
+
+def _varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _read_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def _str_bytes(value):
+    encoded = str(value).encode('utf-8')
+    return _varint(len(encoded)) + encoded
+
+
+def _read_str(data, offset):
+    length, offset = _read_varint(data, offset)
+    end = offset + length
+    if end > len(data):
+        raise IndexError('string runs past the end of the record')
+    return bytes(data[offset:end]).decode('utf-8'), end
@@ -0,0 +1,231 @@
+import time
+import hashlib
+import logging
+import collections
+from vcenterdd.log.setup import addClassLogger
+from .rules import TITLE_LIMIT, TEXT_LIMIT, truncate
+
+logger = logging.getLogger(__name__)
+
+
+class _Storm(object):
+    __slots__ = ('arrivals', 'last', 'started', 'first', 'targets', 'overflow', 'sent')
+
+    def __init__(self, threshold):
+        self.arrivals = collections.deque(maxlen=threshold)
+        self.last = None
+        self.started = None
+        # set while the storm is being rolled up
+        self.first = None
+        self.targets = None
+        self.overflow = 0
+        self.sent = 0
+
+
+class StormSummary(object):
+    """
+    One event standing in for the transitions of many targets to the same status of the same alarm. Quacks like a
+    VcenterAlarm as far as the pipeline is concerned: format_datadog_event() fills datadog_format. The summary has
+    no host, so the first alarm's target is never looked up in DNS.
+    """
+
+    def __init__(self, first, targets, overflow=0, sent=0):
+        """
+        :param first: VcenterAlarm of the first rolled up transition, its tags, priority and alert type are reused
+        :param targets: list of (target_name, oldstatus, datetime) of the rolled up transitions
+        :param overflow: transitions rolled up beyond the targets kept
+        :param sent: transitions of the storm already posted individually before it was detected
+        """
+        self.first = first
+        self.targets = targets
+        self.overflow = overflow
+        self.sent = sent
+        self.datadog_format = {}
+        self.aggregation_key = storm_key_hash(first)
+
+    @property
+    def count(self):
+        return len(self.targets) + self.overflow
+
+    def format_datadog_event(self):
+        first = self.first
+        name = first.summary.replace(' on {}'.format(first.target_name), '')
+        header = '{} changed to {} on {} targets between {:%H:%M:%S} and {:%H:%M:%S}:'.format(
+            name, first.newstatus, self.count, self.targets[0][2], self.targets[-1][2])
+        footer = '\n{} earlier targets were posted as individual events.'.format(self.sent) if self.sent else ''
+        # list as many targets as fit the text limit, keeping room for the count of the others
+        budget = TEXT_LIMIT - len(header) - len(footer) - len('\n  ... and {} more targets'.format(self.count))
+        lines = [header]
+        for target, oldstatus, date_time in self.targets:
+            line = '\n  {} (from {})'.format(target, oldstatus)
+            budget -= len(line)
+            if budget < 0:
+                break
+            lines.append(line)
+        listed = len(lines) - 1
+        if listed < self.count:
+            lines.append('\n  ... and {} more targets'.format(self.count - listed))
+        lines.append(footer)
+        self.datadog_format = first.event_fields(host='')
+        self.datadog_format.update({
+            'title': truncate('{} {} on {} targets'.format(first.prefix, name, self.count), TITLE_LIMIT),
+            'text': truncate(''.join(lines), TEXT_LIMIT),
+            'date_happened': self.targets[-1][2],
+            'aggregation_key': self.aggregation_key,
+            'device_name': '',
+        })
+        return self.datadog_format
+
+
+def storm_key_hash(alarm):
+    """
+    Aggregation key of the summary events of an alarm, shared by its trigger and resolution storms so the lifecycle
+    index links them like the transitions of a single alarm
+    """
+    return hashlib.sha1('storm,{},{}'.format(alarm.alarm_name, alarm.env).encode()).hexdigest()
+
+
+@addClassLogger
+class StormRollup(object):
+    """
+    Rolls the transitions of many targets of the same alarm up into summary events, keyed on alarm_name, newstatus
+    and env. A storage hiccup that turns fifty datastores Red becomes a few events rather than fifty.
+
+    Transitions are released right away until threshold of them arrive for one key within window seconds. From then
+    on the key is storming: its transitions are held and released as a single StormSummary once the key has been
+    quiet for window seconds, or every max_hold seconds while the storm lasts. A transition of the same alarm to
+    another status that is released right away releases the held summary first, so a recovery never goes out
+    before the summary of the trigger storm it recovers from.
+
+    Memory is bounded: at most max_keys keys are tracked (the least recently active one is released early when
+    full), each remembers threshold arrival times and at most max_targets held targets, the rest are only counted.
+    """
+
+    def __init__(self, threshold=10, window=10.0, max_hold=60.0, max_targets=200, max_keys=1000,
+                 clock=time.monotonic):
+        """
+        :param threshold: transitions of one key within window that start a storm, 0 disables the rollup
+        :param window: sliding window in seconds, also the quiet time that ends a storm
+        :param max_hold: seconds a storming key is held at most before its summary is released
+        :param max_targets: targets listed per summary, further ones are counted
+        :param max_keys: keys tracked at most
+        :param clock: monotonic clock, replaceable for testing
+        """
+        self.threshold = threshold
+        self.window = window
+        self.max_hold = max_hold
+        self.max_targets = max_targets
+        self.max_keys = max_keys
+        self.clock = clock
+        self.storms = collections.OrderedDict()
+        # (alarm_name, env) -> statuses tracked in storms, finds the storms of the other statuses of an alarm
+        self._statuses = {}
+        self.rolled_up = 0
+        self.summaries = 0
+
+    def add(self, ready):
+        """
+        Pass the alarms released by the flap coalescer through the rollup
+        :param ready: list of (alarm, timeline)
+        :return: list of (alarm or StormSummary, timeline) ready to be sent
+        """
+        if not self.threshold:
+            return ready
+        now = self.clock()
+        released = self.due(now)
+        for alarm, timeline in ready:
+            if timeline is not None:
+                # the final state of a coalesced flap, its first transition already went through here
+                released.append((alarm, timeline))
+            else:
+                released.extend(self._add(alarm, now))
+        return released
+
+    def _add(self, alarm, now):
+        key = (alarm.alarm_name, alarm.newstatus, alarm.env)
+        storm = self.storms.get(key)
+        released = []
+        if storm is None:
+            while len(self.storms) >= self.max_keys:
+                released.extend(self._close(self._pop_oldest()))
+            storm = self.storms[key] = _Storm(self.threshold)
+            self._statuses.setdefault((key[0], key[2]), set()).add(key[1])
+        else:
+            self.storms.move_to_end(key)
+        storm.arrivals.append(now)
+        storm.last = now
+        if storm.targets is None:
+            if len(storm.arrivals) < self.threshold or now - storm.arrivals[0] > self.window:
+                for status in self._statuses[(key[0], key[2])]:
+                    if status != key[1]:
+                        released.extend(self._close(self.storms[(key[0], status, key[2])]))
+                released.append((alarm, None))
+                return released
+            self.__log.info('%s transitions of %s to %s within %ss, rolling up further targets', self.threshold,
+                            alarm.alarm_name, alarm.newstatus, self.window)
+            storm.started = now
+            storm.targets = []
+            # the transitions of the window that started the storm went out as individual events
+            storm.sent = len(storm.arrivals) - 1
+        if storm.first is None:
+            storm.first = alarm
+        if len(storm.targets) < self.max_targets:
+            storm.targets.append((alarm.target_name, alarm.oldstatus, alarm.date_time))
+        else:
+            storm.overflow += 1
+        self.rolled_up += 1
+        if now - storm.started >= self.max_hold:
+            released.extend(self._close(storm))
+            storm.started = now
+        return released
+
+    def due(self, now=None):
+        """
+        Release the storms that went quiet and forget the keys that did not storm
+        :return: list of (StormSummary, None) ready to be sent
+        """
+        now = self.clock() if now is None else now
+        released = []
+        # keys are in order of their last transition
+        while self.storms:
+            storm = next(iter(self.storms.values()))
+            if now - storm.last < self.window:
+                break
+            released.extend(self._close(self._pop_oldest()))
+        return released
+
+    def next_due(self):
+        """ :return: seconds until the least recently active key goes quiet, None if no key is tracked """
+        if not self.storms:
+            return None
+        storm = next(iter(self.storms.values()))
+        return max(0.0, self.window - (self.clock() - storm.last))
+
+    def flush(self):
+        """ Release every storm, used at shutdown """
+        released = []
+        while self.storms:
+            released.extend(self._close(self._pop_oldest()))
+        return released
+
+    def _pop_oldest(self):
+        """ Forget the least recently active key """
+        (alarm_name, newstatus, env), storm = self.storms.popitem(last=False)
+        statuses = self._statuses[(alarm_name, env)]
+        statuses.discard(newstatus)
+        if not statuses:
+            del self._statuses[(alarm_name, env)]
+        return storm
+
+    def _close(self, storm):
+        """ :return: the summary of the targets held by storm, which is then emptied """
+        if not storm.targets:
+            return []
+        summary = StormSummary(storm.first, storm.targets, overflow=storm.overflow, sent=storm.sent)
+        self.__log.info('Rolled up %s targets of %s into one event', summary.count, storm.first.alarm_name)
+        self.summaries += 1
+        storm.first = None
+        storm.targets = []
+        storm.overflow = 0
+        storm.sent = 0
+        return [(summary, None)]
@@ -0,0 +1,265 @@
+"""
+Routing and filter rules, evaluated after an alarm is parsed and before any DNS or HTTP work.
+
+Rules are read from YAML (or the equivalent dict) and compiled once:
+
+    defaults:
+      tags: ["{env}", "app:vsphere", "team:cig", "inf.vsphere.{alarm_name}"]
+      title: "{name}"
+      priority: normal
+    rules:
+      - name: gray-green-noise
+        match: {transition: ["Gray->Green"]}
+        drop: true
+      - name: datastores
+        match:
+          alarm_name: [alarm.DatastoreDiskUsageAlarm]
+          target_name: "^CL\\\\d+"               # regular expression, searched
+          newstatus: [Yellow, Red]
+          env: [env:prod]
+        sample: 0.5                           # keep half of the matching alarms
+        tags: ["{env}", "app:vsphere", "team:storage"]
+        title: "{prefix} {summary} on {target_name}"
+        text: "{eventdescription}\\n{triggeringsummary}"
+        priority: low
+        alert_type: warning
+        destinations: [events, metrics]       # any of events, logs, metrics
+
+The first rule that matches decides, alarms no rule matches use the defaults. Match keys are alarm_name (exact),
+alarm_name_pattern and target_name (regular expressions), newstatus, oldstatus, transition ("Old->New", either side
+may be "*") and env. Statuses compare case insensitively.
+
+Rules are indexed by alarm name: an alarm is only checked against the rules naming it and the rules that do not
+name any alarm, in file order, and the candidate list per alarm name is built once. Templates are str.format
+strings over the fields of VcenterAlarm.template_fields(), titles are cut to 100 and texts to 4000 characters.
+An optional top level "queue" section configures the daemon's priority queue, see vcenterdd.daemon.priority.
+"""
+import re
+import random
+import logging
+from vcenterdd.telemetry.statsd import telemetry
+from .exceptions import RuleError
+
+logger = logging.getLogger(__name__)
+
+TITLE_LIMIT = 100
+TEXT_LIMIT = 4000
+DESTINATIONS = frozenset(('events', 'logs', 'metrics'))
+TEMPLATE_FIELDS = ('name', 'summary', 'prefix', 'alarm_key_hash', 'env', 'id', 'alarm_name', 'target_id',
+                   'target_name', 'newstatus', 'oldstatus', 'eventdescription', 'triggeringsummary',
+                   'declaringsummary', 'alarmvalue')
+DEFAULTS = {
+    'tags': ['{env}', 'app:vsphere', 'team:cig', 'inf.vsphere.{alarm_name}'],
+    'title': '{name}',
+    'text': '{eventdescription}\n{triggeringsummary}\n{declaringsummary}',
+    'priority': 'normal',
+    'alert_type': None,
+    'destinations': sorted(DESTINATIONS),
+}
+MATCH_KEYS = frozenset(('alarm_name', 'alarm_name_pattern', 'target_name', 'newstatus', 'oldstatus', 'transition',
+                        'env'))
+RULE_KEYS = frozenset(('name', 'match', 'drop', 'sample', 'tags', 'title', 'text', 'priority', 'alert_type',
+                       'destinations'))
+# bound on the candidate cache, alarm names are a small fixed set in practice
+MAX_CACHED_NAMES = 10000
+
+
+def truncate(text, limit):
+    """ :return: text cut to limit characters, marked with ... when cut """
+    if len(text) <= limit:
+        return text
+    return text[:limit - 3] + '...'
+
+
+def _as_list(value):
+    if value is None:
+        return None
+    return list(value) if isinstance(value, (list, tuple, set, frozenset)) else [value]
+
+
+def _lower_set(value):
+    values = _as_list(value)
+    return frozenset(str(v).lower() for v in values) if values is not None else None
+
+
+def _check_template(template, rule_name):
+    try:
+        template.format_map(dict.fromkeys(TEMPLATE_FIELDS, ''))
+    except (KeyError, IndexError, ValueError) as e:
+        raise RuleError('Invalid template {!r} in rule {}: {}'.format(template, rule_name, e))
+    return template
+
+
+class Decision(object):
+    """ What to do with an alarm, precompiled per rule so evaluating a rule allocates nothing """
+    __slots__ = ('rule', 'tags', 'title', 'text', 'priority', 'alert_type', 'destinations')
+
+    def __init__(self, rule, tags, title, text, priority, alert_type, destinations):
+        self.rule = rule
+        self.tags = tuple(tags)
+        self.title = title
+        self.text = text
+        self.priority = priority
+        self.alert_type = alert_type
+        self.destinations = frozenset(destinations)
+
+    def downgraded(self):
+        """ :return: copy of the decision posting with priority low """
+        return Decision(self.rule, self.tags, self.title, self.text, 'low', self.alert_type, self.destinations)
+
+    @classmethod
+    def compile(cls, rule, conf, defaults=None):
+        """
+        :param rule: name of the rule the decision belongs to
+        :param conf: rule (or defaults) dict
+        :param defaults: Decision the unset keys are taken from
+        """
+        def pick(key):
+            if conf.get(key) is not None:
+                return conf[key]
+            return getattr(defaults, key) if defaults is not None else DEFAULTS[key]
+
+        destinations = frozenset(_as_list(pick('destinations')))
+        if not destinations.issubset(DESTINATIONS):
+            raise RuleError('Unknown destinations {} in rule {}'.format(sorted(destinations - DESTINATIONS), rule))
+        priority = pick('priority')
+        if priority not in ('normal', 'low'):
+            raise RuleError('Invalid priority {!r} in rule {}'.format(priority, rule))
+        return cls(rule=rule, tags=[_check_template(t, rule) for t in _as_list(pick('tags'))],
+                   title=_check_template(pick('title'), rule), text=_check_template(pick('text'), rule),
+                   priority=priority, alert_type=pick('alert_type'), destinations=destinations)
+
+
+DEFAULT_DECISION = Decision.compile('default', DEFAULTS)
+
+
+class Rule(object):
+    __slots__ = ('name', 'index', 'alarm_names', 'alarm_name_pattern', 'target', 'newstatus', 'oldstatus',
+                 'transitions', 'envs', 'drop', 'sample', 'decision')
+
+    def __init__(self, conf, index, defaults):
+        unknown = set(conf).difference(RULE_KEYS)
+        self.name = conf.get('name') or 'rule-{}'.format(index)
+        if unknown:
+            raise RuleError('Unknown keys {} in rule {}'.format(sorted(unknown), self.name))
+        match = conf.get('match') or {}
+        unknown = set(match).difference(MATCH_KEYS)
+        if unknown:
+            raise RuleError('Unknown match keys {} in rule {}'.format(sorted(unknown), self.name))
+        self.index = index
+        names = _as_list(match.get('alarm_name'))
+        self.alarm_names = frozenset(names) if names is not None else None
+        try:
+            self.alarm_name_pattern = re.compile(match['alarm_name_pattern']) \
+                if match.get('alarm_name_pattern') else None
+            self.target = re.compile(match['target_name']) if match.get('target_name') else None
+        except re.error as e:
+            raise RuleError('Invalid regular expression in rule {}: {}'.format(self.name, e))
+        self.newstatus = _lower_set(match.get('newstatus'))
+        self.oldstatus = _lower_set(match.get('oldstatus'))
+        self.transitions = None
+        if match.get('transition') is not None:
+            transitions = set()
+            for transition in _as_list(match['transition']):
+                old, sep, new = str(transition).partition('->')
+                if not sep:
+                    raise RuleError('Invalid transition {!r} in rule {}, expected Old->New'.format(
+                        transition, self.name))
+                transitions.add((old.strip().lower(), new.strip().lower()))
+            self.transitions = frozenset(transitions)
+        envs = _as_list(match.get('env'))
+        self.envs = frozenset(envs) if envs is not None else None
+        self.drop = bool(conf.get('drop'))
+        self.sample = None
+        if conf.get('sample') is not None:
+            try:
+                self.sample = float(conf['sample'])
+            except (TypeError, ValueError):
+                raise RuleError('Invalid sample {!r} in rule {}'.format(conf['sample'], self.name))
+            if not 0 <= self.sample <= 1:
+                raise RuleError('sample must be between 0 and 1 in rule {}'.format(self.name))
+        self.decision = Decision.compile(self.name, conf, defaults)
+
+    def matches(self, alarm, oldstatus, newstatus):
+        """ Cheapest checks first, the regular expressions last """
+        if self.envs is not None and alarm.env not in self.envs:
+            return False
+        if self.newstatus is not None and newstatus not in self.newstatus:
+            return False
+        if self.oldstatus is not None and oldstatus not in self.oldstatus:
+            return False
+        if self.transitions is not None and not (
+                (oldstatus, newstatus) in self.transitions or ('*', newstatus) in self.transitions
+                or (oldstatus, '*') in self.transitions):
+            return False
+        if self.alarm_name_pattern is not None and not self.alarm_name_pattern.search(alarm.alarm_name or ''):
+            return False
+        if self.target is not None and not self.target.search(alarm.target_name or ''):
+            return False
+        return True
+
+
+class RuleSet(object):
+
+    def __init__(self, config=None, rng=random.random):
+        """
+        :param config: dict with optional 'defaults' and 'rules' keys, see the module docstring
+        :param rng: callable returning a float in [0, 1), used for sampling
+        """
+        config = config or {}
+        self.config = config
+        self.defaults = Decision.compile('default', config.get('defaults') or {}) \
+            if config.get('defaults') else DEFAULT_DECISION
+        self.rules = [Rule(conf, i, self.defaults) for i, conf in enumerate(config.get('rules') or [])]
+        self.rng = rng
+        self._by_name = {}
+        self._generic = []
+        for rule in self.rules:
+            if rule.alarm_names is None:
+                self._generic.append(rule)
+            else:
+                for name in rule.alarm_names:
+                    self._by_name.setdefault(name, []).append(rule)
+        self._candidates = {}
+
+    @classmethod
+    def load(cls, path):
+        """ Compile the rules of a YAML file """
+        import yaml
+
+        with open(path, 'rt') as f:
+            return cls(yaml.safe_load(f.read()))
+
+    def candidates(self, alarm_name):
+        """ :return: rules that can match an alarm name, in file order """
+        rules = self._candidates.get(alarm_name)
+        if rules is None:
+            named = self._by_name.get(alarm_name)
+            rules = sorted(named + self._generic, key=lambda r: r.index) if named else self._generic
+            if len(self._candidates) < MAX_CACHED_NAMES:
+                self._candidates[alarm_name] = rules
+        return rules
+
+    def evaluate(self, alarm):
+        """
+        :param alarm: VcenterAlarm
+        :return: Decision for the alarm, None when it is dropped or sampled out
+        """
+        oldstatus = (alarm.oldstatus or '').lower()
+        newstatus = (alarm.newstatus or '').lower()
+        for rule in self.candidates(alarm.alarm_name):
+            if rule.matches(alarm, oldstatus, newstatus):
+                if rule.drop or (rule.sample is not None and self.rng() >= rule.sample):
+                    telemetry().increment('rules.dropped', tags=('rule:{}'.format(rule.name),))
+                    return None
+                return rule.decision
+        return self.defaults
+
+    def apply(self, alarm):
+        """
+        Evaluate the rules and attach the decision to the alarm
+        :return: the Decision, None when the alarm is dropped
+        """
+        decision = self.evaluate(alarm)
+        alarm.decision = decision
+        return decision
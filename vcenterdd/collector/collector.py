@@ -0,0 +1,100 @@
+import logging
+import threading
+from vcenterdd.log.setup import addClassLogger
+from .state import AlarmStateTable, alarm_environ
+
+logger = logging.getLogger(__name__)
+
+
+@addClassLogger
+class AlarmCollector(object):
+    """
+    Keeps one session to a vCenter (or a recorded stand-in), applies the incremental triggeredAlarmState updates to
+    an AlarmStateTable and submits every transition to the pipeline as VMWARE_ALARM_* environ, exactly as the
+    "Run a Script" path would, without a process per alarm.
+    """
+
+    def __init__(self, source, submit, env, name=None, max_wait=30, retry_interval=10.0):
+        """
+        :param source: VcenterSource or RecordedVcenter
+        :param submit: callable(env, environ), e.g. AlarmPipeline.submit
+        :param env: env tag of this vCenter
+        :param name: name used in logs and for the thread
+        :param max_wait: maxWaitSeconds of a WaitForUpdatesEx call
+        :param retry_interval: seconds to wait before reconnecting after an error
+        """
+        self.source = source
+        self.submit = submit
+        self.env = env
+        self.name = name or env
+        self.max_wait = max_wait
+        self.retry_interval = retry_interval
+        self.table = AlarmStateTable()
+        self.version = None
+        self.transitions = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def poll(self):
+        """
+        Wait for one update set and submit its transitions
+        :return: number of transitions submitted
+        """
+        self.version, changes = self.source.wait_for_updates(self.version, max_wait=self.max_wait)
+        submitted = 0
+        for state, old_status, new_status in self.table.apply(changes):
+            self.submit(self.env, alarm_environ(state, old_status, new_status))
+            submitted += 1
+        self.transitions += submitted
+        return submitted
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except BaseException as e:
+                self.__log.exception('Collector %s failed, reconnecting in %ss. Exception: %s \n Args: %s',
+                                     self.name, self.retry_interval, e, e.args)
+                # a new session starts from an empty version, the table diff hides states we already reported
+                self.version = None
+                try:
+                    self.source.close()
+                except BaseException:
+                    pass
+                self._stop.wait(self.retry_interval)
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name='collector-{}'.format(self.name), daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """ Stops after the current WaitForUpdatesEx call returns (at most max_wait seconds) """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.max_wait + 5)
+            self._thread = None
+        self.source.close()
+
+
+def load_collectors(config, submit):
+    """
+    Build collectors from a config list, one entry per vCenter:
+        {"host": "vc01", "user": "...", "password": "...", "env": "env:prod"}
+        {"recording": "/path/updates.json", "env": "env:test"}
+    :return: list of AlarmCollector
+    """
+    from .source import VcenterSource, RecordedVcenter
+
+    collectors = []
+    for entry in config:
+        if entry.get('recording'):
+            source = RecordedVcenter(entry['recording'])
+        else:
+            source = VcenterSource(entry['host'], entry['user'], entry['password'], port=entry.get('port', 443),
+                                   verify=entry.get('verify', False))
+        collectors.append(AlarmCollector(source, submit, env=entry['env'],
+                                         name=entry.get('host') or entry.get('name') or entry['env'],
+                                         max_wait=entry.get('max_wait', 30)))
+    return collectors
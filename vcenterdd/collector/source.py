@@ -0,0 +1,156 @@
+"""
+Sources of triggeredAlarmState deltas for the collector.
+
+VcenterSource talks to a real vCenter through pyVmomi (imported lazily, only needed in collector mode).
+RecordedVcenter replays recorded update sets from a JSON file and is the stand-in used to test the collector
+without a vCenter. Both expose:
+
+    wait_for_updates(version, max_wait) -> (new_version or None, list of changes)
+    close()
+
+where the changes use the normalized format described in vcenterdd.collector.state.AlarmStateTable.
+
+Only triggeredAlarmState is followed. Alarm events (AlarmStatusChangedEvent through an EventHistoryCollector) are
+not: a transition that is undone within one WaitForUpdatesEx call, e.g. a Yellow-Red-Yellow flap, isn't seen.
+"""
+import ssl
+import json
+import time
+import logging
+import collections
+from vcenterdd.log.setup import addClassLogger
+from .state import TRIGGERED_ALARM_STATE
+
+logger = logging.getLogger(__name__)
+
+
+@addClassLogger
+class VcenterSource(object):
+    """ Incremental triggeredAlarmState updates of one vCenter through PropertyCollector.WaitForUpdatesEx """
+
+    def __init__(self, host, user, password, port=443, verify=False, max_names=10000, names_ttl=300.0):
+        """
+        :param max_names: alarm definitions and entity names cached at most, the least recently used are dropped
+        :param names_ttl: seconds a cached name is used before it is read again, so renamed entities and edited
+                          alarms are picked up
+        """
+        self.host = host
+        self.user = user
+        self.password = password
+        self.port = port
+        self.verify = verify
+        self.max_names = max_names
+        self.names_ttl = names_ttl
+        self.si = None
+        self.collector = None
+        self._names = collections.OrderedDict()
+
+    def connect(self):
+        from pyVim.connect import SmartConnect
+        from pyVmomi import vmodl
+
+        context = None if self.verify else ssl._create_unverified_context()
+        self.si = SmartConnect(host=self.host, user=self.user, pwd=self.password, port=self.port,
+                               sslContext=context)
+        content = self.si.RetrieveContent()
+        # a separate collector so the filter doesn't interfere with other users of the session
+        self.collector = content.propertyCollector.CreatePropertyCollector()
+        spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=content.rootFolder, skip=False)],
+            propSet=[vmodl.query.PropertyCollector.PropertySpec(type=type(content.rootFolder),
+                                                                pathSet=[TRIGGERED_ALARM_STATE])])
+        self.collector.CreateFilter(spec, partialUpdates=True)
+        self.__log.info('Collecting alarm state updates from %s', self.host)
+
+    def wait_for_updates(self, version, max_wait=60):
+        from pyVmomi import vmodl
+
+        if self.collector is None:
+            self.connect()
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=max_wait)
+        update_set = self.collector.WaitForUpdatesEx(version or '', options)
+        if update_set is None:
+            return version, []
+        changes = []
+        for filter_update in update_set.filterSet:
+            for object_update in filter_update.objectSet:
+                for change in object_update.changeSet:
+                    val = change.val
+                    if change.name == TRIGGERED_ALARM_STATE:
+                        val = [self._normalize(s) for s in (val or [])]
+                    elif val is not None:
+                        val = self._normalize(val)
+                    changes.append({'op': change.op, 'name': change.name, 'val': val})
+        return update_set.version, changes
+
+    def _name(self, moref, attribute):
+        key = moref._moId
+        now = time.monotonic()
+        cached = self._names.get(key)
+        if cached is not None and now < cached[1]:
+            self._names.move_to_end(key)
+            return cached[0]
+        value = attribute(moref)
+        self._names[key] = (value, now + self.names_ttl)
+        self._names.move_to_end(key)
+        while len(self._names) > self.max_names:
+            self._names.popitem(last=False)
+        return value
+
+    def _normalize(self, state):
+        info = self._name(state.alarm, lambda a: a.info)
+        return {
+            'key': state.key,
+            'alarm': state.alarm._moId,
+            'alarm_name': info.name,
+            'alarm_system_name': getattr(info, 'systemName', None),
+            'entity': state.entity._moId,
+            'entity_name': self._name(state.entity, lambda e: e.name),
+            'status': str(state.overallStatus).capitalize(),
+            'time': state.time.isoformat() if state.time else '',
+        }
+
+    def close(self):
+        if self.si is not None:
+            from pyVim.connect import Disconnect
+
+            if self.collector is not None:
+                self.collector.Destroy()
+            Disconnect(self.si)
+            self.si = None
+            self.collector = None
+        # morefs are only meaningful within a session
+        self._names.clear()
+
+
+class RecordedVcenter(object):
+    """
+    Replays recorded update sets. The recording is a JSON list of {"version": "1", "changes": [...]} with the
+    changes in normalized form, or a path to such a file. Once the recording is exhausted wait_for_updates waits
+    max_wait seconds and returns no changes, like an idle vCenter.
+    """
+
+    def __init__(self, recording, delay=0.0):
+        if isinstance(recording, str):
+            with open(recording, 'rt') as f:
+                recording = json.load(f)
+        self.updates = list(recording)
+        self.delay = delay
+        self._position = 0
+
+    def wait_for_updates(self, version, max_wait=60):
+        if self._position >= len(self.updates):
+            time.sleep(max_wait)
+            return version, []
+        if self.delay:
+            time.sleep(self.delay)
+        update = self.updates[self._position]
+        self._position += 1
+        return update.get('version', str(self._position)), update['changes']
+
+    @property
+    def exhausted(self):
+        return self._position >= len(self.updates)
+
+    def close(self):
+        pass
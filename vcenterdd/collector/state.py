@@ -0,0 +1,109 @@
+import logging
+from vcenterdd.log.setup import addClassLogger
+
+logger = logging.getLogger(__name__)
+
+TRIGGERED_ALARM_STATE = 'triggeredAlarmState'
+
+
+def alarm_environ(state, old_status, new_status):
+    """
+    Build the VMWARE_ALARM_* mapping vCenter would pass to a "Run a Script" action
+    :param state: normalized alarm state, see AlarmStateTable
+    :return: dict usable as VcenterAlarm(environ=...)
+    """
+    return {
+        'VMWARE_ALARM_ID': state['alarm'],
+        'VMWARE_ALARM_NAME': state.get('alarm_system_name') or state.get('alarm_name') or state['alarm'],
+        'VMWARE_ALARM_TARGET_ID': state['entity'],
+        'VMWARE_ALARM_TARGET_NAME': state.get('entity_name') or state['entity'],
+        'VMWARE_ALARM_OLDSTATUS': old_status,
+        'VMWARE_ALARM_NEWSTATUS': new_status,
+        'VMWARE_ALARM_EVENTDESCRIPTION': "Alarm '{}' on {} changed from {} to {}".format(
+            state.get('alarm_name') or state['alarm'], state.get('entity_name') or state['entity'],
+            old_status, new_status),
+        'VMWARE_ALARM_TRIGGERINGSUMMARY': state.get('triggering_summary', ''),
+        'VMWARE_ALARM_DECLARINGSUMMARY': state.get('declaring_summary', ''),
+        # AlarmState carries no trigger value, only the time the alarm state changed
+        'VMWARE_ALARM_ALARMVALUE': '',
+        'VMWARE_ALARM_EVENT_TIME': state.get('time', ''),
+    }
+
+
+@addClassLogger
+class AlarmStateTable(object):
+    """
+    In-memory table of the triggered alarms of one vCenter, keyed on the AlarmState key ("alarm-7.datastore-444").
+
+    Property collector deltas for triggeredAlarmState are applied to the table and turned into transitions.
+    Alarm states are normalized dicts:
+        {'key': ..., 'alarm': 'alarm-7', 'alarm_name': ..., 'alarm_system_name': ..., 'entity': 'datastore-444',
+         'entity_name': ..., 'status': 'Yellow', 'time': ...}
+    A state that disappears from triggeredAlarmState was cleared and is reported as a transition to Green.
+
+    The first complete assign (the initial update set of a new filter) seeds the table without transitions: the
+    alarms already triggered when the collector starts were reported when they fired, reporting them again on every
+    restart would post one event per triggered alarm. Later complete assigns, e.g. after a reconnect, are diffed
+    against the table as usual.
+    """
+
+    def __init__(self, seed=True):
+        """
+        :param seed: take the first complete assign as the baseline, False reports it as transitions from Gray
+        """
+        self.states = {}
+        self.seeded = not seed
+
+    def apply(self, changes):
+        """
+        Apply property changes
+        :param changes: list of {'op': 'assign'|'add'|'remove'|'indirectRemove', 'name': ..., 'val': ...}. A name of
+                        triggeredAlarmState with op assign carries the complete list, indexed names
+                        (triggeredAlarmState["key"]) carry a single state.
+        :return: list of (state, old_status, new_status) transitions
+        """
+        transitions = []
+        for change in changes:
+            name, op, val = change['name'], change['op'], change.get('val')
+            if name == TRIGGERED_ALARM_STATE:
+                if op == 'assign' and not self.seeded:
+                    self.states = dict((state['key'], state) for state in val or [])
+                    self.__log.info('Seeded the alarm state table with %s triggered alarms', len(self.states))
+                elif op == 'assign':
+                    transitions.extend(self._assign_all(val or []))
+                elif op in ('remove', 'indirectRemove'):
+                    transitions.extend(self._assign_all([]))
+            elif name.startswith(TRIGGERED_ALARM_STATE + '['):
+                key = name[len(TRIGGERED_ALARM_STATE) + 1:-1].strip('"')
+                if op in ('remove', 'indirectRemove'):
+                    transitions.extend(self._clear(key))
+                else:
+                    transitions.extend(self._set(val))
+            else:
+                self.__log.debug('Ignoring change of %s', name)
+            self.seeded = True
+        return transitions
+
+    def _assign_all(self, states):
+        transitions = []
+        keys = set()
+        for state in states:
+            keys.add(state['key'])
+            transitions.extend(self._set(state))
+        for key in [k for k in self.states if k not in keys]:
+            transitions.extend(self._clear(key))
+        return transitions
+
+    def _set(self, state):
+        previous = self.states.get(state['key'])
+        self.states[state['key']] = state
+        old_status = previous['status'] if previous else 'Gray'
+        if old_status == state['status']:
+            return []
+        return [(state, old_status, state['status'])]
+
+    def _clear(self, key):
+        previous = self.states.pop(key, None)
+        if previous is None or previous['status'] == 'Green':
+            return []
+        return [(previous, previous['status'], 'Green')]
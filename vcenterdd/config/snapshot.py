@@ -0,0 +1,105 @@
+"""
+Precompiled config snapshot for the one-shot alarm script.
+
+Parsing logging_config.yml needs yaml (slow to import and to parse). ConfigSnapshot compiles it (and the alarm
+rules file when there is one) into a single JSON document that is only rebuilt when the mtime or size of one of the
+source files changes, so a normal run does a json.load() of the snapshot and one of datadog_config.conf. The
+Datadog config holds the API and application keys, it is read from its own file on every run and never copied
+into the snapshot.
+"""
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 3
+
+
+class ConfigSnapshot(object):
+
+    def __init__(self, logging_file, datadog_file, snapshot_file=None, rules_file=None):
+        """
+        :param logging_file: logging config in yaml format
+        :param datadog_file: Datadog config in JSON format
+        :param snapshot_file: where to keep the snapshot, next to datadog_file by default
+        :param rules_file: optional alarm rules in yaml format, see vcenterdd.alarm.rules
+        """
+        self.logging_file = logging_file
+        self.datadog_file = datadog_file
+        self.rules_file = rules_file
+        self.snapshot_file = snapshot_file or os.path.join(os.path.dirname(datadog_file), '.config_snapshot.json')
+        self.logging_config = None
+        self.datadog_config = None
+        self.rules_config = None
+        self.from_cache = False
+
+    @staticmethod
+    def _stamp(path):
+        st = os.stat(path)
+        return [st.st_mtime_ns, st.st_size]
+
+    def _has_rules(self):
+        return bool(self.rules_file) and os.path.exists(self.rules_file)
+
+    def _sources(self):
+        sources = {self.logging_file: self._stamp(self.logging_file)}
+        if self._has_rules():
+            sources[self.rules_file] = self._stamp(self.rules_file)
+        return sources
+
+    def load(self):
+        """
+        Load the merged config, from the snapshot when it is still current or from the source files otherwise
+        :return: self
+        """
+        sources = self._sources()
+        snapshot = self._read_snapshot()
+        if snapshot and snapshot.get('version') == SNAPSHOT_VERSION and snapshot.get('sources') == sources:
+            self.logging_config = snapshot['logging']
+            self.rules_config = snapshot.get('rules')
+            self.datadog_config = self._read_datadog()
+            self.from_cache = True
+            return self
+
+        self.compile()
+        self._write_snapshot(sources)
+        return self
+
+    def compile(self):
+        """ Parse the source files, yaml is only imported when the snapshot is stale """
+        import yaml
+
+        with open(self.logging_file, 'rt') as f:
+            self.logging_config = yaml.safe_load(f.read())
+        self.datadog_config = self._read_datadog()
+        self.rules_config = None
+        if self._has_rules():
+            with open(self.rules_file, 'rt') as f:
+                self.rules_config = yaml.safe_load(f.read())
+        self.from_cache = False
+
+    def _read_datadog(self):
+        with open(self.datadog_file, 'rt') as f:
+            return json.load(f)
+
+    def _read_snapshot(self):
+        try:
+            with open(self.snapshot_file, 'rt') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_snapshot(self, sources):
+        """ Write the snapshot atomically, a read-only install dir only costs us the cache """
+        tmp_file = '{}.{}.tmp'.format(self.snapshot_file, os.getpid())
+        try:
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wt') as f:
+                json.dump({'version': SNAPSHOT_VERSION, 'sources': {k: v for k, v in sources.items()},
+                           'logging': self.logging_config, 'rules': self.rules_config}, f)
+            os.replace(tmp_file, self.snapshot_file)
+        except OSError as e:
+            logger.debug('Unable to write config snapshot %s: %s', self.snapshot_file, e)
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
@@ -0,0 +1,66 @@
+"""
+Thin client used by datadog_alarm.py to hand an alarm over to a running forwarder daemon.
+
+This module is imported before anything else in the alarm script so it must stay light: only the standard
+library modules needed to talk to a Unix domain socket are imported here.
+"""
+import os
+import json
+import socket
+
+DEFAULT_SOCKET_PATH = '/var/run/vcenterdd/forwarder.sock'
+ALARM_ENV_PREFIX = 'VMWARE_ALARM'
+
+
+def alarm_environ(environ=None):
+    """
+    Pull the VMWARE_ALARM_* variables out of an environment mapping
+    :param environ: mapping to read from, defaults to os.environ
+    :return: dict of the alarm variables
+    """
+    environ = os.environ if environ is None else environ
+    return {k: v for k, v in environ.items() if k.startswith(ALARM_ENV_PREFIX)}
+
+
+class ForwarderClient(object):
+    """
+    Sends a single alarm to the forwarder daemon over a Unix domain socket. The wire format is one JSON document
+    per line, the daemon answers with a one line JSON acknowledgement once the alarm is queued.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, timeout=0.5):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.response = None
+
+    def forward(self, env, environ=None):
+        """
+        Forward the alarm to the daemon.
+        :param env: the env tag passed in from vCenter
+        :param environ: mapping holding the VMWARE_ALARM_* variables, defaults to os.environ
+        :return: True when the daemon acknowledged the alarm, False when the caller has to handle it in-process
+        """
+        if not os.path.exists(self.socket_path):
+            return False
+
+        try:
+            self.response = self._request({'env': env, 'alarm': alarm_environ(environ)})
+        except (OSError, ValueError):
+            return False
+
+        return self.response.get('status') == 'queued'
+
+    def stats(self):
+        """
+        :return: dict with the daemon's queue depth and its queued, downgraded, shed and rejected counts
+        :raises OSError: the daemon is not running
+        """
+        return self._request({'command': 'stats'})
+
+    def _request(self, request):
+        message = json.dumps(request).encode() + b'\n'
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            sock.sendall(message)
+            return json.loads(sock.makefile('rb').readline().decode() or '{}')
@@ -0,0 +1,6 @@
+class DaemonException(BaseException):
+    pass
+
+
+class DaemonSocketError(DaemonException):
+    pass
@@ -0,0 +1,218 @@
+import logging
+import queue
+import threading
+from vcenterdd.alarm.handle import VcenterAlarm
+from vcenterdd.alarm.record import AlarmRecord
+from vcenterdd.alarm.exceptions import AlarmRecordError
+from vcenterdd.alarm.rules import DEFAULT_DECISION, TEXT_LIMIT, truncate
+from vcenterdd.alarm.coalesce import FlapCoalescer, format_timeline
+from vcenterdd.alarm.rollup import StormRollup
+from vcenterdd.daemon.priority import PriorityAlarmQueue, SHED, REJECTED
+from vcenterdd.datadog.logs import alarm_log_record
+from vcenterdd.replay.capture import capture_alarm
+from vcenterdd.outbox.replay import post_or_spool
+from vcenterdd.log.setup import addClassLogger
+from vcenterdd.telemetry.statsd import telemetry
+
+logger = logging.getLogger(__name__)
+
+
+def format_alarm(alarm, timeline=None):
+    """
+    Format the Datadog event of an alarm released by a FlapCoalescer
+    :param alarm: VcenterAlarm
+    :param timeline: coalesced transitions appended to the event text, or None
+    :return: the alarm's datadog_format
+    """
+    alarm.format_datadog_event()
+    if timeline:
+        text = "{}\n\n{}".format(alarm.datadog_format['text'], format_timeline(timeline))
+        alarm.datadog_format['text'] = truncate(text, TEXT_LIMIT)
+    return alarm.datadog_format
+
+
+@addClassLogger
+class AlarmPipeline(object):
+    """
+    Holds a warm Datadog instance and posts alarms from a queue on a background worker thread. The daemon
+    accepts alarms on its socket and only has to enqueue them here, the slow work (DNS, HTTP) happens on the worker.
+    """
+
+    def __init__(self, datadog, max_queue=10000, outbox=None, coalescer=None, resolver=None, metrics=None,
+                 shipper=None, events=True, capture=None, lifecycle=None, rules=None, sinks=None,
+                 priority_queue=None, rollup=None):
+        """
+        :param datadog: vcenterdd.datadog.handle.Datadog
+        :param max_queue: alarms waiting for the worker before submit() rejects new ones
+        :param outbox: vcenterdd.outbox.spool.Outbox for events that could not be posted
+        :param coalescer: vcenterdd.alarm.coalesce.FlapCoalescer
+        :param resolver: vcenterdd.alarm.dnscache.DnsCache
+        :param metrics: vcenterdd.datadog.metrics.MetricsBuffer
+        :param shipper: vcenterdd.datadog.logs.LogShipper, every alarm is also shipped as a log record
+        :param events: post events, set to False to only ship logs and metrics
+        :param capture: JSONL file every alarm is appended to for later replay (see datadog_replay.py)
+        :param lifecycle: vcenterdd.alarm.lifecycle.AlarmLifecycle threading resolutions to their trigger
+        :param rules: vcenterdd.alarm.rules.RuleSet deciding which alarms are dropped and where the others go
+        :param sinks: vcenterdd.datadog.sinks.SinkSet events are fanned out to, replaces datadog, outbox and
+                      lifecycle for events (metrics and logs still go through datadog)
+        :param priority_queue: vcenterdd.daemon.priority.PriorityAlarmQueue ordering and shedding the waiting
+                               alarms, defaults to one configured from the "queue" section of the rules
+        :param rollup: vcenterdd.alarm.rollup.StormRollup turning storms of one alarm over many targets into
+                       summary events, applied to the events released by the coalescer
+        """
+        self.datadog = datadog
+        self.metrics = metrics
+        self.shipper = shipper
+        self.events = events
+        self.capture = capture
+        self.lifecycle = lifecycle
+        self.rules = rules
+        self.sinks = sinks
+        self.resolver = resolver
+        self.outbox = outbox
+        self.coalescer = coalescer or FlapCoalescer(window=0)
+        self.rollup = rollup or StormRollup(threshold=0)
+        if priority_queue is None:
+            priority_queue = PriorityAlarmQueue.from_config(
+                rules.config.get('queue') if rules is not None else None, maxsize=max_queue,
+                saturated=lambda: datadog.dispatcher.bucket.saturated())
+        self.queue = priority_queue
+        self._worker = None
+        self._stop = object()
+
+    def start(self):
+        telemetry().register_gauge('queue.depth', self.queue.qsize, tags=('queue:alarms',))
+        if self.shipper is not None:
+            telemetry().register_gauge('queue.depth', lambda: len(self.shipper.buffer), tags=('queue:logs',))
+        if self.metrics is not None:
+            self.metrics.start()
+        if self.shipper is not None:
+            self.shipper.start()
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, name='alarm-pipeline', daemon=True)
+            self._worker.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops the worker once every alarm already queued has been handled
+        :param timeout: seconds to wait for the worker to drain the queue
+        :return: None
+        """
+        if self._worker is not None:
+            self.queue.put_last(self._stop)
+            self._worker.join(timeout)
+            self._worker = None
+        if self.metrics is not None:
+            self.metrics.stop()
+        if self.shipper is not None:
+            self.shipper.stop()
+        if self.outbox is not None:
+            self.outbox.close()
+        if self.resolver is not None:
+            self.resolver.close()
+        if self.lifecycle is not None:
+            self.lifecycle.close()
+        if self.sinks is not None:
+            # the sinks belong to the caller, they still serve the outbox replayers
+            self.sinks.flush(timeout)
+
+    def submit(self, env, environ):
+        """
+        Queue an alarm for processing
+        :param env: the env tag passed in from vCenter
+        :param environ: dict of the VMWARE_ALARM_* variables
+        :return: True if queued, False if the queue is full or the alarm is incomplete
+        """
+        try:
+            # queued alarms are held as compact records, stamped with the time they arrived
+            record = AlarmRecord.from_env(environ)
+        except AlarmRecordError as e:
+            telemetry().increment('alarm.rejected', tags=('reason:invalid',))
+            self.__log.warning('Rejecting alarm for env %s: %s', env, e)
+            return False
+        outcome = self.queue.put(env, record)
+        if outcome == REJECTED:
+            telemetry().increment('alarm.rejected', tags=('reason:queue_full',))
+            self.__log.warning('Alarm queue full, rejecting alarm for env %s', env)
+            return False
+        telemetry().increment('alarm.received')
+        if outcome == SHED:
+            # handled as far as the sender is concerned, it must not post the alarm itself
+            self.__log.debug('Shed %s transition of %s', record.newstatus, record.alarm_name)
+        return True
+
+    def stats(self):
+        """ :return: dict with the queue depth and the counts of queued, downgraded, shed and rejected alarms """
+        return {'depth': self.queue.qsize(), 'queue': dict(self.queue.stats)}
+
+    def process(self, env, record, low=False):
+        """
+        :param env: the env tag passed in from vCenter
+        :param record: vcenterdd.alarm.record.AlarmRecord
+        :param low: post the event with priority low, set by the queue when it sheds load
+        """
+        if self.capture:
+            try:
+                capture_alarm(self.capture, env=env, environ=record.to_env(), captured=record.time)
+            except OSError as e:
+                self.__log.warning('Unable to capture alarm to %s: %s', self.capture, e)
+        alarm = VcenterAlarm(env=env, record=record, resolver=self.resolver)
+        decision = DEFAULT_DECISION
+        if self.rules is not None:
+            decision = self.rules.apply(alarm)
+            if decision is None:
+                return
+        if low:
+            decision = decision.downgraded()
+            alarm.decision = decision
+        # metrics and logs are side channels, a failure in either must never cost the event
+        if self.metrics is not None and 'metrics' in decision.destinations:
+            try:
+                self.metrics.record_alarm(alarm)
+            except BaseException as e:
+                self.__log.exception('Exception: %s \n Args: %s', e, e.args)
+        if self.shipper is not None and 'logs' in decision.destinations:
+            try:
+                self.shipper.submit(alarm_log_record(alarm))
+            except BaseException as e:
+                self.__log.exception('Exception: %s \n Args: %s', e, e.args)
+        if not self.events or 'events' not in decision.destinations:
+            return
+        self.send(self.rollup.add(self.coalescer.add(alarm)))
+
+    def send(self, ready):
+        """
+        Format and post alarms released by the coalescer and the rollup
+        :param ready: list of (alarm or StormSummary, timeline)
+        :return: None
+        """
+        for alarm, timeline in ready:
+            try:
+                format_alarm(alarm, timeline)
+                self.__log.info("Sending JSON Data: \n%s", alarm.datadog_format.__str__())
+                if self.sinks is not None:
+                    # each sink posts on its own worker, the pipeline moves on to the next alarm right away
+                    self.sinks.submit(alarm.datadog_format)
+                else:
+                    post_or_spool(self.datadog, self.outbox, alarm.datadog_format, lifecycle=self.lifecycle)
+            except BaseException as e:
+                self.__log.exception('Exception: %s \n Args: %s', e, e.args)
+
+    def _next_due(self):
+        due = [d for d in (self.coalescer.next_due(), self.rollup.next_due()) if d is not None]
+        return min(due) if due else None
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self._next_due())
+            except queue.Empty:
+                self.send(self.rollup.add(self.coalescer.due()))
+                continue
+            try:
+                if item is self._stop:
+                    self.send(self.rollup.add(self.coalescer.flush()) + self.rollup.flush())
+                    return
+                self.process(*item)
+            except BaseException as e:
+                self.__log.exception('Exception: %s \n Args: %s', e, e.args)
@@ -0,0 +1,213 @@
+"""
+Priority queue of alarms waiting for the pipeline worker, with aging and load shedding.
+
+Every alarm gets a deadline when it is queued: its arrival time plus a delay for its alert type (and any
+adjustment configured for its alarm name). The worker always takes the alarm with the earliest deadline, so a Red
+host-down alarm overtakes the Yellow and Green backlog, while an alarm that has waited longer than the difference in
+delays goes first again: nothing starves. Transitions of the same alarm keep their arrival order.
+
+Under pressure (the queue is filled beyond shed_above, or the Datadog rate budget is exhausted) low value
+transitions, Green and Gray, are sampled: shed_sample of them are kept and posted with priority low, the others are
+shed. A full queue evicts its least urgent alarm for a more urgent one and rejects the new alarm otherwise. Every
+decision is counted in stats and in the vcenterdd.queue.shed counter.
+
+The queue is configured from the "queue" section of the rules file:
+
+    queue:
+      delays: {error: 0, warning: 10, info: 30, success: 30}   # seconds, per alert type
+      alarm_names: {alarm.HostConnectionLostAlarm: -30}         # added to the delay of these alarms
+      shed_above: 0.8
+      shed_sample: 0.1
+"""
+import time
+import heapq
+import queue
+import random
+import threading
+import collections
+from vcenterdd.telemetry.statsd import telemetry
+
+QUEUED = 'queued'
+DOWNGRADED = 'downgraded'
+SHED = 'shed'
+REJECTED = 'rejected'
+
+# alert type VcenterAlarm derives from the new status
+STATUS_ALERT_TYPES = {'red': 'error', 'yellow': 'warning', 'green': 'success'}
+DEFAULT_DELAYS = {'error': 0.0, 'warning': 10.0, 'info': 30.0, 'success': 30.0}
+# transitions that are sampled and downgraded under pressure
+LOW_VALUE = frozenset(('success', 'info'))
+CONFIG_KEYS = frozenset(('delays', 'alarm_names', 'shed_above', 'shed_sample'))
+
+
+def alert_type(record):
+    """ :return: the alert type of an AlarmRecord, the same mapping VcenterAlarm uses """
+    return STATUS_ALERT_TYPES.get((record.newstatus or '').lower(), 'info')
+
+
+class _Entry(object):
+    __slots__ = ('deadline', 'seq', 'key', 'alert_type', 'item', 'low', 'live')
+
+    def __init__(self, deadline, seq, key, alert_type, item, low):
+        self.deadline = deadline
+        self.seq = seq
+        self.key = key
+        self.alert_type = alert_type
+        self.item = item
+        self.low = low
+        self.live = True
+
+    def __lt__(self, other):
+        return (self.deadline, self.seq) < (other.deadline, other.seq)
+
+
+class PriorityAlarmQueue(object):
+
+    def __init__(self, maxsize=10000, delays=None, alarm_names=None, shed_above=0.8, shed_sample=0.1,
+                 saturated=None, rng=random.random, clock=time.monotonic):
+        """
+        :param maxsize: alarms held before the least urgent one is evicted or the new one rejected
+        :param delays: dict of alert type to seconds it yields to more urgent work, merged over DEFAULT_DELAYS
+        :param alarm_names: dict of alarm name to seconds added to its delay, negative to raise its priority
+        :param shed_above: share of maxsize at which low value transitions are sampled
+        :param shed_sample: share of low value transitions kept (and downgraded) while shedding
+        :param saturated: callable returning True while the Datadog rate budget is exhausted
+        :param rng: callable returning a float in [0, 1), used for sampling
+        :param clock: monotonic clock the deadlines are based on
+        """
+        self.maxsize = maxsize
+        self.delays = dict(DEFAULT_DELAYS, **(delays or {}))
+        self.alarm_names = dict(alarm_names or {})
+        self.shed_above = shed_above
+        self.shed_sample = shed_sample
+        self.saturated = saturated
+        self.rng = rng
+        self.clock = clock
+        self.stats = collections.Counter()
+        self._heap = []
+        # the same entries keyed on (-deadline, -seq), the least urgent one is found in O(log n) when full. Entries
+        # taken or evicted stay in both heaps until they surface (or the heap is compacted), live tells them apart
+        self._worst = []
+        self._size = 0
+        self._seq = 0
+        self._last = {}
+        self._tail = []
+        self._cond = threading.Condition()
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        """
+        :param config: the "queue" section of the rules file, or None for the defaults
+        :param kwargs: passed to the constructor, the config takes precedence
+        """
+        config = config or {}
+        unknown = set(config) - CONFIG_KEYS
+        if unknown:
+            raise ValueError('Unknown queue settings {}'.format(sorted(unknown)))
+        kwargs.update(config)
+        return cls(**kwargs)
+
+    def qsize(self):
+        with self._cond:
+            return self._size + len(self._tail)
+
+    def _count(self, outcome, alert_type):
+        self.stats[outcome] += 1
+        self.stats['{}:{}'.format(outcome, alert_type)] += 1
+        if outcome != QUEUED:
+            telemetry().increment('queue.shed', tags=('outcome:{}'.format(outcome),
+                                                      'alert_type:{}'.format(alert_type)))
+
+    def _under_pressure(self):
+        if self._size >= self.maxsize * self.shed_above:
+            return True
+        return self.saturated is not None and self.saturated()
+
+    def put(self, env, record):
+        """
+        Queue an alarm, never blocks
+        :param env: the env tag passed in from vCenter
+        :param record: vcenterdd.alarm.record.AlarmRecord
+        :return: QUEUED, DOWNGRADED (queued, to be posted with priority low), SHED or REJECTED
+        """
+        kind = alert_type(record)
+        key = (env, record.alarm_name, record.target_id or record.target_name)
+        with self._cond:
+            low = False
+            if kind in LOW_VALUE and self._under_pressure():
+                if self.rng() >= self.shed_sample:
+                    self._count(SHED, kind)
+                    return SHED
+                low = True
+            deadline = self.clock() + self.delays.get(kind, self.delays['info']) + \
+                self.alarm_names.get(record.alarm_name, 0.0)
+            last = self._last.get(key)
+            if last is not None and last.live and last.deadline > deadline:
+                # never overtake an earlier transition of the same alarm
+                deadline = last.deadline
+            self._seq += 1
+            entry = _Entry(deadline, self._seq, key, kind, (env, record), low)
+            if self._size >= self.maxsize:
+                worst = self._least_urgent()
+                if worst is None or not entry < worst:
+                    self._count(REJECTED, kind)
+                    return REJECTED
+                heapq.heappop(self._worst)
+                self._remove(worst)
+                self._count('evicted', worst.alert_type)
+                if len(self._heap) > 2 * self._size + 64:
+                    # drop the evicted entries still sitting in the heap
+                    self._heap = [e for e in self._heap if e.live]
+                    heapq.heapify(self._heap)
+            if len(self._worst) > 2 * self._size + 64:
+                # drop the entries the worker took, they only ever leave this heap when evictions reach them
+                self._worst = [w for w in self._worst if w[2].live]
+                heapq.heapify(self._worst)
+            heapq.heappush(self._heap, entry)
+            heapq.heappush(self._worst, (-entry.deadline, -entry.seq, entry))
+            self._size += 1
+            self._last[key] = entry
+            outcome = DOWNGRADED if low else QUEUED
+            self._count(outcome, kind)
+            self._cond.notify()
+            return outcome
+
+    def put_last(self, item):
+        """ Queue an item (e.g. a stop marker) behind every alarm, bypassing maxsize """
+        with self._cond:
+            self._tail.append(item)
+            self._cond.notify()
+
+    def _least_urgent(self):
+        """ :return: the live entry with the latest deadline, None when empty """
+        while self._worst and not self._worst[0][2].live:
+            heapq.heappop(self._worst)
+        return self._worst[0][2] if self._worst else None
+
+    def _remove(self, entry):
+        entry.live = False
+        self._size -= 1
+        if self._last.get(entry.key) is entry:
+            del self._last[entry.key]
+
+    def get(self, timeout=None):
+        """
+        :param timeout: seconds to wait for an alarm, None waits forever
+        :return: (env, record, low) for alarms, the item itself for items queued with put_last
+        :raises queue.Empty: nothing arrived within timeout
+        """
+        with self._cond:
+            ends = None if timeout is None else time.monotonic() + timeout
+            while True:
+                while self._heap:
+                    entry = heapq.heappop(self._heap)
+                    if entry.live:
+                        self._remove(entry)
+                        env, record = entry.item
+                        return env, record, entry.low
+                if self._tail:
+                    return self._tail.pop(0)
+                remaining = None if ends is None else ends - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self._cond.wait(remaining)
@@ -0,0 +1,102 @@
+import logging
+import os
+import json
+import stat
+import socket
+import socketserver
+from vcenterdd.log.setup import addClassLogger
+from .client import DEFAULT_SOCKET_PATH
+from .exceptions import DaemonSocketError
+
+logger = logging.getLogger(__name__)
+
+
+class _AlarmRequestHandler(socketserver.StreamRequestHandler):
+    """
+    One connection carries one JSON encoded alarm (or a {"command": "stats"} request), see
+    vcenterdd.daemon.client.ForwarderClient
+    """
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # a connection closed without a request, e.g. another daemon checking whether this one is alive
+            return
+        try:
+            request = json.loads(line.decode())
+            if request.get('command') == 'stats':
+                response = self.server.daemon.pipeline.stats()
+            else:
+                queued = self.server.daemon.pipeline.submit(env=request['env'], environ=request['alarm'])
+                response = {'status': 'queued' if queued else 'rejected'}
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning('Invalid alarm request: %s', e)
+            response = {'status': 'invalid'}
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class _ThreadingUnixStreamServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+@addClassLogger
+class ForwarderDaemon(object):
+    """
+    Long running forwarder. Listens on a Unix domain socket for alarms sent by datadog_alarm.py and hands them
+    to an AlarmPipeline which keeps a single Datadog instance (session, decrypted config) warm between alarms.
+    """
+
+    def __init__(self, pipeline, socket_path=DEFAULT_SOCKET_PATH, socket_mode=0o660):
+        self.pipeline = pipeline
+        self.socket_path = socket_path
+        self.socket_mode = socket_mode
+        self.server = None
+
+    def __prepare_socket_path(self):
+        os.makedirs(os.path.dirname(self.socket_path) or '.', exist_ok=True)
+        try:
+            mode = os.stat(self.socket_path).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            raise DaemonSocketError('{} exists and is not a socket'.format(self.socket_path))
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except ConnectionRefusedError:
+            # stale socket from a previous run, nothing is listening on it any more
+            self.__log.info('Removing stale socket %s', self.socket_path)
+            os.unlink(self.socket_path)
+            return
+        except OSError as e:
+            raise DaemonSocketError('Unable to check socket {}: {}'.format(self.socket_path, e))
+        finally:
+            probe.close()
+        raise DaemonSocketError('Another forwarder daemon is listening on {}'.format(self.socket_path))
+
+    def serve_forever(self):
+        self.__prepare_socket_path()
+        self.server = _ThreadingUnixStreamServer(self.socket_path, _AlarmRequestHandler)
+        self.server.daemon = self
+        os.chmod(self.socket_path, self.socket_mode)
+        self.pipeline.start()
+        self.__log.info('Forwarder daemon listening on %s', self.socket_path)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
+
+    def shutdown(self):
+        """ Stop accepting alarms, must be called from a thread other than the one running serve_forever """
+        if self.server is not None:
+            self.server.shutdown()
+
+    def close(self):
+        if self.server is not None:
+            self.server.server_close()
+            self.server = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        self.__log.info('Draining alarm queue')
+        self.pipeline.stop()
+        self.__log.info('Forwarder daemon stopped')
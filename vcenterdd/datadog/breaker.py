@@ -0,0 +1,186 @@
+"""
+Circuit breaker around a Datadog destination, shared by every process that posts to it.
+
+The breaker state lives in a small JSON file so the one-shot alarm script runs, the daemon and the aggregator on a
+host agree on the health of the endpoint:
+
+    {"state": "open", "failures": 5, "opened_at": 1700000000.0, "probe_at": 0.0}
+
+closed      requests go out, consecutive failures (connection errors, timeouts, 5xx) are counted
+open        after threshold consecutive failures, requests fail immediately without touching the network
+half_open   reset_timeout after opening one process sends a single probe request, its outcome closes the breaker
+            or opens it for another reset_timeout. A probe that never reports back is retried after probe_timeout
+
+Updates are made under an flock of the state file. While the breaker is closed and nothing failed a process only
+re-reads the file every refresh seconds, so the healthy path costs no file I/O per request.
+"""
+import os
+import json
+import time
+import fcntl
+import logging
+from vcenterdd.log.setup import addClassLogger
+from vcenterdd.telemetry.statsd import telemetry
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def _initial_state():
+    return {'state': CLOSED, 'failures': 0, 'opened_at': 0.0, 'probe_at': 0.0}
+
+
+@addClassLogger
+class CircuitBreaker(object):
+
+    def __init__(self, path, name='datadog', threshold=5, reset_timeout=30.0, probe_timeout=None, refresh=1.0,
+                 clock=time.time):
+        """
+        :param path: state file, shared by every process using the same destination
+        :param name: name of the destination, used in logs and telemetry tags
+        :param threshold: consecutive failures that open the breaker
+        :param reset_timeout: seconds the breaker stays open before a probe is allowed
+        :param probe_timeout: seconds after which an unanswered probe is given up, defaults to reset_timeout
+        :param refresh: seconds a closed state read from the file is trusted before it is read again
+        :param clock: wall clock, the state is compared across processes
+        """
+        self.path = path
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.probe_timeout = reset_timeout if probe_timeout is None else probe_timeout
+        self.refresh = refresh
+        self.clock = clock
+        self._state = None
+        self._loaded = 0.0
+
+    @property
+    def state(self):
+        return self._current()['state']
+
+    def _current(self):
+        now = self.clock()
+        if self._state is None or now - self._loaded > self.refresh or self._state['state'] != CLOSED:
+            self._state = self._read()
+            self._loaded = now
+        return self._state
+
+    def _read(self):
+        try:
+            with open(self.path, 'rt') as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+                return self._parse(f.read())
+        except FileNotFoundError:
+            return _initial_state()
+        except OSError as e:
+            # an unreadable state file must not stop delivery
+            self.__log.warning('Unable to read circuit breaker state %s: %s', self.path, e)
+            return _initial_state()
+
+    @staticmethod
+    def _parse(data):
+        try:
+            state = json.loads(data)
+            if state.get('state') in (CLOSED, OPEN, HALF_OPEN):
+                return dict(_initial_state(), **state)
+        except (ValueError, AttributeError):
+            pass
+        return _initial_state()
+
+    def _update(self, change):
+        """
+        Apply change to the state under an exclusive lock of the state file
+        :param change: callable(state, now) modifying the state dict in place, returns a value passed through
+        :return: the value returned by change
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            with os.fdopen(os.dup(fd), 'r+t') as f:
+                state = self._parse(f.read())
+                before = state['state']
+                now = self.clock()
+                result = change(state, now)
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+                f.flush()
+        finally:
+            os.close(fd)
+        self._state = state
+        self._loaded = now
+        if state['state'] != before:
+            self._transition(before, state)
+        return result
+
+    def _transition(self, before, state):
+        telemetry().increment('breaker.transition', tags=('breaker:{}'.format(self.name),
+                                                          'state:{}'.format(state['state'])))
+        if state['state'] == OPEN:
+            self.__log.warning('Circuit breaker %s opened after %s consecutive failures, failing fast for %ss',
+                               self.name, state['failures'], self.reset_timeout)
+        elif state['state'] == HALF_OPEN:
+            self.__log.info('Circuit breaker %s half open, probing the endpoint', self.name)
+        else:
+            self.__log.info('Circuit breaker %s closed, endpoint healthy again (was %s)', self.name, before)
+
+    def allow(self):
+        """
+        :return: True when a request may be sent, False to fail fast. True while half open means the caller owns
+                 the single probe and has to report its outcome with record_success or record_failure
+        """
+        state = self._current()
+        if state['state'] == CLOSED:
+            return True
+        now = self.clock()
+        due = state['opened_at'] + self.reset_timeout if state['state'] == OPEN else \
+            state['probe_at'] + self.probe_timeout
+        if now >= due:
+            try:
+                if self._update(self._claim_probe):
+                    return True
+            except OSError as e:
+                self.__log.warning('Unable to update circuit breaker state %s: %s', self.path, e)
+                return True
+        telemetry().increment('breaker.rejected', tags=('breaker:{}'.format(self.name),))
+        return False
+
+    def _claim_probe(self, state, now):
+        # another process may have claimed the probe or closed the breaker since the state was read
+        if state['state'] == CLOSED:
+            return True
+        if state['state'] == OPEN and now < state['opened_at'] + self.reset_timeout:
+            return False
+        if state['state'] == HALF_OPEN and now < state['probe_at'] + self.probe_timeout:
+            return False
+        state['state'] = HALF_OPEN
+        state['probe_at'] = now
+        return True
+
+    def record_success(self):
+        state = self._current()
+        if state['state'] == CLOSED and not state['failures']:
+            return
+        self._safe_update(self._succeeded)
+
+    def record_failure(self):
+        self._safe_update(self._failed)
+
+    def _safe_update(self, change):
+        try:
+            self._update(change)
+        except OSError as e:
+            self.__log.warning('Unable to update circuit breaker state %s: %s', self.path, e)
+
+    @staticmethod
+    def _succeeded(state, now):
+        state.update(_initial_state())
+
+    def _failed(self, state, now):
+        state['failures'] += 1
+        if state['state'] == HALF_OPEN or (state['state'] == CLOSED and state['failures'] >= self.threshold):
+            state['state'] = OPEN
+            state['opened_at'] = now
@@ -0,0 +1,247 @@
+"""
+Rate limit aware dispatch of Datadog API requests.
+
+Dispatcher sits between Datadog and the AsyncSender:
+  - a TokenBucket paces requests, it is resized from the X-RateLimit-* headers Datadog returns
+  - 429 responses are retried after Retry-After (or X-RateLimit-Reset), 5xx responses and connection errors are
+    retried with exponential backoff and full jitter
+  - a RetryBudget caps retries to a fraction of the recent request volume so a storm can't amplify itself
+  - an optional CircuitBreaker fails requests fast, without a connection attempt, while the endpoint is down
+"""
+import json
+import time
+import random
+import asyncio
+import logging
+import collections
+from email.utils import parsedate_to_datetime
+from vcenterdd.log.setup import addClassLogger
+from vcenterdd.telemetry.statsd import telemetry
+from .exceptions import DatadogConnectionError, DatadogCircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """ Token bucket for asyncio code, not thread safe: use it from a single event loop """
+
+    def __init__(self, rate=100.0, capacity=None, clock=time.monotonic):
+        """
+        :param rate: tokens added per second
+        :param capacity: maximum burst, defaults to one second worth of tokens
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+        self.blocked_until = 0.0
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    async def acquire(self):
+        while True:
+            now = self._refill()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def saturated(self):
+        """ :return: True when a request would have to wait for a token, safe to call from other threads """
+        now = self.clock()
+        if now < self.blocked_until:
+            return True
+        return min(self.capacity, self.tokens + (now - self.updated) * self.rate) < 1
+
+    def update_from_headers(self, headers):
+        """
+        Resize the bucket from Datadog's rate limit headers
+        :param headers: response headers, lower-case names
+        :return: None
+        """
+        try:
+            limit = headers.get('x-ratelimit-limit')
+            period = headers.get('x-ratelimit-period')
+            if limit and period and float(period) > 0:
+                self.capacity = float(limit)
+                self.rate = float(limit) / float(period)
+            remaining = headers.get('x-ratelimit-remaining')
+            if remaining is not None:
+                self._refill()
+                self.tokens = min(self.tokens, float(remaining))
+                reset = headers.get('x-ratelimit-reset')
+                if float(remaining) <= 0 and reset:
+                    self.block_for(float(reset))
+        except ValueError:
+            logger.debug('Ignoring malformed rate limit headers %s', headers)
+
+    def block_for(self, seconds):
+        """ Hold every request for the given number of seconds """
+        self.blocked_until = max(self.blocked_until, self.clock() + seconds)
+        self.tokens = 0.0
+
+
+class RetryBudget(object):
+    """
+    Allows retries up to ratio * requests seen in the last ttl seconds, plus a small floor so single failures
+    are still retried when traffic is low.
+    """
+
+    def __init__(self, ratio=0.2, min_per_second=1.0, ttl=10.0, clock=time.monotonic):
+        self.ratio = ratio
+        self.min_retries = min_per_second * ttl
+        self.ttl = ttl
+        self.clock = clock
+        self._requests = collections.deque()
+        self._retries = collections.deque()
+
+    def _expire(self, now):
+        for events in (self._requests, self._retries):
+            while events and now - events[0] > self.ttl:
+                events.popleft()
+
+    def record_request(self):
+        self._requests.append(self.clock())
+
+    def try_withdraw(self):
+        """ :return: True if a retry is allowed, the retry is counted against the budget """
+        now = self.clock()
+        self._expire(now)
+        if len(self._retries) < self.min_retries + self.ratio * len(self._requests):
+            self._retries.append(now)
+            return True
+        return False
+
+
+def retry_after_seconds(headers, default=None):
+    """ Parse Retry-After (seconds or HTTP date) falling back to X-RateLimit-Reset """
+    value = headers.get('retry-after')
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    reset = headers.get('x-ratelimit-reset')
+    if reset:
+        try:
+            return max(0.0, float(reset))
+        except ValueError:
+            pass
+    return default
+
+
+@addClassLogger
+class Dispatcher(object):
+
+    def __init__(self, sender, bucket=None, budget=None, max_attempts=4, base_delay=0.2, max_delay=30.0,
+                 breaker=None, max_total=None):
+        """
+        :param sender: vcenterdd.datadog.sender.AsyncSender
+        :param bucket: TokenBucket, defaults to 100 requests/s until Datadog tells us the real limit
+        :param budget: RetryBudget
+        :param breaker: vcenterdd.datadog.breaker.CircuitBreaker shared with the other processes posting here
+        :param max_attempts: attempts per request including the first one
+        :param base_delay: first backoff delay in seconds
+        :param max_delay: upper bound for a single backoff or Retry-After wait
+        :param max_total: seconds a request may take with its retries, a retry that would wait past it is not made.
+                          None only bounds the attempts
+        """
+        self.sender = sender
+        self.bucket = bucket or TokenBucket()
+        self.budget = budget or RetryBudget()
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker
+        self.max_total = max_total
+        self.stats = collections.Counter()
+
+    def backoff(self, attempt):
+        """ Exponential backoff with full jitter """
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def post_json(self, path, payload, headers=None):
+        """
+        Post a JSON payload, pacing and retrying as needed
+        :return: the final SenderResponse, raises DatadogConnectionError when every attempt failed to connect
+        """
+        extra = {'Content-Type': 'application/json'}
+        extra.update(headers or {})
+        return await self.post(path, json.dumps(payload).encode(), headers=extra)
+
+    async def post(self, path, body, headers=None):
+        """
+        Post an already encoded body (e.g. compressed), pacing and retrying as needed
+        :return: the final SenderResponse, raises DatadogConnectionError when every attempt failed to connect and
+                 DatadogCircuitOpenError when the circuit breaker is open
+        """
+        self.budget.record_request()
+        started = time.monotonic()
+        attempt = 0
+        breaker = self.breaker
+        while True:
+            if breaker is not None and not breaker.allow():
+                self.stats['fast_failed'] += 1
+                raise DatadogCircuitOpenError('Circuit breaker {} is open, not posting to {}'.format(
+                    breaker.name, path))
+            await self.bucket.acquire()
+            self.stats['attempts'] += 1
+            try:
+                response = await self.sender.request('POST', path, body=body, headers=headers)
+            except DatadogConnectionError as e:
+                if breaker is not None:
+                    breaker.record_failure()
+                delay = self.backoff(attempt)
+                if not self._may_retry(attempt, 'connection error: {}'.format(e), started, delay):
+                    raise
+            else:
+                self.bucket.update_from_headers(response.headers)
+                if breaker is not None:
+                    # 429 and 4xx still prove the endpoint answers, only 5xx counts against it
+                    if response.status_code >= 500:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                if response.status_code == 429:
+                    self.stats['throttled'] += 1
+                    telemetry().increment('datadog.throttled')
+                    delay = min(self.max_delay, retry_after_seconds(response.headers, self.backoff(attempt)))
+                    self.bucket.block_for(delay)
+                    if not self._may_retry(attempt, 'HTTP 429', started, delay):
+                        return response
+                elif response.status_code >= 500:
+                    delay = self.backoff(attempt)
+                    if not self._may_retry(attempt, 'HTTP {}'.format(response.status_code), started, delay):
+                        return response
+                else:
+                    self.stats['completed'] += 1
+                    return response
+            attempt += 1
+            self.stats['retries'] += 1
+            telemetry().increment('datadog.retries')
+            await asyncio.sleep(delay)
+
+    def _may_retry(self, attempt, reason, started, delay):
+        if attempt + 1 >= self.max_attempts or \
+                (self.max_total is not None and time.monotonic() - started + delay > self.max_total):
+            self.stats['gave_up'] += 1
+            telemetry().increment('datadog.gave_up')
+            self.__log.warning('Giving up after %s attempts: %s', attempt + 1, reason)
+            return False
+        if not self.budget.try_withdraw():
+            self.stats['budget_exhausted'] += 1
+            self.__log.warning('Retry budget exhausted, not retrying: %s', reason)
+            return False
+        self.__log.info('Retrying request (%s), attempt %s', reason, attempt + 2)
+        return True
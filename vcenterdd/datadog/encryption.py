@@ -1,7 +1,5 @@
 
 import base64
-from Crypto import Random
-from Crypto.Cipher import AES, PKCS1_OAEP
 from vcenterdd.log.setup import addClassLogger
 
 
@@ -39,71 +37,44 @@ class PKCS7Encoder(object):
         self.__klen = k
         self.offset = offset
 
+    def _padding_length(self, text):
+        """ :return: length of a valid PKCS#7 padding at the end of text (str or bytes), 0 if there is none """
+        if not text:
+            return 0
+        lastch = text[-1] if isinstance(text, bytes) else ord(text[-1])
+        if lastch > self.__klen or lastch == 0:
+            return 0
+        pad = bytes([lastch]) * lastch if isinstance(text, bytes) else chr(lastch) * lastch
+        return lastch if text[-lastch:] == pad else 0
+
     ## @param text The padded text for which the padding is to be removed.
     # @exception ValueError Raised when the input padding is missing or corrupt.
     def decode(self, text):
-        dectext = ''
         if (len(text) % self.__klen) != 0:
             raise Exception('text not %d align' % (self.__klen))
-        lastch = ord(text[-1])
-        if lastch <= self.__klen and lastch != 0:
-            trimlen = lastch
-            textlen = len(text)
-            for i in range(lastch):
-                if ord(text[textlen - i - 1]) != lastch:
-                    trimlen = 0
-                    break
-            if trimlen == 0:
-                dectext = text
-            else:
-                dectext = text[:(textlen - trimlen)]
-        else:
-            dectext = text
-        return dectext
+        trimlen = self._padding_length(text)
+        return text[:len(text) - trimlen] if trimlen else text
 
     def get_bytes(self, text):
-        outbytes = []
-        for c in text:
-            outbytes.append(ord(c))
-        return outbytes
+        return list(map(ord, text))
 
     def get_text(self, inbytes):
-        s = ''
-        for i in inbytes:
-            s += chr((i % 256))
-        return s
+        if not isinstance(inbytes, (bytes, bytearray)):
+            inbytes = bytes(i % 256 for i in inbytes)
+        return inbytes.decode('latin-1')
 
     def __encode_inner(self, text):
         '''
         Pad an input string according to PKCS#7
         if the real text is bits same ,just expand the text
         '''
-        totallen = len(text)
-        passlen = 0
-        enctext = ''
-        if (len(text) % self.__klen) != 0:
-            enctext = text
-            leftlen = self.__klen - (len(text) % self.__klen)
-            lastch = chr(leftlen)
-            enctext += lastch * leftlen
-        else:
-            lastch = ord(text[-1])
-            if lastch <= self.__klen and lastch != 0:
-                trimlen = self.__klen
-                textlen = len(text)
-                for i in range(lastch):
-                    if lastch != ord(text[(textlen - i - 1)]):
-                        trimlen = 0
-                        break
-                if trimlen == 0:
-                    enctext = text
-                else:
-                    enctext = text
-                    enctext += chr(self.__klen) * self.__klen
-            else:
-                enctext = text
-
-        return enctext
+        leftlen = self.__klen - (len(text) % self.__klen)
+        if leftlen != self.__klen:
+            return text + chr(leftlen) * leftlen
+        if self._padding_length(text):
+            # the aligned text already looks padded, add a full block so decode() doesn't strip real data
+            return text + chr(self.__klen) * self.__klen
+        return text
 
     ## @param text The text to encode.
     def encode(self, text):
@@ -118,61 +89,50 @@ class AESCipher(object):
         designed to be used with all AES Cipher Modes.
     """
     def __init__(self):
+        from Crypto import Random
+        from Crypto.Cipher import AES
+
         self.AES_BLOCK_SIZE = AES.block_size
         self.AES_KEY = Random.get_random_bytes(32)
-        self.__log.debug("AES_KEY: {}".format(self.AES_KEY))
-        self.__log.debug("AES_BLOCK_SIZE: {}".format(self.AES_BLOCK_SIZE))
         self.padding = PKCS7Encoder()
         self.decrypted_bytes = None
         self.decrypted_data = None
 
     def encrypt(self, raw, *args, **kwargs):
+        """
+        Key material, plaintext and ciphertext are never written to the log
+        """
+        from Crypto import Random
+        from Crypto.Cipher import AES
+
         try:
             if isinstance(raw, str):
-                self.__log.debug("raw text is 'str'. convert to bytes")
                 tmp = self.padding.encode(raw).encode('utf')
-                self.__log.debug(tmp)
             else:
                 raise ValueError("data to be encrypted is not in 'str' form")
 
-            if kwargs.get('IV' or None):
-                kwargs['IV'] = Random.get_random_bytes(self.AES_BLOCK_SIZE)
-            else:
-                kwargs.update({'IV': Random.get_random_bytes(self.AES_BLOCK_SIZE)})
-
-            self.__log.debug("AES_IV: {}".format(kwargs['IV']))
-            self.__log.debug('IV_Size kwargs: {}'.format(len(kwargs['IV'])))
-            self.__log.debug('Creating AES Cipher')
+            kwargs['IV'] = Random.get_random_bytes(self.AES_BLOCK_SIZE)
             cipher = AES.new(key=self.AES_KEY,
                              mode=AES.MODE_CFB,
                              **kwargs)
-            self.__log.debug('IV_Size cipher: {}'.format(len(cipher.IV)))
             ciphertext = cipher.encrypt(tmp)
-            self.__log.debug("ciphertext: {}".format(ciphertext))
             return base64.b64encode(kwargs['IV'] + ciphertext)
 
         except BaseException as e:
-            self.__log.exception('Exception: {} \n Args: {}'.format(e, e.args))
+            self.__log.exception('Exception: %s \n Args: %s', type(e).__name__, e.args)
             raise e
 
     def decrypt(self, enc, key, *args, **kwargs):
+        from Crypto.Cipher import AES
+
         if key:
             if isinstance(key, str):
                 self.AES_KEY = base64.b64decode(key)
             else:
                 self.AES_KEY = key
-        self.__log.debug("Encrypted text: {}".format(enc))
         enc = base64.b64decode(enc)
 
-        if kwargs.get('IV' or None):
-            kwargs['IV'] = enc[:self.AES_BLOCK_SIZE]
-        else:
-            kwargs.update({'IV': enc[:self.AES_BLOCK_SIZE]})
-        self.__log.debug("AES_IV: {}".format(kwargs['IV']))
-        self.__log.debug('IV_Size: {}'.format(len(kwargs['IV'])))
-        self.__log.debug('Creating AES Cipher')
+        kwargs['IV'] = enc[:self.AES_BLOCK_SIZE]
         cipher = AES.new(self.AES_KEY, AES.MODE_CFB, **kwargs)
-        self.__log.debug('IV_Size: {}'.format(len(cipher.IV)))
-        self.decrypted_bytes = cipher.decrypt(enc[self.AES_BLOCK_SIZE:])
-        ciphertext = self.padding.get_text(self.decrypted_bytes)
-        return self.padding.decode(ciphertext)
+        # the plaintext is returned only, it is not kept on the cipher object
+        return self.padding.decode(self.padding.get_text(cipher.decrypt(enc[self.AES_BLOCK_SIZE:])))
@@ -14,3 +14,14 @@ class DatadogApplicationKeyError(DatadogException):
 
 class DatadogConnectionError(DatadogException):
     pass
+
+
+class DatadogCircuitOpenError(DatadogConnectionError):
+    pass
+
+
+class DatadogHTTPError(DatadogException):
+
+    def __init__(self, *args, response=None):
+        super().__init__(*args)
+        self.response = response
@@ -1,100 +1,155 @@
 
 import logging
 import json
+import asyncio
 import time, datetime
 import os
 import base64
-import requests
 import uuid
+import zlib
+import gzip
 from .exceptions import *
-from .encryption import AESCipher
+from .vault import CredentialVault
+from .sender import AsyncSender
+from .dispatch import Dispatcher, TokenBucket
+from .breaker import CircuitBreaker
+from .logs import SENDER_THREAD_NAME
 from vcenterdd.log.setup import addClassLogger
-from urllib3 import disable_warnings
-from urllib3.exceptions import InsecureRequestWarning
+from vcenterdd.telemetry.statsd import telemetry
 
 
 logger = logging.getLogger(__name__)
 
 
+def compress_body(body, compression='gzip'):
+    """
+    :param body: request body as bytes
+    :param compression: 'gzip', 'deflate' or None
+    :return: (body, headers) with the matching Content-Encoding header
+    """
+    if compression == 'gzip':
+        return gzip.compress(body, compresslevel=6), {'Content-Encoding': 'gzip'}
+    if compression == 'deflate':
+        return zlib.compress(body, 6), {'Content-Encoding': 'deflate'}
+    return body, {}
+
+
 @addClassLogger
 class Datadog(object):
 
-    def __init__(self, config_file):
-        self.__api_key = None
-        self.__application_key = None
+    EVENTS_PATH = 'events'
+    SERIES_PATH = 'series'
+    LOGS_PATH = 'logs'
+
+    def __init__(self, config_file, config=None, max_in_flight=10, timeout=1.0, breaker=None, retry=None):
+        """
+        :param config_file: path to the datadog json config
+        :param config: already parsed config (e.g. from a ConfigSnapshot), config_file is not read when given
+        :param max_in_flight: maximum number of concurrent requests of the async sender
+        :param timeout: seconds allowed per request
+        :param breaker: circuit breaker state file shared by the processes posting to this destination, None
+                        disables the breaker
+        :param retry: dict of Dispatcher retry settings (max_attempts, max_delay, max_total) taking precedence
+                      over the config, e.g. a tight budget for a one-shot run that leaves retries to the outbox
+        """
+        self.__vault = None
         self.datadog_base_url = 'https://api.datadoghq.com/api/v1/'
-        requests.adapters.DEFAULT_RETRIES = 3
-        self.session = requests.Session()
-        self.session.verify = False
-        self.session.headers.update({
-            'Content-type': 'application/json'
-        })
+        self.datadog_logs_url = 'https://http-intake.logs.datadoghq.com/api/v2/'
+        self._session = None
         self.proxies = None
-        disable_warnings(InsecureRequestWarning)
         self.api_response = None
         self.config_file = config_file
-        self.__cipher = AESCipher()
-
-        self.setup_connection(config_file)
-
-    def __get_api_key(self):
-        return self.__decode_key(self.__api_key)
-
-    def __store_api_key(self, api_key):
-        self.__api_key = self.__encode_key(api_key)
-
-    def __get_app_key(self):
-        return self.__decode_key(self.__application_key)
-
-    def __store_app_key(self, app_key):
-        self.__application_key = self.__encode_key(app_key)
-
-    def __encode_key(self, plaintxt):
-        """
-        This is purely obfuscation and not actually secure. but for the purposes for this project, this will do.
-        :param string:
-        :return: encoded string
-        """
-        return self.__cipher.encrypt(plaintxt)
-
-    def __decode_key(self, enc_txt):
-        return self.__cipher.decrypt(key=self.__cipher.AES_KEY, enc=enc_txt)
-
-    def setup_connection(self, config_file):
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.breaker_file = breaker
+        self.retry = dict(retry or {})
+        self.sender = None
+        self.dispatcher = None
+        self.logs_sender = None
+        self.logs_dispatcher = None
+
+        self.setup_connection(config_file, data=config)
+
+    @property
+    def session(self):
+        """ requests session, only created (and requests imported) by the calls that still use it """
+        if self._session is None:
+            import requests
+            from urllib3 import disable_warnings
+            from urllib3.exceptions import InsecureRequestWarning
+
+            self._session = requests.Session()
+            self._session.verify = False
+            self._session.headers.update({
+                'Content-type': 'application/json'
+            })
+            disable_warnings(InsecureRequestWarning)
+        return self._session
+
+    def __auth_headers(self):
+        return self.__vault.api_headers
+
+    def setup_connection(self, config_file, data=None):
         """
         Reads in the config file to get the API Key and App Key and and proxies that may be defined
         :param config_file:
+        :param data: already parsed config data, skips reading config_file
         :return:
         """
         try:
-            if not os.path.exists(config_file):
-                raise FileExistsError('File path {} not found.'.format(config_file))
             self.config_file = config_file
-            self.__log.info('Loading the Datadog config data')
-            with open(config_file) as json_file:
-                data = json.load(json_file)
-                json_file.close()
-            self.__log.debug(data.__str__())
-            if data.get('api_key' or None):
-                self.__store_api_key(data['api_key'])
-            else:
+            if data is None:
+                if not os.path.exists(config_file):
+                    raise FileExistsError('File path {} not found.'.format(config_file))
+                self.__log.info('Loading the Datadog config data')
+                with open(config_file) as json_file:
+                    data = json.load(json_file)
+                    json_file.close()
+                self.__log.debug('Datadog config keys: %s', sorted(data))
+            if not data.get('api_key' or None):
                 raise DatadogApiKeyError("Unable to locate Datadog API Key in file {}".format(config_file))
 
-            if data.get('app_key' or None):
-                self.__store_app_key(data['app_key'])
+            self.__vault = CredentialVault(data['api_key'], app_key=data.get('app_key' or None))
 
             if data.get('proxies' or None):
                 self.proxies = data['proxies']
 
+            # another Datadog site (e.g. datadoghq.eu) or explicit intake urls
+            if data.get('site' or None):
+                self.datadog_base_url = 'https://api.{}/api/v1/'.format(data['site'])
+                self.datadog_logs_url = 'https://http-intake.logs.{}/api/v2/'.format(data['site'])
+            self.datadog_base_url = data.get('api_url', self.datadog_base_url)
+
+            self.sender = AsyncSender(self.datadog_base_url, proxies=self.proxies,
+                                      max_in_flight=data.get('max_in_flight', self.max_in_flight),
+                                      timeout=data.get('timeout', self.timeout))
+            bucket = TokenBucket(rate=data['rate_limit']) if data.get('rate_limit' or None) else None
+            breaker = None
+            if self.breaker_file and data.get('breaker_threshold', 5):
+                breaker = CircuitBreaker(self.breaker_file, name=data.get('name', 'datadog'),
+                                         threshold=data.get('breaker_threshold', 5),
+                                         reset_timeout=data.get('breaker_reset', 30.0))
+            retry = dict({'max_attempts': data.get('max_attempts', 4), 'max_delay': data.get('max_retry_delay', 30.0),
+                          'max_total': data.get('max_retry_total')}, **self.retry)
+            self.dispatcher = Dispatcher(self.sender, bucket=bucket, breaker=breaker, **retry)
+            # the logs intake lives on its own host, it gets its own connection pool and rate limit
+            self.datadog_logs_url = data.get('logs_url', self.datadog_logs_url)
+            self.logs_sender = AsyncSender(self.datadog_logs_url, proxies=self.proxies,
+                                           max_in_flight=data.get('max_in_flight', self.max_in_flight),
+                                           timeout=data.get('logs_timeout', 5.0), thread_name=SENDER_THREAD_NAME)
+            self.logs_dispatcher = Dispatcher(self.logs_sender, max_attempts=data.get('max_attempts', 4),
+                                              max_delay=data.get('max_retry_delay', 30.0))
+
         except BaseException as e:
-            self.__log.exception('Exception: {} \n Args: {}'.format(e, e.args))
+            self.__log.exception('Exception: %s \n Args: %s', e, e.args)
             raise e
 
     def post_event(self, title, text, date_happened=datetime.datetime.now(), priority='normal', host='', tags=None,
                    alert_type='info', aggregation_key='', source_type_name='', related_event_id='',
                    device_name=''):
         """
-        This method is matching that of the Datadog API documentation
+        This method is matching that of the Datadog API documentation. Synchronous wrapper around post_event_async,
+        the request is sent over the pooled connections of the sender.
         :param title: required parameter
         :param text: required parameter
         :param date_happened: required parameter, defaults to datetime.now()
@@ -106,46 +161,109 @@ class Datadog(object):
         :param source_type_name:
         :param related_event_id:
         :param device_name:
-        :return:
+        :return: id of the created event, None when the response did not carry one
+        """
+        started = time.perf_counter()
+        status = 'failure'
+        try:
+            json_payload = self.build_event_payload(title, text, date_happened=date_happened, priority=priority,
+                                                    host=host, tags=tags, alert_type=alert_type,
+                                                    aggregation_key=aggregation_key,
+                                                    source_type_name=source_type_name,
+                                                    related_event_id=related_event_id, device_name=device_name)
+            self.api_response = self.sender.run(
+                self.dispatcher.post_json(self.EVENTS_PATH, json_payload, headers=self.__auth_headers()))
+            self.validate_api_response()
+            status = 'success'
+            return self.event_id(self.api_response)
+
+        except DatadogCircuitOpenError as e:
+            # an outage is already logged by the breaker, no traceback for every event failing fast
+            status = 'circuit_open'
+            self.__log.warning('Not posting event %s: %s', title, e)
+            raise e
+        except BaseException as e:
+            self.__log.exception('Exception: %s \n Args: %s', e, e.args)
+            raise e
+        finally:
+            telemetry().timing('datadog.post', time.perf_counter() - started, tags=('status:{}'.format(status),))
+
+    async def post_event_async(self, **kwargs):
+        """
+        Post an event on the caller's event loop (paced and retried by the dispatcher), takes the same arguments
+        as post_event
+        :return: SenderResponse, raises DatadogHTTPError for error responses
         """
+        started = time.perf_counter()
+        status = 'failure'
         try:
+            response = await self.dispatcher.post_json(self.EVENTS_PATH, self.build_event_payload(**kwargs),
+                                                       headers=self.__auth_headers())
+            response.raise_for_status()
+            status = 'success'
+            return response
+        finally:
+            telemetry().timing('datadog.post', time.perf_counter() - started, tags=('status:{}'.format(status),))
 
-            json_payload = {
-                'title': "{}".format(title),
-                'text': "{}".format(text),
-                'date_happened': self._convert_to_epoch(date_happened),
-            }
-            if priority:
-                json_payload.update({'priority': "{}".format(priority)})
+    @staticmethod
+    def event_id(response):
+        """
+        :param response: SenderResponse of an event post
+        :return: id of the created event or None
+        """
+        try:
+            return response.json().get('event', {}).get('id')
+        except (ValueError, AttributeError):
+            return None
 
-            if host:
-                json_payload.update({'host': "{}".format(host)})
+    async def post_events_async(self, events):
+        """
+        Post many events concurrently, bounded by the sender's max_in_flight
+        :param events: list of post_event keyword argument dicts
+        :return: list of SenderResponse or exception per event, in order
+        """
+        return await asyncio.gather(*[self.post_event_async(**e) for e in events], return_exceptions=True)
 
-            if tags:
-                json_payload.update({'tags': tags})
+    def post_events(self, events):
+        """ Synchronous wrapper around post_events_async """
+        return self.sender.run(self.post_events_async(events))
 
-            if alert_type:
-                json_payload.update({'alert_type': "{}".format(alert_type)})
+    def build_event_payload(self, title, text, date_happened=None, priority='normal', host='', tags=None,
+                            alert_type='info', aggregation_key='', source_type_name='', related_event_id='',
+                            device_name=''):
+        """ Build the JSON body of an events request, see post_event """
+        if date_happened is None:
+            date_happened = datetime.datetime.now()
+        json_payload = {
+            'title': "{}".format(title),
+            'text': "{}".format(text),
+            'date_happened': self._convert_to_epoch(date_happened),
+        }
+        if priority:
+            json_payload.update({'priority': "{}".format(priority)})
 
-            if aggregation_key:
-                json_payload.update({'aggregation_key': "{}".format(aggregation_key)})
+        if host:
+            json_payload.update({'host': "{}".format(host)})
 
-            if source_type_name:
-                json_payload.update({'source_type_name': "{}".format(source_type_name)})
+        if tags:
+            json_payload.update({'tags': tags})
 
-            if related_event_id:
-                json_payload.update({'related_event_id': related_event_id})
+        if alert_type:
+            json_payload.update({'alert_type': "{}".format(alert_type)})
 
-            if device_name:
-                json_payload.update({'device_name': "{}".format(device_name)})
+        if aggregation_key:
+            json_payload.update({'aggregation_key': "{}".format(aggregation_key)})
 
-            url = "{}{}".format(self.datadog_base_url, 'events?api_key={}'.format(self.__get_api_key()))
-            self.api_response = self.session.post(url=url, json=json_payload, timeout=1.0, proxies=self.proxies)
-            self.validate_api_response()
+        if source_type_name:
+            json_payload.update({'source_type_name': "{}".format(source_type_name)})
 
-        except BaseException as e:
-            self.__log.exception('Exception: {} \n Args: {}'.format(e, e.args))
-            raise e
+        if related_event_id:
+            json_payload.update({'related_event_id': related_event_id})
+
+        if device_name:
+            json_payload.update({'device_name': "{}".format(device_name)})
+
+        return json_payload
 
     @staticmethod
     def _convert_to_epoch(date_time):
@@ -154,73 +272,84 @@ class Datadog(object):
 
         raise TypeError("date_time parameter must be type 'datetime.datetime'")
 
-    def post_metric(self, json_data):
+    def post_metric(self, json_data, compression='gzip'):
         """
-        Work in progress, not production ready
-        :param json_data:
+        Submit timeseries points, see https://docs.datadoghq.com/api/?lang=bash#post-timeseries-points
+        The request body is compressed, use vcenterdd.datadog.metrics.MetricsBuffer to batch points.
+        :param json_data: dict with a 'series' list
+        :param compression: 'gzip', 'deflate' or None
         :return:
         """
         try:
             if not self.validate_metric_json(json_data):
                 raise ValueError("metric json_data must contain valid data. \n"
                                  "See documentation at https://docs.datadoghq.com/api/?lang=bash#post-timeseries-points")
-            url = "{}{}".format(self.datadog_base_url, 'series?api_key={}'.format(self._get_api_key()))
-            self.api_response = self.session.post(url=url, data=json_data)
+            self.api_response = self.sender.run(self.post_metric_async(json_data, compression=compression))
             self.validate_api_response()
 
         except BaseException as e:
-            self.__log.exception('Exception: {} \n Args: {}'.format(e, e.args))
+            self.__log.exception('Exception: %s \n Args: %s', e, e.args)
             raise e
 
-    def post_logs(self, method, data, tags=None):
+    async def post_metric_async(self, json_data, compression='gzip'):
+        """ Post a series payload on the caller's event loop, see post_metric """
+        body, headers = compress_body(json.dumps(json_data).encode(), compression)
+        headers.update({'Content-Type': 'application/json'})
+        headers.update(self.__auth_headers())
+        return await self.dispatcher.post(self.SERIES_PATH, body, headers=headers)
+
+    def post_logs(self, data, tags=None, compression='gzip'):
         """
-        Work in progress, not production ready
-        :param method:
-        :param data:
-        :param tags:
+        Send log records to the logs intake, see https://docs.datadoghq.com/api/latest/logs/#send-logs
+        Use vcenterdd.datadog.logs.LogShipper to batch records within the intake limits.
+        :param data: list of log record dicts
+        :param tags: tags added to every record (ddtags)
+        :param compression: 'gzip', 'deflate' or None
         :return:
         """
         try:
-            if method.lower() == 'post':
-                url = "{}{}".format(self.datadog_base_url, 'input?api_key={}'.format(self._get_api_key()))
-                self.api_response = self.session.get(url=url)
-
-                self.validate_api_response()
+            self.api_response = self.logs_sender.run(self.post_logs_async(data, tags=tags, compression=compression))
+            self.validate_api_response()
 
         except BaseException as e:
-            self.__log.exception('Exception: {} \n Args: {}'.format(e, e.args))
+            self.__log.exception('Exception: %s \n Args: %s', e, e.args)
             raise e
 
+    async def post_logs_async(self, data, tags=None, compression='gzip'):
+        """ Post log records on the caller's event loop, see post_logs """
+        if tags:
+            extra = ','.join(tags)
+            data = [dict(r, ddtags='{},{}'.format(r['ddtags'], extra) if r.get('ddtags') else extra) for r in data]
+        body, headers = compress_body(json.dumps(data).encode(), compression)
+        headers.update({'Content-Type': 'application/json'})
+        headers.update(self.__auth_headers())
+        return await self.logs_dispatcher.post(self.LOGS_PATH, body, headers=headers)
+
+    def close(self):
+        for sender in (self.sender, self.logs_sender):
+            if sender is not None:
+                sender.close()
+
     @staticmethod
-    def validate_metric_json(self, json_data):
-        if json_data.get('series' or None):
-            series = json_data['series']
-            # validate required parameters
-            if series.get('metric' or None) and series.get('points' or None):
-                if isinstance(series['points'], list):
-                    # points should be a list of lists
-                    for val in series['points']:
-                        if not isinstance(val, list):
-                            break
-
-                    return True
-        return False
+    def validate_metric_json(json_data):
+        series = json_data.get('series' or None) if isinstance(json_data, dict) else None
+        if not series or not isinstance(series, list):
+            return False
+        for metric in series:
+            # validate required parameters, points should be a list of [timestamp, value] lists
+            if not metric.get('metric' or None) or not isinstance(metric.get('points' or None), list):
+                return False
+            for val in metric['points']:
+                if not isinstance(val, (list, tuple)) or len(val) != 2:
+                    return False
+        return True
 
     def validate_api_response(self):
         self.__log.info('Validating api response')
-        self.__log.debug("HTTP Response: {}".format(self.api_response.status_code))
+        self.__log.debug("HTTP Response: %s", self.api_response.status_code)
         try:
             self.api_response.raise_for_status()
             self.__log.info('API Response OK')
-        except requests.exceptions.HTTPError as e:
-            self.__log.exception('Exception: {}'.format(e))
+        except BaseException as e:
+            self.__log.exception('Exception: %s', e)
             raise e
-
-
-
-
-
-
-
-
-
@@ -0,0 +1,188 @@
+"""
+Batched log shipping to the Datadog logs intake.
+
+LogShipper buffers structured records (alarms and the forwarder's own diagnostics) in a bounded deque and sends
+them from a background thread in gzip-compressed batches that respect the intake limits: at most 1000 records and
+5MB (uncompressed) per request, 1MB per record. Producers only append to the deque, they never wait on the network.
+"""
+import json
+import socket
+import logging
+import threading
+import collections
+from vcenterdd.log.setup import addClassLogger
+from vcenterdd.alarm.record import ENV_PREFIX
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_RECORDS = 1000
+MAX_BATCH_BYTES = 5 * 1024 * 1024
+MAX_RECORD_BYTES = 1024 * 1024
+SHIPPER_THREAD_NAME = 'datadog-logs'
+SENDER_THREAD_NAME = 'datadog-logs-sender'
+# loggers of the code that delivers the logs, their records would feed back into the shipper
+DELIVERY_LOGGERS = ('vcenterdd.datadog',)
+
+ALERT_TYPE_STATUS = {'error': 'error', 'warning': 'warn', 'success': 'ok', 'info': 'info'}
+
+
+def alarm_log_record(alarm, service='vcenterdd', source='vsphere', hostname=None):
+    """
+    Structured log record of an alarm transition
+    :param alarm: VcenterAlarm
+    :return: dict
+    """
+    # VcenterAlarm is slotted, its fields come from the record rather than an instance dict
+    fields = {k: v for k, v in alarm.template_fields().items() if v and k not in ('name', 'env')}
+    fields['alert_type'] = alarm.alert_type
+    for name, value in (alarm.record.extra or {}).items():
+        fields.setdefault(name[len(ENV_PREFIX):].lower(), value)
+    return {
+        'ddsource': source,
+        'service': service,
+        'hostname': hostname or socket.gethostname(),
+        'ddtags': ','.join(t for t in (alarm.env, 'app:vsphere') if t),
+        'status': ALERT_TYPE_STATUS.get(alarm.alert_type, 'info'),
+        'message': getattr(alarm, 'eventdescription', alarm.name),
+        'date': int(alarm.date_time.timestamp() * 1000),
+        'alarm': fields,
+    }
+
+
+@addClassLogger
+class LogShipper(object):
+
+    def __init__(self, datadog, flush_interval=5.0, max_buffer=10000, max_batch_records=MAX_BATCH_RECORDS,
+                 max_batch_bytes=MAX_BATCH_BYTES, max_record_bytes=MAX_RECORD_BYTES, compression='gzip'):
+        """
+        :param datadog: vcenterdd.datadog.handle.Datadog
+        :param flush_interval: maximum seconds a record waits in the buffer
+        :param max_buffer: records held in memory, the oldest are dropped (and counted) when it is full
+        """
+        self.datadog = datadog
+        self.flush_interval = flush_interval
+        self.max_batch_records = max_batch_records
+        self.max_batch_bytes = max_batch_bytes
+        self.max_record_bytes = max_record_bytes
+        self.compression = compression
+        self.buffer = collections.deque(maxlen=max_buffer)
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def submit(self, record):
+        """ Queue a record, never blocks """
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append(record)
+        if len(self.buffer) >= self.max_batch_records:
+            self._wakeup.set()
+
+    def _encode(self, record):
+        """ :return: (record, encoded size), record is None when it can't be made to fit the per-record limit """
+        data = json.dumps(record, default=str).encode()
+        if len(data) > self.max_record_bytes:
+            # keep the record but cut the message (at most 4 bytes per character) to fit the per-record limit
+            record = {k: v for k, v in record.items() if k != 'alarm'}
+            record.update(message=str(record.get('message', ''))[:self.max_record_bytes // 8], truncated=True)
+            data = json.dumps(record, default=str).encode()
+            if len(data) > self.max_record_bytes:
+                return None, 0
+        return record, len(data)
+
+    def next_batch(self):
+        """ :return: list of records for one request, within the count and size limits """
+        batch = []
+        size = 2
+        while self.buffer and len(batch) < self.max_batch_records:
+            record, length = self._encode(self.buffer[0])
+            if record is None:
+                self.buffer.popleft()
+                self.dropped += 1
+                continue
+            if batch and size + length + 1 > self.max_batch_bytes:
+                break
+            self.buffer.popleft()
+            batch.append(record)
+            size += length + 1
+        return batch
+
+    def flush(self):
+        """ Send everything buffered, returns the number of records sent """
+        sent = 0
+        while self.buffer:
+            batch = self.next_batch()
+            if not batch:
+                break
+            try:
+                self.datadog.post_logs(batch, compression=self.compression)
+            except BaseException as e:
+                self.failed += len(batch)
+                self.__log.warning('Dropped %s log records: %s', len(batch), e)
+                continue
+            sent += len(batch)
+        self.sent += sent
+        return sent
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=SHIPPER_THREAD_NAME, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+class DatadogLogHandler(logging.Handler):
+    """
+    logging handler forwarding the forwarder's own diagnostics through a LogShipper. Records of the loggers under
+    exclude are ignored, whichever thread emits them, so failures to deliver logs (or events over the same
+    connections) can't feed back into the shipper. They still reach the local log files.
+    """
+
+    def __init__(self, shipper, service='vcenterdd', source='python', hostname=None, level=logging.WARNING,
+                 exclude=DELIVERY_LOGGERS):
+        """
+        :param shipper: LogShipper
+        :param exclude: names of the loggers, with their children, whose records aren't shipped
+        """
+        super().__init__(level=level)
+        self.shipper = shipper
+        self.service = service
+        self.source = source
+        self.hostname = hostname or socket.gethostname()
+        self.exclude = tuple(exclude)
+
+    def excluded(self, name):
+        return any(name == prefix or name.startswith(prefix + '.') for prefix in self.exclude)
+
+    def emit(self, record):
+        if self.excluded(record.name):
+            return
+        try:
+            self.shipper.submit({
+                'ddsource': self.source,
+                'service': self.service,
+                'hostname': self.hostname,
+                'status': record.levelname.lower(),
+                'message': self.format(record),
+                'logger': {'name': record.name, 'thread_name': record.threadName},
+                'date': int(record.created * 1000),
+            })
+        except Exception:
+            self.handleError(record)
@@ -0,0 +1,155 @@
+"""
+Alarm state time series.
+
+Every alarm transition is turned into points:
+    vsphere.alarm.status       gauge, 0 green / 1 yellow / 2 red / -1 gray (unknown)
+    vsphere.alarm.transitions  count of transitions per alarm and target
+Points are buffered by MetricsBuffer and submitted to the series endpoint in large compressed batches, one POST
+per flush interval instead of one HTTP call per alarm.
+"""
+import time
+import logging
+import threading
+import collections
+from vcenterdd.log.setup import addClassLogger
+
+logger = logging.getLogger(__name__)
+
+STATUS_METRIC = 'vsphere.alarm.status'
+TRANSITIONS_METRIC = 'vsphere.alarm.transitions'
+STATUS_VALUES = {'green': 0, 'yellow': 1, 'red': 2, 'gray': -1}
+
+
+def alarm_tags(alarm):
+    """ :return: tags of the alarm series """
+    tags = ['alarm_name:{}'.format(getattr(alarm, 'alarm_name', None)),
+            'target:{}'.format(getattr(alarm, 'target_name', None))]
+    if alarm.env:
+        tags.append(alarm.env)
+    return tags
+
+
+@addClassLogger
+class MetricsBuffer(object):
+    """
+    Thread safe buffer of gauge points and counters. The number of series is bounded by max_series, points of
+    new series are dropped (and counted) once the limit is reached until the next flush.
+    """
+
+    def __init__(self, datadog, flush_interval=10.0, max_series=50000, max_points_per_series=60,
+                 series_per_request=1000, compression='gzip', host=None):
+        """
+        :param datadog: vcenterdd.datadog.handle.Datadog used to submit the series
+        :param flush_interval: seconds between flushes when started with start()
+        :param max_series: maximum number of distinct series held between flushes
+        :param max_points_per_series: only the latest points of a gauge are kept
+        :param series_per_request: series per POST to the series endpoint
+        :param compression: 'gzip', 'deflate' or None
+        :param host: host reported with the series
+        """
+        self.datadog = datadog
+        self.flush_interval = flush_interval
+        self.max_series = max_series
+        self.max_points_per_series = max_points_per_series
+        self.series_per_request = series_per_request
+        self.compression = compression
+        self.host = host
+        self.dropped = 0
+        self._gauges = {}
+        self._counts = collections.Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _has_room(self, key):
+        return key in self._gauges or key in self._counts or len(self._gauges) + len(self._counts) < self.max_series
+
+    def gauge(self, metric, value, tags=None, timestamp=None):
+        key = (metric, tuple(tags or ()))
+        with self._lock:
+            if not self._has_room(key):
+                self.dropped += 1
+                return
+            points = self._gauges.get(key)
+            if points is None:
+                points = self._gauges[key] = collections.deque(maxlen=self.max_points_per_series)
+            points.append([int(timestamp or time.time()), value])
+
+    def increment(self, metric, value=1, tags=None):
+        key = (metric, tuple(tags or ()))
+        with self._lock:
+            if not self._has_room(key):
+                self.dropped += 1
+                return
+            self._counts[key] += value
+
+    def record_alarm(self, alarm):
+        """
+        Record the points of an alarm transition
+        :param alarm: VcenterAlarm
+        :return: None
+        """
+        tags = alarm_tags(alarm)
+        status = STATUS_VALUES.get((getattr(alarm, 'newstatus', None) or '').lower(), -1)
+        timestamp = time.mktime(alarm.date_time.timetuple())
+        self.gauge(STATUS_METRIC, status, tags=tags, timestamp=timestamp)
+        self.increment(TRANSITIONS_METRIC, tags=tags)
+
+    def drain(self):
+        """ :return: list of series dicts and reset the buffer """
+        now = int(time.time())
+        with self._lock:
+            gauges, self._gauges = self._gauges, {}
+            counts, self._counts = self._counts, collections.Counter()
+        series = []
+        for (metric, tags), points in gauges.items():
+            series.append(self._series(metric, list(points), 'gauge', tags))
+        for (metric, tags), value in counts.items():
+            entry = self._series(metric, [[now, value]], 'count', tags)
+            if self.flush_interval:
+                entry['interval'] = int(self.flush_interval)
+            series.append(entry)
+        return series
+
+    def _series(self, metric, points, metric_type, tags):
+        entry = {'metric': metric, 'points': points, 'type': metric_type, 'tags': list(tags)}
+        if self.host:
+            entry['host'] = self.host
+        return entry
+
+    def flush(self):
+        """
+        Submit everything buffered, in batches of series_per_request
+        :return: number of series submitted
+        """
+        series = self.drain()
+        for i in range(0, len(series), self.series_per_request):
+            self.datadog.post_metric({'series': series[i:i + self.series_per_request]},
+                                     compression=self.compression)
+        if series:
+            self.__log.info('Submitted %s series', len(series))
+        return len(series)
+
+    def start(self):
+        if self._thread is None and self.flush_interval:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """ Stop the flush thread and submit what is left """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self._safe_flush()
+
+    def _safe_flush(self):
+        try:
+            self.flush()
+        except BaseException as e:
+            self.__log.exception('Exception: %s \n Args: %s', e, e.args)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self._safe_flush()
@@ -0,0 +1,360 @@
+"""
+Asyncio HTTP sender with a pool of keep-alive connections.
+
+The sender speaks plain HTTP/1.1 over asyncio streams so no extra dependency is needed on the vCenter appliance.
+Connections (including proxy CONNECT tunnels) are kept open and reused between requests, the number of requests in
+flight is bounded by a semaphore. Synchronous code uses run(), which executes a coroutine on a background event
+loop owned by the sender so the pool survives between calls.
+"""
+import ssl
+import json
+import time
+import socket
+import asyncio
+import logging
+import threading
+import base64
+import collections
+from urllib.parse import urlsplit, unquote
+from vcenterdd.log.setup import addClassLogger
+from .exceptions import DatadogConnectionError, DatadogHTTPError
+
+logger = logging.getLogger(__name__)
+
+
+class SenderResponse(object):
+    """ Minimal response object, mirrors the parts of requests.Response used by this package """
+
+    def __init__(self, url, status_code, reason, headers, content, latency):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+        self.latency = latency
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise DatadogHTTPError('{} {} for url: {}'.format(self.status_code, self.reason, self.url), response=self)
+
+    def __repr__(self):
+        return '<SenderResponse [{}]>'.format(self.status_code)
+
+
+class _Connection(object):
+    __slots__ = ('reader', 'writer', 'used', 'written', 'received')
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.used = time.monotonic()
+        # progress of the current exchange, decides whether a failed request may be retried
+        self.written = False
+        self.received = False
+
+    def close(self):
+        self.writer.close()
+
+
+@addClassLogger
+class AsyncSender(object):
+
+    def __init__(self, base_url, headers=None, proxies=None, max_in_flight=10, max_idle=None, timeout=1.0,
+                 verify=False, idle_timeout=30.0, thread_name='datadog-sender'):
+        """
+        :param base_url: url that request paths are relative to, e.g. https://api.datadoghq.com/api/v1/
+        :param headers: headers sent with every request
+        :param proxies: requests style proxies dict, e.g. {'https': 'http://proxy:3128'}
+        :param max_in_flight: maximum number of concurrent requests
+        :param max_idle: maximum number of idle connections kept in the pool, defaults to max_in_flight
+        :param timeout: seconds allowed for a single request (connect, send and read)
+        :param verify: verify the TLS certificate of the endpoint
+        :param idle_timeout: idle connections older than this are not reused
+        :param thread_name: name of the thread running the background event loop
+        """
+        self.base_url = base_url if base_url.endswith('/') else base_url + '/'
+        parts = urlsplit(self.base_url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.base_path = parts.path
+        self.headers = dict(headers or {})
+        self.proxy = (proxies or {}).get(self.scheme)
+        self.proxy_authorization = self._proxy_authorization(self.proxy)
+        self.max_in_flight = max_in_flight
+        self.max_idle = max_idle or max_in_flight
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.thread_name = thread_name
+        self.ssl_context = None
+        if self.scheme == 'https':
+            self.ssl_context = ssl.create_default_context()
+            if not verify:
+                self.ssl_context.check_hostname = False
+                self.ssl_context.verify_mode = ssl.CERT_NONE
+        self.latencies = collections.deque(maxlen=1024)
+        self._idle = collections.deque()
+        self._semaphore = None
+        self._pool_loop = None
+        self._loop = None
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    @staticmethod
+    def _proxy_authorization(proxy):
+        """ :return: Proxy-Authorization header value for the credentials in a proxy url, None without any """
+        if not proxy:
+            return None
+        parts = urlsplit(proxy)
+        if not parts.username:
+            return None
+        credentials = '{}:{}'.format(unquote(parts.username), unquote(parts.password or ''))
+        return 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+
+    # ---- connection pool ----
+    def _bind_loop(self):
+        """ The pool and semaphore belong to the loop they were created on """
+        loop = asyncio.get_running_loop()
+        if self._pool_loop is not loop:
+            self._idle.clear()
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+            self._pool_loop = loop
+
+    async def _connect(self):
+        if self.proxy and self.scheme == 'https':
+            sock = await asyncio.get_running_loop().run_in_executor(None, self._proxy_tunnel)
+            reader, writer = await asyncio.open_connection(sock=sock, ssl=self.ssl_context,
+                                                           server_hostname=self.host)
+        elif self.proxy:
+            proxy = urlsplit(self.proxy)
+            reader, writer = await asyncio.open_connection(proxy.hostname, proxy.port or 80)
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl_context,
+                                                           server_hostname=self.host if self.ssl_context else None)
+        return _Connection(reader, writer)
+
+    def _proxy_tunnel(self):
+        """ Open a CONNECT tunnel through the http proxy, runs in an executor thread """
+        proxy = urlsplit(self.proxy)
+        sock = socket.create_connection((proxy.hostname, proxy.port or 80), timeout=self.timeout)
+        try:
+            target = '{}:{}'.format(self.host, self.port)
+            auth = 'Proxy-Authorization: {}\r\n'.format(self.proxy_authorization) if self.proxy_authorization else ''
+            sock.sendall('CONNECT {0} HTTP/1.1\r\nHost: {0}\r\n{1}\r\n'.format(target, auth).encode())
+            response = b''
+            while b'\r\n\r\n' not in response:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                response += chunk
+            status = response.split(b'\r\n', 1)[0].split()
+            if len(status) < 2 or status[1] != b'200':
+                raise DatadogConnectionError('Proxy CONNECT to {} failed: {}'.format(target, response[:100]))
+            sock.settimeout(None)
+            sock.setblocking(False)
+            return sock
+        except BaseException:
+            sock.close()
+            raise
+
+    def _acquire(self):
+        now = time.monotonic()
+        while self._idle:
+            conn = self._idle.pop()
+            if now - conn.used < self.idle_timeout and not conn.reader.at_eof():
+                return conn
+            conn.close()
+        return None
+
+    def _release(self, conn):
+        conn.used = time.monotonic()
+        if len(self._idle) < self.max_idle:
+            self._idle.append(conn)
+        else:
+            conn.close()
+
+    # ---- requests ----
+    async def request(self, method, path, body=None, headers=None):
+        """
+        Send a request, reusing a pooled connection when one is available
+        :param method: HTTP method
+        :param path: path relative to base_url
+        :param body: request body as bytes
+        :param headers: extra headers for this request
+        :return: SenderResponse
+        """
+        self._bind_loop()
+        async with self._semaphore:
+            started = time.perf_counter()
+            try:
+                response = await asyncio.wait_for(self._request(method, path, body, headers), self.timeout)
+            except asyncio.TimeoutError:
+                raise DatadogConnectionError('Request to {}{} timed out after {}s'.format(
+                    self.base_url, path, self.timeout))
+            except (OSError, asyncio.IncompleteReadError) as e:
+                raise DatadogConnectionError('Request to {}{} failed: {}'.format(self.base_url, path, e))
+            response.latency = time.perf_counter() - started
+            self.latencies.append(response.latency)
+            self.__log.debug('%s %s -> %s in %.1f ms', method, path, response.status_code,
+                             response.latency * 1000)
+            return response
+
+    async def _request(self, method, path, body, headers):
+        conn = self._acquire()
+        reused = conn is not None
+        if conn is None:
+            conn = await self._connect()
+        try:
+            response, keep_alive = await self._exchange(conn, method, path, body, headers)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            conn.close()
+            if not reused or not self._retryable(conn, e):
+                raise
+            # the server closed an idle keep-alive connection before it saw the request, retry once on a fresh one
+            conn = await self._connect()
+            try:
+                response, keep_alive = await self._exchange(conn, method, path, body, headers)
+            except BaseException:
+                # includes the CancelledError of request()'s timeout, the fresh connection is not pooled either
+                conn.close()
+                raise
+        except BaseException:
+            conn.close()
+            raise
+        if keep_alive:
+            self._release(conn)
+        else:
+            conn.close()
+        return response
+
+    @staticmethod
+    def _retryable(conn, error):
+        """
+        A request failed on a reused connection. Retrying is only safe when the server can't have acted on it,
+        otherwise the event could be posted twice
+        :return: True when nothing of the request was written, or not a byte of the response arrived and the
+                 connection was reset, i.e. the request hit a socket the server had already closed. A clean EOF
+                 after the request was written is not retried, the server may have read and processed it
+        """
+        if not conn.written:
+            return True
+        return not conn.received and isinstance(error, (ConnectionResetError, BrokenPipeError))
+
+    async def _exchange(self, conn, method, path, body, headers):
+        conn.written = False
+        conn.received = False
+        target = self.base_path + path
+        all_headers = {'Host': self.host, 'Connection': 'keep-alive', 'Content-Length': str(len(body or b''))}
+        if self.proxy and self.scheme == 'http':
+            target = '{}://{}:{}{}'.format(self.scheme, self.host, self.port, target)
+            if self.proxy_authorization:
+                all_headers['Proxy-Authorization'] = self.proxy_authorization
+        all_headers.update(self.headers)
+        all_headers.update(headers or {})
+        head = '{} {} HTTP/1.1\r\n'.format(method, target) + \
+               ''.join('{}: {}\r\n'.format(k, v) for k, v in all_headers.items()) + '\r\n'
+        if conn.reader.at_eof() or conn.writer.is_closing():
+            raise ConnectionResetError('Connection closed by the server')
+        conn.written = True
+        conn.writer.write(head.encode('latin-1') + (body or b''))
+        await conn.writer.drain()
+
+        status_line = await conn.reader.readuntil(b'\r\n')
+        conn.received = True
+        version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        response_headers = {}
+        while True:
+            line = await conn.reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == 'HTTP/1.1' and response_headers.get('connection', '').lower() != 'close'
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            content = b''
+            while True:
+                size = int((await conn.reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                if size == 0:
+                    await conn.reader.readuntil(b'\r\n')
+                    break
+                content += await conn.reader.readexactly(size)
+                await conn.reader.readexactly(2)
+        elif 'content-length' in response_headers:
+            content = await conn.reader.readexactly(int(response_headers['content-length']))
+        elif method == 'HEAD' or status in ('204', '304'):
+            content = b''
+        else:
+            content = await conn.reader.read()
+            keep_alive = False
+
+        url = '{}{}'.format(self.base_url, path)
+        return SenderResponse(url, int(status), reason, response_headers, content, 0.0), keep_alive
+
+    async def post_json(self, path, payload, headers=None):
+        body = json.dumps(payload).encode()
+        extra = {'Content-Type': 'application/json'}
+        extra.update(headers or {})
+        return await self.request('POST', path, body=body, headers=extra)
+
+    async def send_many(self, path, payloads):
+        """
+        Post many JSON payloads concurrently, bounded by max_in_flight
+        :return: list of SenderResponse or exception per payload, in the order of payloads
+        """
+        return await asyncio.gather(*[self.post_json(path, p) for p in payloads], return_exceptions=True)
+
+    async def aclose(self):
+        while self._idle:
+            self._idle.pop().close()
+
+    # ---- synchronous bridge ----
+    def run(self, coro, timeout=None):
+        """
+        Run a coroutine on the sender's background event loop and wait for the result. Must not be called from
+        a coroutine running on that loop.
+        """
+        return self.submit(coro).result(timeout)
+
+    def submit(self, coro):
+        """
+        Schedule a coroutine on the sender's background event loop without waiting for it. Coroutines start in
+        the order they were submitted.
+        :return: concurrent.futures.Future of the result
+        """
+        with self._thread_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name=self.thread_name,
+                                                daemon=True)
+                self._thread.start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def close(self):
+        with self._thread_lock:
+            if self._loop is not None:
+                asyncio.run_coroutine_threadsafe(self.aclose(), self._loop).result()
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join()
+                self._loop.close()
+                self._loop = None
+                self._thread = None
+
+    def latency_stats(self):
+        """ :return: dict with count, p50 and p99 of recent request latencies in seconds """
+        values = sorted(self.latencies)
+        if not values:
+            return {'count': 0, 'p50': None, 'p99': None}
+        return {'count': len(values), 'p50': values[len(values) // 2],
+                'p99': values[min(len(values) - 1, int(len(values) * 0.99))]}
@@ -0,0 +1,307 @@
+"""
+Fan-out of events to several Datadog destinations (sites or orgs).
+
+datadog_config.conf describes the primary destination, an optional "sinks" list adds more. Each sink takes the
+same keys as the primary config plus a name and optionally its own outbox and lifecycle paths:
+
+    {"api_key": "...", "sinks": [{"name": "eu", "site": "datadoghq.eu", "api_key": "...", "rate_limit": 50}]}
+
+Every sink is isolated: its own Datadog instance (sender loop, connection pool, token bucket and retry budget), its
+own Outbox, its own AlarmLifecycle index since event ids only mean something inside one org, and its own circuit
+breaker state file. An event is
+formatted once and handed to each sink's worker thread, a slow or failing sink only delays (or spools) its own copy.
+"""
+import os
+import time
+import threading
+import concurrent.futures
+from vcenterdd.log.setup import addClassLogger
+from vcenterdd.telemetry.statsd import telemetry
+from vcenterdd.outbox.replay import OutboxReplayer, post_or_spool, event_sender, POSTED, QUEUED, SPOOLED
+
+PRIMARY = 'primary'
+# the post failed and the sink has no outbox to keep the event in
+FAILED = 'failed'
+
+
+def sink_path(path, name):
+    """
+    Path of a per sink file next to the primary one
+    :param path: e.g. vcenterdd/.outbox or vcenterdd/.lifecycle.sqlite
+    :param name: sink name
+    :return: e.g. vcenterdd/.outbox-eu or vcenterdd/.lifecycle-eu.sqlite
+    """
+    root, ext = os.path.splitext(path.rstrip('/'))
+    return '{}-{}{}'.format(root, name, ext)
+
+
+class SinkResult(object):
+    __slots__ = ('sink', 'status', 'error', 'latency')
+
+    def __init__(self, sink, status, error=None, latency=0.0):
+        self.sink = sink
+        self.status = status
+        self.error = error
+        self.latency = latency
+
+    @property
+    def ok(self):
+        """ the event was posted or is kept in the sink's outbox for a later replay """
+        return self.status in (POSTED, QUEUED, SPOOLED)
+
+    def to_dict(self):
+        return {'status': self.status, 'error': None if self.error is None else str(self.error),
+                'latency': self.latency}
+
+    def __repr__(self):
+        return '<SinkResult {} {}>'.format(self.sink, self.status)
+
+
+@addClassLogger
+class Sink(object):
+
+    def __init__(self, name, datadog, outbox=None, lifecycle=None, max_pending=10000, inline=False):
+        """
+        :param name: name of the destination, used in logs, telemetry tags and per sink file names
+        :param datadog: vcenterdd.datadog.handle.Datadog of this destination
+        :param outbox: vcenterdd.outbox.spool.Outbox of this destination, or None to post without spooling
+        :param lifecycle: vcenterdd.alarm.lifecycle.AlarmLifecycle of this destination
+        :param max_pending: events waiting for the worker before new ones go straight to the outbox
+        :param inline: post on the caller's thread instead of a worker thread (single sink setups)
+        """
+        self.name = name
+        self.datadog = datadog
+        self.outbox = outbox
+        self.lifecycle = lifecycle
+        self.max_pending = max_pending
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        if not inline:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                                   thread_name_prefix='sink-{}'.format(name))
+
+    def post(self, datadog_format):
+        """
+        Post (or spool) a copy of an event, never raises
+        :param datadog_format: keyword arguments for Datadog.post_event, not modified
+        :return: SinkResult
+        """
+        started = time.perf_counter()
+        try:
+            status = post_or_spool(self.datadog, self.outbox, dict(datadog_format), lifecycle=self.lifecycle)
+            result = SinkResult(self.name, status, latency=time.perf_counter() - started)
+        except BaseException as e:
+            self.__log.error('Unable to post event %s to %s: %s', datadog_format.get('title'), self.name, e)
+            result = SinkResult(self.name, FAILED, error=e, latency=time.perf_counter() - started)
+        telemetry().increment('sink.events', tags=('sink:{}'.format(self.name), 'status:{}'.format(result.status)))
+        return result
+
+    def submit(self, datadog_format):
+        """
+        Hand an event to the sink's worker, events are posted in the order they were submitted
+        :return: concurrent.futures.Future of the SinkResult
+        """
+        if self._executor is None:
+            return self.run(self.post, datadog_format)
+        with self._lock:
+            backlog = self.pending >= self.max_pending
+            if not backlog:
+                self.pending += 1
+        if backlog and self.outbox is not None:
+            # the destination can't keep up, keep the event in its outbox instead of in memory
+            future = concurrent.futures.Future()
+            future.set_result(self._spool(datadog_format))
+            return future
+        future = self._executor.submit(self.post, datadog_format)
+        if not backlog:
+            future.add_done_callback(self._done)
+        return future
+
+    def run(self, func, *args):
+        """
+        Run a callable on the sink's worker, after the events submitted before it
+        :return: concurrent.futures.Future of the result
+        """
+        if self._executor is not None:
+            return self._executor.submit(func, *args)
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    def _spool(self, datadog_format):
+        from vcenterdd.outbox.spool import encode_event
+
+        try:
+            datadog_format = dict(datadog_format)
+            if self.lifecycle is not None:
+                self.lifecycle.link(datadog_format)
+            self.outbox.append(encode_event(datadog_format))
+            if self.lifecycle is not None:
+                self.lifecycle.record(datadog_format)
+            status, error = QUEUED, None
+        except BaseException as e:
+            status, error = FAILED, e
+        telemetry().increment('sink.events', tags=('sink:{}'.format(self.name), 'status:{}'.format(status)))
+        return SinkResult(self.name, status, error=error)
+
+    def replayer(self):
+        """ :return: OutboxReplayer delivering this sink's spooled events, None without an outbox """
+        if self.outbox is None:
+            return None
+        return OutboxReplayer(self.outbox, send=event_sender(self.datadog, lifecycle=self.lifecycle))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        if self.outbox is not None:
+            self.outbox.close()
+        if self.lifecycle is not None:
+            self.lifecycle.close()
+        self.datadog.close()
+
+
+@addClassLogger
+class SinkSet(object):
+
+    def __init__(self, sinks):
+        """
+        :param sinks: list of Sink, the first one is the primary destination (metrics and logs go there only)
+        """
+        if not sinks:
+            raise ValueError('at least one Datadog sink is required')
+        self.sinks = list(sinks)
+
+    @classmethod
+    def from_config(cls, config_file, config=None, outbox=None, lifecycle=None, lifecycle_ttl=7 * 86400,
+                    max_pending=10000, breaker=None, retry=None):
+        """
+        :param config_file: path to the datadog json config
+        :param config: already parsed config (e.g. from a ConfigSnapshot), config_file is not read when given
+        :param outbox: outbox directory of the primary sink, the others default to <outbox>-<name>
+        :param lifecycle: lifecycle index file of the primary sink, the others default to <name>-suffixed files
+        :param lifecycle_ttl: see AlarmLifecycle
+        :param max_pending: see Sink
+        :param breaker: circuit breaker state file of the primary sink, the others default to <name>-suffixed files
+        :param retry: retry settings of every sink's Datadog, see Datadog
+        :return: SinkSet
+        """
+        import json
+        from .handle import Datadog
+
+        if config is None:
+            with open(config_file) as json_file:
+                config = json.load(json_file)
+        entries = [dict(config, name=config.get('name', PRIMARY))]
+        entries.extend(config.get('sinks') or [])
+        names = [e.get('name') for e in entries]
+        if not all(names) or len(set(names)) != len(names):
+            raise ValueError('every Datadog sink needs a unique name, got {}'.format(names))
+
+        sinks = []
+        try:
+            for index, entry in enumerate(entries):
+                name = entry['name']
+                outbox_path = entry.get('outbox') or (outbox if index == 0 or outbox is None
+                                                      else sink_path(outbox, name))
+                lifecycle_path = entry.get('lifecycle') or (lifecycle if index == 0 or lifecycle is None
+                                                            else sink_path(lifecycle, name))
+                breaker_path = entry.get('breaker') or (breaker if index == 0 or not breaker
+                                                        else sink_path(breaker, name))
+                datadog = Datadog(config_file, config=entry, breaker=breaker_path, retry=retry)
+                sinks.append(cls._open_sink(name, datadog, outbox_path, lifecycle_path, lifecycle_ttl, max_pending,
+                                            inline=len(entries) == 1))
+        except BaseException:
+            for sink in sinks:
+                sink.close()
+            raise
+        return cls(sinks)
+
+    @staticmethod
+    def _open_sink(name, datadog, outbox_path, lifecycle_path, lifecycle_ttl, max_pending, inline):
+        from vcenterdd.outbox.spool import Outbox
+        from vcenterdd.alarm.lifecycle import AlarmLifecycle
+
+        return Sink(name, datadog,
+                    outbox=Outbox(outbox_path) if outbox_path else None,
+                    lifecycle=AlarmLifecycle(lifecycle_path, ttl=lifecycle_ttl) if lifecycle_path else None,
+                    max_pending=max_pending, inline=inline)
+
+    @property
+    def primary(self):
+        return self.sinks[0]
+
+    @property
+    def names(self):
+        return [sink.name for sink in self.sinks]
+
+    def submit(self, datadog_format):
+        """
+        Hand an event to every sink without waiting
+        :param datadog_format: keyword arguments for Datadog.post_event, every sink posts its own copy
+        :return: dict of sink name to concurrent.futures.Future of the SinkResult
+        """
+        return dict((sink.name, sink.submit(datadog_format)) for sink in self.sinks)
+
+    def post(self, datadog_format, timeout=None):
+        """
+        Post an event to every sink concurrently and wait for the outcome
+        :param datadog_format: keyword arguments for Datadog.post_event
+        :param timeout: seconds to wait for the slowest sink, sinks still posting are reported as pending
+        :return: dict of sink name to SinkResult
+        """
+        futures = self.submit(datadog_format)
+        concurrent.futures.wait(futures.values(), timeout=timeout)
+        results = {}
+        for name, future in futures.items():
+            results[name] = future.result() if future.done() else SinkResult(name, 'pending')
+        failed = [name for name, result in results.items() if not result.ok]
+        if failed:
+            self.__log.warning('Event %s not delivered to %s', datadog_format.get('title'), ', '.join(failed))
+        return results
+
+    def replay(self, max_records=None, names=None, timeout=None):
+        """
+        Drain the outboxes of several sinks concurrently, each on its sink's worker
+        :param max_records: records delivered per sink at most
+        :param names: sinks to replay, defaults to all
+        :param timeout: seconds to wait for the slowest sink
+        :return: dict of sink name to records delivered
+        """
+        futures = {}
+        for sink in self.sinks:
+            replayer = sink.replayer() if names is None or sink.name in names else None
+            if replayer is not None:
+                futures[sink.name] = sink.run(replayer.drain, max_records)
+        concurrent.futures.wait(futures.values(), timeout=timeout)
+        return dict((name, future.result() if future.done() and not future.exception() else 0)
+                    for name, future in futures.items())
+
+    def flush(self, timeout=None):
+        """
+        Wait for the events already submitted to every sink
+        :param timeout: seconds to wait for the slowest sink
+        :return: True when every sink caught up
+        """
+        futures = [sink.run(int) for sink in self.sinks]
+        done, pending = concurrent.futures.wait(futures, timeout=timeout)
+        return not pending
+
+    def replayers(self):
+        """ :return: one OutboxReplayer per sink that has an outbox """
+        return [r for r in (sink.replayer() for sink in self.sinks) if r is not None]
+
+    def close(self):
+        """ Wait for the submitted events and release every sink """
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except BaseException as e:
+                self.__log.exception('Exception: %s \n Args: %s', e, e.args)
@@ -0,0 +1,55 @@
+from vcenterdd.log.setup import addClassLogger
+from vcenterdd.telemetry.statsd import telemetry
+from .encryption import AESCipher
+
+
+@addClassLogger
+class CredentialVault(object):
+    """
+    Holds the Datadog API and application keys for the lifetime of the process (or daemon).
+
+    The keys are kept obfuscated with an AESCipher until they are first needed, then decrypted exactly once and
+    turned into ready-to-use request headers. This replaces the decrypt on every request that Datadog used to do.
+    The vault never formats a key into a log message and masks them in its repr.
+
+    This is obfuscation and not actual security, anyone able to read process memory can get the keys.
+    """
+
+    def __init__(self, api_key, app_key=None):
+        self.__cipher = AESCipher()
+        self.__api_key = self.__cipher.encrypt(api_key)
+        self.__app_key = self.__cipher.encrypt(app_key) if app_key else None
+        self.__api_headers = None
+        self.__app_headers = None
+
+    @property
+    def has_app_key(self):
+        return self.__app_key is not None
+
+    def __decrypt(self, enc_txt):
+        with telemetry().timer('datadog.key_decrypt'):
+            return self.__cipher.decrypt(key=self.__cipher.AES_KEY, enc=enc_txt)
+
+    @property
+    def api_headers(self):
+        """ :return: dict with the DD-API-KEY header, the same object on every call """
+        if self.__api_headers is None:
+            self.__api_headers = {'DD-API-KEY': self.__decrypt(self.__api_key)}
+        return self.__api_headers
+
+    @property
+    def app_headers(self):
+        """ :return: dict with the DD-API-KEY and DD-APPLICATION-KEY headers """
+        if self.__app_headers is None:
+            headers = dict(self.api_headers)
+            if self.__app_key is not None:
+                headers['DD-APPLICATION-KEY'] = self.__decrypt(self.__app_key)
+            self.__app_headers = headers
+        return self.__app_headers
+
+    def api_key(self):
+        """ :return: the plaintext API key, for the legacy calls that still pass it in the query string """
+        return self.api_headers['DD-API-KEY']
+
+    def __repr__(self):
+        return '<CredentialVault api_key=*** app_key={}>'.format('***' if self.has_app_key else None)
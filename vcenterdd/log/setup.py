@@ -1,30 +1,126 @@
 
 import sys
+import queue
+import atexit
 import logging
 import logging.config
 import logging.handlers
-import yaml
 from pathlib import Path
 
 
+class _AsyncQueueHandler(logging.handlers.QueueHandler):
+    """
+    Stands in for the handlers of one logger and hands records to the listener thread together with the
+    handlers they are meant for. The record is not formatted here, the listener's handlers do that off the
+    alarm path. A full queue drops the record instead of blocking the caller.
+    """
+
+    def __init__(self, log_queue, targets, on_drop):
+        super().__init__(log_queue)
+        self.targets = tuple(targets)
+        self.on_drop = on_drop
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait((record, self.targets))
+        except queue.Full:
+            self.on_drop()
+
+
+class _RoutingQueueListener(logging.handlers.QueueListener):
+    """ drains (record, handlers) pairs queued by _AsyncQueueHandler """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue, respect_handler_level=True)
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+    def handle(self, item):
+        record, handlers = item
+        for handler in handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
 class LoggerSetup(object):
 
-    def __init__(self, yaml_file, auto_setup=False):
+    def __init__(self, yaml_file=None, auto_setup=False, dict_config=None, use_queue=True, queue_size=10000):
+        """
+        :param yaml_file: logging config in yaml format
+        :param auto_setup: apply the config right away
+        :param dict_config: already parsed config (e.g. from a ConfigSnapshot), yaml_file is not read when given
+        :param use_queue: move handler I/O to a background thread fed by a bounded queue
+        :param queue_size: records held before new ones are dropped
+        """
         self.config_file = yaml_file
-        self._init_dictConfig()
+        self.use_queue = use_queue
+        self.queue_size = queue_size
+        self.dropped = 0
+        self._listener = None
+        if dict_config is not None:
+            self.dictConfig = dict_config
+        else:
+            self._init_dictConfig()
 
         if auto_setup:
             self.setup()
 
     def _init_dictConfig(self):
+        import yaml
+
         with open(self.config_file, 'rt') as f:
             conf = yaml.safe_load(f.read())
             f.close()
         self.dictConfig = conf
 
     def setup(self):
-        self.__validate_fpath_structure()
-        logging.config.dictConfig(self.dictConfig)
+        from vcenterdd.telemetry.statsd import telemetry
+
+        with telemetry().timer('logging.setup'):
+            self.stop()
+            self.__validate_fpath_structure()
+            logging.config.dictConfig(self.dictConfig)
+            if self.use_queue:
+                self.__install_queue()
+
+    def __install_queue(self):
+        """ swap the handlers of every configured logger for queue handlers served by one listener thread """
+
+        log_queue = queue.Queue(self.queue_size)
+        loggers = [logging.getLogger()]
+        loggers.extend(logging.getLogger(name) for name in self.dictConfig.get('loggers') or {})
+        for logger in loggers:
+            if not logger.handlers:
+                continue
+            targets = list(logger.handlers)
+            for handler in targets:
+                logger.removeHandler(handler)
+            logger.addHandler(_AsyncQueueHandler(log_queue, targets, self._record_dropped))
+
+        self._listener = _RoutingQueueListener(log_queue)
+        self._listener.start()
+        atexit.register(self.stop)
+
+    def _record_dropped(self):
+        from vcenterdd.telemetry.statsd import telemetry
+
+        self.dropped += 1
+        telemetry().increment('logging.dropped')
+
+    def stop(self):
+        """ flush the queued records and stop the listener thread """
+
+        listener, self._listener = self._listener, None
+        if listener is None:
+            return
+        atexit.unregister(self.stop)
+        if self.dropped:
+            logging.getLogger(__name__).warning('Log queue full, dropped %s log records', self.dropped)
+        listener.stop()
 
     def __validate_fpath_structure(self):
         """ internal method to locate and pre-create log file structures"""
@@ -0,0 +1,190 @@
+import os
+import fcntl
+import logging
+import threading
+from vcenterdd.log.setup import addClassLogger
+from vcenterdd.telemetry.statsd import telemetry
+from vcenterdd.datadog.exceptions import DatadogConnectionError, DatadogHTTPError
+
+logger = logging.getLogger(__name__)
+
+POSTED = 'posted'
+QUEUED = 'queued'
+SPOOLED = 'spooled'
+
+
+def retryable(error):
+    """
+    Whether a failed post may succeed later, only those are worth keeping in the outbox. A 4xx other than 408 and
+    429 (bad payload, wrong key) fails the same way on every retry
+    :param error: exception raised by a post
+    :return: True for connection errors, timeouts, 408, 429 and 5xx
+    """
+    if isinstance(error, DatadogHTTPError):
+        status = getattr(error.response, 'status_code', None)
+        return status is None or status in (408, 429) or status >= 500
+    return isinstance(error, (DatadogConnectionError, OSError))
+
+
+@addClassLogger
+class OutboxReplayer(object):
+    """
+    Drains an Outbox in order. Records are read in batches and acknowledged once delivered, the first failed
+    delivery stops the drain so ordering is kept and the endpoint is not hammered while it is unhealthy. A record
+    refused for good (see retryable) is moved to the outbox's dead letter file and acknowledged, so it can't hold
+    back the records behind it.
+    Only one replayer per outbox directory runs at a time (across processes), others return right away.
+    """
+
+    def __init__(self, outbox, send, batch_size=100):
+        """
+        :param outbox: vcenterdd.outbox.spool.Outbox
+        :param send: callable taking one record, raises when the record could not be delivered
+        :param batch_size: records read from the outbox per batch
+        """
+        self.outbox = outbox
+        self.send = send
+        self.batch_size = batch_size
+        self.lock_file = os.path.join(outbox.path, '.replay.lock')
+        self.delivered = 0
+        self.failed = 0
+        self.dead_lettered = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def drain(self, max_records=None):
+        """
+        Deliver pending records
+        :param max_records: stop after this many records, None drains the outbox completely
+        :return: number of records delivered
+        """
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.__log.debug('Outbox replay already running in another process')
+                return 0
+            return self._drain(max_records)
+        finally:
+            os.close(fd)
+
+    def _drain(self, max_records):
+        delivered = 0
+        while max_records is None or delivered < max_records:
+            limit = self.batch_size if max_records is None else min(self.batch_size, max_records - delivered)
+            batch = self.outbox.read(max_records=limit)
+            if not batch:
+                break
+            last_position = None
+            healthy = True
+            for position, record in batch:
+                try:
+                    self.send(record)
+                except BaseException as e:
+                    self.failed += 1
+                    if retryable(e):
+                        self.__log.warning('Outbox replay stopped, endpoint still unhealthy: %s', e)
+                        healthy = False
+                        break
+                    self.__log.error('Outbox record refused, moving it to %s: %s', self.outbox.dead_letter_file, e)
+                    self.outbox.dead_letter(record, e)
+                    self.dead_lettered += 1
+                    telemetry().increment('outbox.dead_lettered')
+                    last_position = position
+                    continue
+                last_position = position
+                delivered += 1
+                self.delivered += 1
+            if last_position is not None:
+                self.outbox.ack(last_position)
+            if not healthy:
+                break
+        if delivered:
+            self.__log.info('Replayed %s records from the outbox', delivered)
+        return delivered
+
+    def start(self, interval=5.0):
+        """ Drain the outbox every interval seconds on a background thread (daemon mode) """
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval,), name='outbox-replay', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                if self.outbox.pending():
+                    self.drain()
+            except BaseException as e:
+                self.__log.exception('Exception: %s \n Args: %s', e, e.args)
+
+
+def event_sender(datadog, lifecycle=None):
+    """
+    :param datadog: vcenterdd.datadog.handle.Datadog
+    :param lifecycle: vcenterdd.alarm.lifecycle.AlarmLifecycle recording the ids of the replayed events
+    :return: send callable for OutboxReplayer posting spooled events through datadog
+    """
+    from .spool import decode_event
+
+    def send(record):
+        datadog_format = decode_event(record)
+        if lifecycle is not None and not datadog_format.get('related_event_id'):
+            # the parent was spooled as well, its id is only known once it was replayed ahead of this event
+            lifecycle.link(datadog_format)
+        event_id = datadog.post_event(**datadog_format)
+        if lifecycle is not None:
+            lifecycle.record(datadog_format, event_id)
+    return send
+
+
+def post_or_spool(datadog, outbox, datadog_format, lifecycle=None):
+    """
+    Post an event, spooling it to the outbox when the post fails with an error worth retrying (see retryable),
+    other failures are raised. While older events are still waiting in the outbox the event is spooled behind them
+    so Datadog receives the alarms in order.
+    :param datadog: vcenterdd.datadog.handle.Datadog
+    :param outbox: vcenterdd.outbox.spool.Outbox or None to post without spooling
+    :param datadog_format: keyword arguments for Datadog.post_event
+    :param lifecycle: vcenterdd.alarm.lifecycle.AlarmLifecycle, links the event to the incident it belongs to
+    :return: POSTED, QUEUED when spooled behind older events or SPOOLED when the post failed
+    """
+    from .spool import encode_event
+
+    if lifecycle is not None:
+        lifecycle.link(datadog_format)
+
+    if outbox is None:
+        event_id = datadog.post_event(**datadog_format)
+        if lifecycle is not None:
+            lifecycle.record(datadog_format, event_id)
+        return POSTED
+
+    if outbox.pending():
+        outbox.append(encode_event(datadog_format))
+        telemetry().increment('outbox.spooled', tags=('reason:backlog',))
+        status = QUEUED
+        event_id = None
+    else:
+        try:
+            event_id = datadog.post_event(**datadog_format)
+            status = POSTED
+        except BaseException as e:
+            if not retryable(e):
+                raise
+            logger.warning('Unable to post event, spooling to outbox %s: %s', outbox.path, e)
+            outbox.append(encode_event(datadog_format))
+            telemetry().increment('outbox.spooled', tags=('reason:post_failed',))
+            status = SPOOLED
+            event_id = None
+    if lifecycle is not None:
+        # spooled events update the status now, their id is recorded when the replayer posts them
+        lifecycle.record(datadog_format, event_id)
+    return status
@@ -0,0 +1,276 @@
+"""
+Durable on-disk outbox for Datadog payloads that could not be delivered.
+
+The outbox is a directory of append-only segment files. Each record is a single line
+
+    <crc32 as 8 hex chars> <json document>\n
+
+so a torn write from a crashed process is detected (no trailing newline or bad crc) and skipped when reading.
+Delivery progress is kept in a cursor file (segment number and byte offset) that is replaced atomically when
+records are acknowledged. Segments that lie completely before the cursor are deleted on compaction.
+"""
+import os
+import json
+import time
+import zlib
+import fcntl
+import datetime
+import logging
+from vcenterdd.log.setup import addClassLogger
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.log'
+# records Datadog refused for good, kept for inspection instead of blocking the records behind them
+DEAD_LETTER_FILE = 'dead-letter.jsonl'
+
+
+def encode_event(datadog_format):
+    """
+    Convert the keyword arguments of Datadog.post_event into a JSON safe record
+    :param datadog_format: dict as built by VcenterAlarm.format_datadog_event
+    :return: dict
+    """
+    payload = dict(datadog_format)
+    if isinstance(payload.get('date_happened'), datetime.datetime):
+        payload['date_happened'] = payload['date_happened'].timestamp()
+    return {'kind': 'event', 'payload': payload}
+
+
+def decode_event(record):
+    """ Reverse of encode_event, returns the keyword arguments for Datadog.post_event """
+    payload = dict(record['payload'])
+    if isinstance(payload.get('date_happened'), (int, float)):
+        payload['date_happened'] = datetime.datetime.fromtimestamp(payload['date_happened'])
+    return payload
+
+
+@addClassLogger
+class Outbox(object):
+    """
+    Append-only spool of undelivered payloads, safe to use from several processes at once.
+    Appends take an flock on the directory lock file for the duration of a single write. Writes are fsync'd in
+    batches, every fsync_every records or fsync_interval seconds, and always on flush()/close().
+    """
+
+    def __init__(self, path, segment_bytes=4 * 1024 * 1024, max_bytes=256 * 1024 * 1024, fsync_every=64,
+                 fsync_interval=1.0):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.cursor_file = os.path.join(path, 'cursor.json')
+        self.dead_letter_file = os.path.join(path, DEAD_LETTER_FILE)
+        self.lock_file = os.path.join(path, '.lock')
+        self.dropped_segments = 0
+        self._fd = None
+        self._segment = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        os.makedirs(path, exist_ok=True)
+
+    # ---- segment helpers ----
+    def _segment_path(self, segment):
+        return os.path.join(self.path, '{}{:012d}{}'.format(SEGMENT_PREFIX, segment, SEGMENT_SUFFIX))
+
+    def segments(self):
+        """ :return: sorted list of the segment numbers on disk """
+        segments = []
+        for name in os.listdir(self.path):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                segments.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+        return sorted(segments)
+
+    def _lock(self):
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    @staticmethod
+    def _unlock(fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def _open_segment(self, segment):
+        if self._fd is not None:
+            self._sync()
+            os.close(self._fd)
+        self._fd = os.open(self._segment_path(segment), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        self._segment = segment
+
+    # ---- writing ----
+    def append(self, record):
+        """
+        Append a single record to the outbox
+        :param record: JSON serializable dict
+        :return: None
+        """
+        data = json.dumps(record, separators=(',', ':')).encode()
+        line = '{:08x} '.format(zlib.crc32(data)).encode() + data + b'\n'
+        lock = self._lock()
+        try:
+            segments = self.segments()
+            if not segments:
+                self._open_segment(0)
+            elif self._segment != segments[-1] or not os.path.exists(self._segment_path(self._segment)):
+                self._open_segment(segments[-1])
+            size = os.fstat(self._fd).st_size
+            if size >= self.segment_bytes:
+                self._open_segment(self._segment + 1)
+                self._enforce_size_cap()
+            elif size and os.pread(self._fd, 1, size - 1) != b'\n':
+                # a writer crashed mid-record, terminate the torn line so it is skipped as corrupt on read
+                line = b'\n' + line
+            os.write(self._fd, line)
+            self._unsynced += 1
+        finally:
+            self._unlock(lock)
+
+        if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self._sync()
+
+    def _sync(self):
+        if self._fd is not None and self._unsynced:
+            os.fsync(self._fd)
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def flush(self):
+        self._sync()
+
+    def close(self):
+        if self._fd is not None:
+            self._sync()
+            os.close(self._fd)
+            self._fd = None
+            self._segment = None
+
+    def _enforce_size_cap(self):
+        """ Drop the oldest segments once the outbox grows past max_bytes, the newest alarms are kept """
+        segments = self.segments()
+        sizes = {s: os.path.getsize(self._segment_path(s)) for s in segments}
+        total = sum(sizes.values())
+        for segment in segments[:-1]:
+            if total <= self.max_bytes:
+                break
+            self.__log.warning('Outbox size cap of %s bytes exceeded, dropping segment %s',
+                               self.max_bytes, segment)
+            os.unlink(self._segment_path(segment))
+            total -= sizes[segment]
+            self.dropped_segments += 1
+
+    # ---- reading / acknowledging ----
+    def cursor(self):
+        """ :return: (segment, offset) of the first unacknowledged record """
+        try:
+            with open(self.cursor_file, 'rt') as f:
+                data = json.load(f)
+            return data['segment'], data['offset']
+        except (OSError, ValueError, KeyError):
+            return 0, 0
+
+    def read(self, max_records=100):
+        """
+        Read unacknowledged records in order
+        :param max_records: maximum number of records to return
+        :return: list of (position, record) where position is passed to ack() once the record is delivered
+        """
+        segment, offset = self.cursor()
+        records = []
+        segments = self.segments()
+        for seg in segments:
+            if seg < segment:
+                continue
+            start = offset if seg == segment else 0
+            try:
+                with open(self._segment_path(seg), 'rb') as f:
+                    f.seek(start)
+                    position = start
+                    for line in f:
+                        if not line.endswith(b'\n'):
+                            if seg == segments[-1]:
+                                # in-flight write, pick it up on the next read
+                                return records
+                            # torn write of a crashed writer in a closed segment
+                            break
+                        position += len(line)
+                        record = self._decode_line(line)
+                        if record is not None:
+                            records.append(((seg, position), record))
+                        if len(records) >= max_records:
+                            return records
+            except FileNotFoundError:
+                continue
+        return records
+
+    def _decode_line(self, line):
+        try:
+            crc, data = line[:8], line[9:-1]
+            if int(crc, 16) != zlib.crc32(data):
+                raise ValueError('crc mismatch')
+            return json.loads(data.decode())
+        except ValueError as e:
+            self.__log.warning('Skipping corrupt outbox record: %s', e)
+            return None
+
+    def pending(self):
+        """ :return: True if there are unacknowledged records """
+        segment, offset = self.cursor()
+        for seg in self.segments():
+            if seg > segment:
+                return True
+            if seg == segment and os.path.getsize(self._segment_path(seg)) > offset:
+                return True
+        return False
+
+    def ack(self, position):
+        """
+        Acknowledge every record up to and including position and compact delivered segments
+        :param position: (segment, offset) as returned by read()
+        :return: None
+        """
+        tmp_file = '{}.{}.tmp'.format(self.cursor_file, os.getpid())
+        with open(tmp_file, 'wt') as f:
+            json.dump({'segment': position[0], 'offset': position[1]}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.cursor_file)
+        self.compact()
+
+    def compact(self):
+        """ Delete segments that were completely delivered, the segment being written to is always kept """
+        segment, offset = self.cursor()
+        lock = self._lock()
+        try:
+            segments = self.segments()
+            for seg in segments[:-1]:
+                if seg < segment or (seg == segment and os.path.getsize(self._segment_path(seg)) <= offset):
+                    os.unlink(self._segment_path(seg))
+        finally:
+            self._unlock(lock)
+
+    def dead_letter(self, record, reason):
+        """
+        Set aside a record that can never be delivered, e.g. one Datadog answered with a 400. The caller acks it
+        :param record: the record as returned by read()
+        :param reason: why it was refused, kept with the record
+        :return: None
+        """
+        line = json.dumps({'time': time.time(), 'reason': str(reason), 'record': record}, separators=(',', ':'))
+        lock = self._lock()
+        try:
+            with open(self.dead_letter_file, 'at') as f:
+                f.write(line + '\n')
+        finally:
+            self._unlock(lock)
+
+    def stats(self):
+        segments = self.segments()
+        return {
+            'segments': len(segments),
+            'bytes': sum(os.path.getsize(self._segment_path(s)) for s in segments),
+            'cursor': self.cursor(),
+            'dropped_segments': self.dropped_segments,
+        }
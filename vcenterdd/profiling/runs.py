@@ -0,0 +1,267 @@
+"""
+Per run profiling of the alarm script, for VCSAs where alarm delivery is slow. Used by the --profile flag and the
+VCENTERDD_PROFILE environment variable (sample 1 in N runs).
+
+A profiled run writes one directory under the profile directory, the oldest are removed beyond keep:
+
+    run-20240101T120000-12345/
+        cprofile.pstats     cProfile stats of the whole run, readable with pstats
+        memory.json         tracemalloc peak and current size and the top allocating lines
+        stages.json         wall time per stage: the script phases (imports, LoggerSetup, VcenterAlarm, ...) and
+                            the DNS, key decryption and HTTP timers the code reports to telemetry
+
+Runs that are not sampled cost one random number. Merge many runs into one ranked report with
+
+    python -m vcenterdd.profiling.runs aggregate vcenterdd/.profiles
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import contextlib
+import collections
+from vcenterdd.profiling.startup import StartupProfile
+from vcenterdd.telemetry import statsd
+
+RUN_PREFIX = 'run-'
+PSTATS_FILE = 'cprofile.pstats'
+MEMORY_FILE = 'memory.json'
+STAGES_FILE = 'stages.json'
+
+
+class StageTelemetry(statsd.NullTelemetry):
+    """ Records the timers passing through it as stages and forwards everything to the telemetry it wraps """
+
+    def __init__(self, inner, stages):
+        """
+        :param inner: telemetry the calls are forwarded to
+        :param stages: dict name -> [count, seconds] the timers are summed into
+        """
+        self.inner = inner
+        self.stages = stages
+
+    @property
+    def enabled(self):
+        return self.inner.enabled
+
+    def increment(self, name, value=1, tags=None):
+        self.inner.increment(name, value, tags)
+
+    def gauge(self, name, value, tags=None):
+        self.inner.gauge(name, value, tags)
+
+    def timing(self, name, seconds, tags=None):
+        stage = self.stages.setdefault(name, [0, 0.0])
+        stage[0] += 1
+        stage[1] += seconds
+        self.inner.timing(name, seconds, tags)
+
+    @contextlib.contextmanager
+    def timer(self, name, tags=None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(name, time.perf_counter() - started, tags)
+
+    def register_gauge(self, name, func, tags=None):
+        self.inner.register_gauge(name, func, tags)
+
+    def flush(self):
+        self.inner.flush()
+
+    def start(self):
+        self.inner.start()
+        return self
+
+    def stop(self):
+        self.inner.stop()
+
+
+class RunProfiler(StartupProfile):
+    """
+    StartupProfile that, when the run is sampled, also runs cProfile and tracemalloc and writes everything to a
+    per run directory in report().
+    """
+
+    def __init__(self, directory, sample=1, keep=100, top=25, frames=5, print_phases=False, rng=random.random):
+        """
+        :param directory: profile directory the run directories are created in
+        :param sample: profile 1 in sample runs
+        :param keep: run directories kept, the oldest are removed
+        :param top: allocating lines kept in memory.json
+        :param frames: traceback depth recorded by tracemalloc
+        :param print_phases: also print the phases on stderr like --startup-profile
+        :param rng: callable returning a float in [0, 1)
+        """
+        self.sampled = sample > 0 and (sample == 1 or rng() * sample < 1)
+        super().__init__(enabled=self.sampled or print_phases)
+        self.directory = directory
+        self.keep = keep
+        self.top = top
+        self.frames = frames
+        self.print_phases = print_phases
+        self.stages = {}
+        self._profiler = None
+        self._telemetry = None
+
+    def start(self):
+        """ Start cProfile and tracemalloc, a no-op for runs that are not sampled """
+        if not self.sampled:
+            return self
+        import cProfile
+        import tracemalloc
+
+        tracemalloc.start(self.frames)
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+        self.attach_telemetry()
+        return self
+
+    def attach_telemetry(self):
+        """ Record the telemetry timers as stages, call again after statsd.configure() replaced the telemetry """
+        if self.sampled and not isinstance(statsd.telemetry(), StageTelemetry):
+            self._telemetry = StageTelemetry(statsd.telemetry(), self.stages)
+            statsd.install(self._telemetry)
+
+    def report(self):
+        if self.print_phases:
+            super().report()
+        if not self.sampled or self._profiler is None:
+            return
+        import tracemalloc
+
+        self._profiler.disable()
+        total = time.perf_counter() - self.started
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        if isinstance(statsd.telemetry(), StageTelemetry):
+            statsd.install(statsd.telemetry().inner)
+        try:
+            self.write(total, snapshot, current, peak)
+        except OSError as e:
+            # profiling must never fail the run
+            sys.stderr.write('Unable to write profile to {}: {}\n'.format(self.directory, e))
+
+    def write(self, total, snapshot, current, peak):
+        name = '{}{}-{}'.format(RUN_PREFIX, time.strftime('%Y%m%dT%H%M%S'), os.getpid())
+        path = os.path.join(self.directory, name)
+        partial = path + '.partial'
+        os.makedirs(partial, exist_ok=True)
+        self._profiler.dump_stats(os.path.join(partial, PSTATS_FILE))
+        allocators = [{'where': str(stat.traceback), 'size': stat.size, 'count': stat.count}
+                      for stat in snapshot.statistics('lineno')[:self.top]]
+        with open(os.path.join(partial, MEMORY_FILE), 'wt') as f:
+            json.dump({'peak': peak, 'current': current, 'top': allocators}, f, indent=1)
+        stages = dict((phase, seconds) for phase, seconds in self.phases)
+        stages.update((timer, seconds) for timer, (count, seconds) in self.stages.items())
+        with open(os.path.join(partial, STAGES_FILE), 'wt') as f:
+            json.dump({'host': socket.gethostname(), 'argv': sys.argv, 'started': time.time() - total,
+                       'total': total, 'stages': stages}, f, indent=1)
+        os.rename(partial, path)
+        self.rotate()
+        return path
+
+    def rotate(self):
+        """ Remove the oldest run directories beyond keep """
+        runs = run_directories(self.directory)
+        for path in runs[:max(0, len(runs) - self.keep)]:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def run_directories(directory):
+    """ :return: complete run directories, oldest first """
+    try:
+        names = sorted(n for n in os.listdir(directory) if n.startswith(RUN_PREFIX) and not n.endswith('.partial'))
+    except FileNotFoundError:
+        return []
+    return [os.path.join(directory, n) for n in names]
+
+
+def _percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def aggregate(directory, top=30, sort='cumulative', stream=None):
+    """
+    Merge the runs of a profile directory into one ranked report
+    :param directory: profile directory
+    :param top: functions and allocating lines listed
+    :param sort: pstats sort key of the function ranking
+    :param stream: output, defaults to stdout
+    :return: number of runs merged
+    """
+    import pstats
+
+    stream = stream or sys.stdout
+    runs = run_directories(directory)
+    if not runs:
+        stream.write('No profiled runs in {}\n'.format(directory))
+        return 0
+
+    stages = collections.defaultdict(list)
+    totals = []
+    peaks = []
+    allocators = collections.Counter()
+    stats = None
+    for run in runs:
+        try:
+            with open(os.path.join(run, STAGES_FILE), 'rt') as f:
+                data = json.load(f)
+            with open(os.path.join(run, MEMORY_FILE), 'rt') as f:
+                memory = json.load(f)
+            if stats is None:
+                stats = pstats.Stats(os.path.join(run, PSTATS_FILE), stream=stream)
+            else:
+                stats.add(os.path.join(run, PSTATS_FILE))
+        except (OSError, ValueError, TypeError) as e:
+            stream.write('Skipping {}: {}\n'.format(run, e))
+            continue
+        totals.append(data['total'])
+        for name, seconds in data['stages'].items():
+            stages[name].append(seconds)
+        peaks.append(memory['peak'])
+        for allocator in memory['top']:
+            allocators[allocator['where']] += allocator['size']
+
+    stream.write('{} runs, total p50 {:.1f} ms p95 {:.1f} ms max {:.1f} ms, tracemalloc peak p50 {:.0f} KiB\n\n'
+                 .format(len(totals), _percentile(totals, 0.5) * 1000, _percentile(totals, 0.95) * 1000,
+                         max(totals) * 1000, _percentile(peaks, 0.5) / 1024))
+    stream.write('{:<28} {:>6} {:>10} {:>10} {:>10}\n'.format('stage', 'runs', 'p50 ms', 'p95 ms', 'max ms'))
+    for name, values in sorted(stages.items(), key=lambda item: -_percentile(item[1], 0.5)):
+        stream.write('{:<28} {:>6} {:>10.2f} {:>10.2f} {:>10.2f}\n'.format(
+            name, len(values), _percentile(values, 0.5) * 1000, _percentile(values, 0.95) * 1000,
+            max(values) * 1000))
+    stream.write('\ntop allocating lines (bytes summed over the runs)\n')
+    for where, size in allocators.most_common(top):
+        stream.write('{:>12}  {}\n'.format(size, where))
+    stream.write('\n')
+    stats.sort_stats(sort).print_stats(top)
+    return len(totals)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Profiled runs of the alarm script")
+    sub = parser.add_subparsers(dest='command')
+    report = sub.add_parser('aggregate', help='Merge the profiled runs of a directory into one ranked report')
+    report.add_argument('directory', action='store')
+    report.add_argument('--top', required=False, action='store', type=int, default=30,
+                        help='Functions and allocating lines listed')
+    report.add_argument('--sort', required=False, action='store', default='cumulative',
+                        help='pstats sort key of the function ranking, e.g. cumulative, tottime, ncalls')
+    args = parser.parse_args(argv)
+
+    if args.command == 'aggregate':
+        return 0 if aggregate(args.directory, top=args.top, sort=args.sort) else 1
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,55 @@
+import sys
+import time
+
+
+class StartupProfile(object):
+    """
+    Records wall clock time per startup phase of the alarm script. Used by the --startup-profile flag.
+
+        profile = StartupProfile(enabled=True)
+        with profile.phase('imports'):
+            ...
+        profile.report()
+    """
+
+    def __init__(self, enabled=False, stream=None):
+        self.enabled = enabled
+        self.stream = stream
+        self.phases = []
+        self.started = time.perf_counter()
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def attach_telemetry(self):
+        """ Called once the process wide telemetry is configured, see vcenterdd.profiling.runs.RunProfiler """
+
+    def record(self, name, seconds):
+        self.phases.append((name, seconds))
+
+    def report(self):
+        if not self.enabled:
+            return
+        stream = self.stream or sys.stderr
+        total = time.perf_counter() - self.started
+        stream.write('startup profile:\n')
+        for name, seconds in self.phases:
+            stream.write('  {:<24} {:>9.2f} ms\n'.format(name, seconds * 1000))
+        stream.write('  {:<24} {:>9.2f} ms\n'.format('total', total * 1000))
+
+
+class _Phase(object):
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.profile.enabled:
+            self.profile.record(self.name, time.perf_counter() - self.start)
+        return False
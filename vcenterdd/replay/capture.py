@@ -0,0 +1,34 @@
+"""
+Capture of alarm snapshots for replay. Only the standard library is used so the thin alarm client can capture
+without importing anything heavy. Captures are JSON lines:
+
+    {"captured": 1561100000.0, "env": "env:prod", "alarm": {"VMWARE_ALARM_NAME": ..., ...}}
+"""
+import os
+import json
+import time
+import fcntl
+
+from vcenterdd.daemon.client import alarm_environ
+
+CAPTURE_ENV_VAR = 'VCENTERDD_CAPTURE'
+
+
+def capture_alarm(path, env, environ=None, captured=None):
+    """
+    Append an alarm snapshot to a capture file
+    :param path: JSONL file
+    :param env: env tag of the alarm
+    :param environ: mapping holding the VMWARE_ALARM_* variables, defaults to os.environ
+    :param captured: epoch timestamp, defaults to now
+    :return: None
+    """
+    line = json.dumps({'captured': captured or time.time(), 'env': env,
+                       'alarm': alarm_environ(environ)}, separators=(',', ':')) + '\n'
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+    try:
+        # concurrent alarm runs append to the same file, keep lines whole
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
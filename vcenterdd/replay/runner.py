@@ -0,0 +1,132 @@
+"""
+Replay / backfill of captured alarms.
+
+Capture files (see vcenterdd.replay.capture) are read as a stream, one line at a time, so arbitrarily large
+corpora never sit in memory. Building the VcenterAlarm and formatting it (including DNS) runs in a thread pool,
+posting runs on an asyncio loop through Datadog's dispatcher. A bounded window of alarms in progress keeps the reader
+from running ahead of the sender.
+"""
+import gzip
+import json
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from vcenterdd.alarm.handle import VcenterAlarm
+from vcenterdd.alarm.record import AlarmRecord
+from vcenterdd.log.setup import addClassLogger
+
+logger = logging.getLogger(__name__)
+
+
+def read_captures(paths):
+    """
+    Stream captured alarms from JSONL files (optionally .gz), '-' is not supported as replay needs to know when
+    a file ends
+    :param paths: list of files
+    :return: generator of capture dicts
+    """
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt') as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    capture = json.loads(line)
+                    if not isinstance(capture.get('alarm'), dict):
+                        raise ValueError('no alarm mapping')
+                except ValueError as e:
+                    logger.warning('Skipping %s:%s: %s', path, number, e)
+                    continue
+                yield capture
+
+
+class _NoDns(object):
+    """ Resolver that skips DNS, used for dry runs that only measure formatting throughput """
+
+    @staticmethod
+    def lookup(name):
+        return None
+
+
+@addClassLogger
+class ReplayRunner(object):
+
+    def __init__(self, datadog=None, resolver=None, workers=8, window=200, dry_run=False, env=None,
+                 keep_time=True, rules=None):
+        """
+        :param datadog: vcenterdd.datadog.handle.Datadog, not needed for dry runs
+        :param resolver: vcenterdd.alarm.dnscache.DnsCache or None for uncached DNS
+        :param workers: threads building and formatting alarms
+        :param window: maximum alarms in progress (formatting or posting) at a time
+        :param dry_run: format only, nothing is posted
+        :param env: override the env tag of the captures
+        :param keep_time: post with the captured time instead of now
+        :param rules: vcenterdd.alarm.rules.RuleSet, replays what the rules would have sent
+        """
+        self.datadog = datadog
+        self.resolver = resolver
+        self.workers = workers
+        self.window = window
+        self.dry_run = dry_run
+        self.env = env
+        self.keep_time = keep_time
+        self.rules = rules
+        self.stats = {'read': 0, 'dropped': 0, 'formatted': 0, 'posted': 0, 'failed': 0}
+
+    def build(self, capture):
+        """ Build and format the alarm of a capture, runs in the worker pool, None when the rules drop it """
+        record = AlarmRecord.from_env(capture['alarm'], time=capture.get('captured') if self.keep_time else None)
+        alarm = VcenterAlarm(env=self.env or capture.get('env'), record=record, resolver=self.resolver)
+        if self.rules is not None:
+            decision = self.rules.apply(alarm)
+            if decision is None or 'events' not in decision.destinations:
+                return None
+        alarm.format_datadog_event()
+        return alarm.datadog_format
+
+    async def _handle(self, loop, pool, capture, window):
+        try:
+            datadog_format = await loop.run_in_executor(pool, self.build, capture)
+            if datadog_format is None:
+                self.stats['dropped'] += 1
+                return
+            self.stats['formatted'] += 1
+            if not self.dry_run:
+                await self.datadog.post_event_async(**datadog_format)
+                self.stats['posted'] += 1
+        except BaseException as e:
+            self.stats['failed'] += 1
+            self.__log.warning('Replay of %s failed: %s', capture['alarm'].get('VMWARE_ALARM_NAME'), e)
+        finally:
+            window.release()
+
+    async def _run(self, captures):
+        loop = asyncio.get_running_loop()
+        window = asyncio.Semaphore(self.window)
+        tasks = set()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for capture in captures:
+                await window.acquire()
+                self.stats['read'] += 1
+                task = loop.create_task(self._handle(loop, pool, capture, window))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+
+    def run(self, captures):
+        """
+        Replay captures
+        :param captures: iterable of capture dicts, e.g. read_captures(paths)
+        :return: stats dict including elapsed seconds and alarms per second
+        """
+        if self.dry_run and self.resolver is None:
+            self.resolver = _NoDns()
+        started = time.perf_counter()
+        asyncio.run(self._run(captures))
+        elapsed = time.perf_counter() - started
+        self.stats.update({'elapsed': elapsed,
+                           'alarms_per_second': self.stats['formatted'] / elapsed if elapsed else 0.0})
+        return self.stats
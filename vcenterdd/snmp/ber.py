@@ -0,0 +1,131 @@
+"""
+The subset of ASN.1 BER used by SNMPv1 and SNMPv2c traps, enough to decode the traps vCenter sends and to craft
+test traps. Decoding works on offsets into the datagram and only materialises the values that are asked for.
+"""
+from .exceptions import TrapDecodeError
+
+INTEGER = 0x02
+OCTET_STRING = 0x04
+NULL = 0x05
+OBJECT_IDENTIFIER = 0x06
+SEQUENCE = 0x30
+IP_ADDRESS = 0x40
+COUNTER32 = 0x41
+GAUGE32 = 0x42
+TIMETICKS = 0x43
+COUNTER64 = 0x46
+TRAP_V1 = 0xa4
+TRAP_V2 = 0xa7
+
+UNSIGNED = frozenset((COUNTER32, GAUGE32, TIMETICKS, COUNTER64))
+
+
+def read_tlv(data, pos, end=None):
+    """
+    :param data: bytes
+    :param pos: offset of a tag
+    :param end: offset the value has to end by, defaults to len(data)
+    :return: (tag, value start, value end)
+    """
+    end = len(data) if end is None else end
+    try:
+        tag = data[pos]
+        length = data[pos + 1]
+        pos += 2
+        if length & 0x80:
+            size = length & 0x7f
+            if not size or size > 4:
+                raise TrapDecodeError('Unsupported BER length of {} bytes'.format(size))
+            length = int.from_bytes(data[pos:pos + size], 'big')
+            pos += size
+    except IndexError:
+        raise TrapDecodeError('Truncated BER header at offset {}'.format(pos))
+    if pos + length > end:
+        raise TrapDecodeError('BER value at offset {} runs past its container'.format(pos))
+    return tag, pos, pos + length
+
+
+def read_children(data, start, end):
+    """ :return: list of (tag, value start, value end) of the TLVs between start and end """
+    children = []
+    while start < end:
+        tlv = read_tlv(data, start, end)
+        children.append(tlv)
+        start = tlv[2]
+    return children
+
+
+def decode_integer(data, start, end):
+    return int.from_bytes(data[start:end], 'big', signed=True)
+
+
+def decode_oid(value):
+    """ :return: dotted string of an encoded OBJECT IDENTIFIER value """
+    if not value:
+        raise TrapDecodeError('Empty OBJECT IDENTIFIER')
+    first = value[0]
+    parts = [str(min(first // 40, 2)), str(first - 40 * min(first // 40, 2))]
+    number = 0
+    for byte in value[1:]:
+        number = (number << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            parts.append(str(number))
+            number = 0
+    return '.'.join(parts)
+
+
+def decode_value(tag, data, start, end):
+    """ :return: python value of a varbind value, str for strings and OIDs """
+    if tag == OCTET_STRING:
+        return data[start:end].decode('utf-8', 'replace')
+    if tag == INTEGER:
+        return decode_integer(data, start, end)
+    if tag in UNSIGNED:
+        return int.from_bytes(data[start:end], 'big')
+    if tag == OBJECT_IDENTIFIER:
+        return decode_oid(data[start:end])
+    if tag == IP_ADDRESS:
+        return '.'.join(str(b) for b in data[start:end])
+    if tag == NULL:
+        return None
+    return bytes(data[start:end])
+
+
+# ---- encoding, used to craft traps ----
+def encode_tlv(tag, value):
+    length = len(value)
+    if length < 0x80:
+        return bytes((tag, length)) + value
+    size = (length.bit_length() + 7) // 8
+    return bytes((tag, 0x80 | size)) + length.to_bytes(size, 'big') + value
+
+
+def encode_integer(number, tag=INTEGER):
+    size = max(1, (number.bit_length() + 8) // 8)
+    return encode_tlv(tag, number.to_bytes(size, 'big', signed=tag == INTEGER))
+
+
+def encode_oid_value(oid):
+    """ :return: the encoded value (without tag and length) of a dotted OBJECT IDENTIFIER """
+    parts = [int(p) for p in oid.strip('.').split('.')]
+    body = bytearray([40 * parts[0] + parts[1]])
+    for part in parts[2:]:
+        chunk = [part & 0x7f]
+        part >>= 7
+        while part:
+            chunk.append(0x80 | (part & 0x7f))
+            part >>= 7
+        body.extend(reversed(chunk))
+    return bytes(body)
+
+
+def encode_oid(oid):
+    return encode_tlv(OBJECT_IDENTIFIER, encode_oid_value(oid))
+
+
+def encode_string(text):
+    return encode_tlv(OCTET_STRING, text.encode('utf-8') if isinstance(text, str) else text)
+
+
+def encode_sequence(*items, tag=SEQUENCE):
+    return encode_tlv(tag, b''.join(items))
@@ -0,0 +1,8 @@
+
+
+class SnmpException(BaseException):
+    pass
+
+
+class TrapDecodeError(SnmpException):
+    pass
@@ -0,0 +1,189 @@
+import socket
+import asyncio
+import threading
+import collections
+from vcenterdd.log.setup import addClassLogger
+from vcenterdd.telemetry.statsd import telemetry
+from .exceptions import TrapDecodeError
+from .trap import decode_trap, encode_response
+
+DEFAULT_PORT = 162
+# datagrams read and decoded per loop iteration at most
+BATCH_SIZE = 256
+
+
+def parse_address(address):
+    """
+    :param address: "host:port", "host" or ":port", "[::1]:port" for IPv6
+    :return: (host, port)
+    """
+    host, sep, port = address.rpartition(':')
+    if not sep or ']' in port:
+        host, port = address, DEFAULT_PORT
+    return host.strip('[]') or '0.0.0.0', int(port)
+
+
+@addClassLogger
+class TrapListener(object):
+    """
+    Receives the SNMP traps vCenter alarms send and submits each alarm to the pipeline as VMWARE_ALARM_* environ,
+    the same way the daemon socket and the collectors do, without a process per alarm.
+
+    The UDP socket is served by an asyncio loop on a thread of its own. When the socket becomes readable up to
+    batch_size datagrams are read at once and decoded and submitted as a batch, so a burst of traps costs one loop
+    iteration per batch rather than one per trap.
+
+    The env tag of an alarm comes from the community of its trap, traps from communities that aren't configured
+    are counted and dropped.
+    """
+
+    def __init__(self, submit, communities, address=('0.0.0.0', DEFAULT_PORT), recv_buffer=4 * 1024 * 1024,
+                 batch_size=BATCH_SIZE):
+        """
+        :param submit: callable(env, environ), e.g. AlarmPipeline.submit
+        :param communities: dict of community to the env tag of the alarms sent with it
+        :param address: (host, port) to listen on
+        :param recv_buffer: SO_RCVBUF of the socket, absorbs bursts while a batch is being submitted
+        :param batch_size: datagrams decoded per loop iteration at most
+        """
+        self.submit = submit
+        self.communities = dict(communities)
+        self.address = address
+        self.recv_buffer = recv_buffer
+        self.batch_size = batch_size
+        self.stats = collections.Counter()
+        self._sock = None
+        self._loop = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._error = None
+
+    def _read(self):
+        """ Reader callback, reads the datagrams waiting in the socket buffer and handles them as one batch """
+        batch = []
+        recvfrom = self._sock.recvfrom
+        try:
+            for _ in range(self.batch_size):
+                batch.append(recvfrom(65535))
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            self.__log.warning('SNMP trap socket error: %s', e)
+        self.handle(batch)
+
+    def handle(self, batch):
+        """
+        Decode a batch of datagrams and submit their alarms
+        :param batch: list of (datagram, address)
+        :return: number of alarms submitted
+        """
+        submitted = 0
+        stats = self.stats
+        for data, addr in batch:
+            stats['received'] += 1
+            try:
+                community, environ, request_id = decode_trap(data)
+            except TrapDecodeError as e:
+                stats['malformed'] += 1
+                self.__log.debug('Malformed SNMP trap from %s: %s', addr[0], e)
+                continue
+            env = self.communities.get(community)
+            if env is None:
+                stats['unauthorized'] += 1
+                self.__log.debug('Ignoring SNMP trap from %s with an unknown community', addr[0])
+                continue
+            if environ is None:
+                # a trap without the vpxdAlarm varbinds, e.g. a coldStart or another vCenter event, is dropped on
+                # purpose, acknowledging it stops the sender from retrying it
+                stats['ignored'] += 1
+                self._acknowledge(community, request_id, data, addr)
+                continue
+            try:
+                queued = self.submit(env, environ)
+            except BaseException as e:
+                queued = False
+                self.__log.exception('Exception: %s \n Args: %s', e, e.args)
+            if queued:
+                submitted += 1
+                # an inform is only acknowledged once the pipeline holds its alarm, otherwise vCenter sends it again
+                self._acknowledge(community, request_id, data, addr)
+            else:
+                stats['rejected'] += 1
+        stats['submitted'] += submitted
+        if batch:
+            t = telemetry()
+            t.increment('snmp.traps', len(batch))
+            t.gauge('snmp.batch', len(batch))
+        return submitted
+
+    def _acknowledge(self, community, request_id, data, addr):
+        """ Send the Response-PDU of an inform, traps (request_id None) aren't acknowledged """
+        if request_id is None:
+            return
+        try:
+            self._sock.sendto(encode_response(community, request_id, data), addr)
+        except OSError as e:
+            self.__log.debug('Unable to acknowledge SNMP inform from %s: %s', addr[0], e)
+
+    def _open_socket(self):
+        host, port = self.address
+        family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer)
+        except OSError as e:
+            self.__log.warning('Unable to set the SNMP receive buffer to %s bytes: %s', self.recv_buffer, e)
+        sock.bind((host, port))
+        sock.setblocking(False)
+        return sock
+
+    def _serve(self):
+        loop = self._loop
+        asyncio.set_event_loop(loop)
+        try:
+            self._sock = self._open_socket()
+            self.address = self._sock.getsockname()[:2]
+            loop.add_reader(self._sock.fileno(), self._read)
+        except BaseException as e:
+            self._error = e
+            self._ready.set()
+            loop.close()
+            return
+        self.__log.info('Listening for SNMP traps on %s:%s', self.address[0], self.address[1])
+        self._ready.set()
+        try:
+            loop.run_forever()
+            # hand the traps that were already received to the pipeline
+            self._read()
+        finally:
+            loop.remove_reader(self._sock.fileno())
+            self._sock.close()
+            loop.close()
+
+    def start(self):
+        """
+        Bind the socket and serve it on a background thread
+        :return: self
+        """
+        if self._thread is None:
+            self._loop = asyncio.new_event_loop()
+            self._ready.clear()
+            self._thread = threading.Thread(target=self._serve, name='snmp-traps', daemon=True)
+            self._thread.start()
+            self._ready.wait()
+            if self._error is not None:
+                if self._sock is not None:
+                    self._sock.close()
+                    self._sock = None
+                self._thread.join()
+                self._thread = None
+                error, self._error = self._error, None
+                self.__log.error('Unable to listen for SNMP traps on %s: %s', self.address, error)
+                raise error
+        return self
+
+    def stop(self, timeout=5.0):
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout)
+            self._thread = None
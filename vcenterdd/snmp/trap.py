@@ -0,0 +1,211 @@
+"""
+Decoding of the SNMP traps vCenter sends for alarms (VMWARE-VC-EVENT-MIB vpxdAlarm) into the VMWARE_ALARM_*
+environ the "Run a Script" action would get, so a trap becomes the same VcenterAlarm and Datadog event.
+
+Both SNMPv1 traps and SNMPv2c traps and informs are decoded. The alarm varbinds live under
+1.3.6.1.4.1.6876.4.3 (vmwVpxdTrap...):
+
+    301 TrapType        alarm name          302 HostName        host the alarm is on, or the VM's host
+    303 VMName          VM the alarm is on  304 OldStatus       Gray, Green, Yellow, Red
+    305 NewStatus                           306 ObjValue        triggering value of the alarm
+    307 TargetObj       target object name  308 TargetObjType   e.g. HostSystem, Datastore
+
+Craft traps for testing with
+
+    python -m vcenterdd.snmp.trap send --to 127.0.0.1:1162 --name "Host CPU usage" --target esx01 --count 1000
+"""
+import sys
+import time
+import socket
+import argparse
+from .exceptions import TrapDecodeError
+from .ber import read_tlv, read_children, decode_integer, decode_value, encode_tlv, encode_integer, encode_oid, \
+    encode_oid_value, encode_string, encode_sequence, INTEGER, OCTET_STRING, SEQUENCE, OBJECT_IDENTIFIER, \
+    TIMETICKS, IP_ADDRESS, TRAP_V1, TRAP_V2
+from vcenterdd.alarm.record import ENV_NAMES
+
+VMWARE_TRAP_ROOT = '1.3.6.1.4.1.6876.4.3'
+VPXD_ALARM_TRAP = VMWARE_TRAP_ROOT + '.0.201'
+SYS_UPTIME = '1.3.6.1.2.1.1.3.0'
+SNMP_TRAP_OID = '1.3.6.1.6.3.1.1.4.1.0'
+INFORM = 0xa6
+RESPONSE = 0xa2
+VARBINDS = {
+    301: 'alarm_name',
+    302: 'host_name',
+    303: 'vm_name',
+    304: 'oldstatus',
+    305: 'newstatus',
+    306: 'alarmvalue',
+    307: 'target',
+    308: 'target_type',
+}
+V1 = 0
+V2C = 1
+
+
+def _oid_keys():
+    """ :return: dict of the encoded OID value of every alarm varbind, with and without the .0 instance, to name """
+    keys = {}
+    for number, name in VARBINDS.items():
+        oid = '{}.{}'.format(VMWARE_TRAP_ROOT, number)
+        keys[encode_oid_value(oid)] = name
+        keys[encode_oid_value(oid + '.0')] = name
+    return keys
+
+
+# varbinds are matched on their encoded OID, no OID is decoded on the hot path
+_OID_KEYS = _oid_keys()
+
+
+def alarm_environ(values):
+    """
+    Build the VMWARE_ALARM_* mapping from the decoded alarm varbinds, the event description reads like the one
+    vCenter passes to scripts. Traps carry no managed object ids: NAME is the display name of the alarm rather than
+    its alarm.* id and TARGET_ID is the name of the target rather than its moref, so the alarm_key_hash differs from
+    the one of the same alarm run as a script
+    :param values: dict of VARBINDS names to values
+    :return: dict usable as VcenterAlarm(environ=...)
+    """
+    target = values.get('vm_name') or values.get('host_name') or values.get('target') or ''
+    name = values.get('alarm_name') or ''
+    old_status = values.get('oldstatus') or ''
+    new_status = values.get('newstatus') or ''
+    return {
+        ENV_NAMES['alarm_name']: name,
+        ENV_NAMES['target_id']: values.get('target') or target,
+        ENV_NAMES['target_name']: target,
+        ENV_NAMES['oldstatus']: old_status,
+        ENV_NAMES['newstatus']: new_status,
+        ENV_NAMES['eventdescription']: "Alarm '{}' on {} changed from {} to {}".format(
+            name, target, old_status, new_status),
+        ENV_NAMES['alarmvalue']: values.get('alarmvalue') or '',
+    }
+
+
+def decode_trap(datagram):
+    """
+    :param datagram: bytes of one SNMP message
+    :return: (community, environ, request_id), environ is None for traps without the VMware alarm varbinds and
+             request_id is None unless the message is an inform that expects a response
+    :raises TrapDecodeError: the datagram isn't a well formed SNMP trap
+    """
+    tag, start, end = read_tlv(datagram, 0)
+    if tag != SEQUENCE:
+        raise TrapDecodeError('Not an SNMP message, tag 0x{:02x}'.format(tag))
+    children = read_children(datagram, start, end)
+    if len(children) != 3 or children[0][0] != INTEGER or children[1][0] != OCTET_STRING:
+        raise TrapDecodeError('Malformed SNMP message header')
+    version = decode_integer(datagram, children[0][1], children[0][2])
+    community = datagram[children[1][1]:children[1][2]].decode('utf-8', 'replace')
+    pdu, start, end = children[2]
+
+    request_id = None
+    if version == V1 and pdu == TRAP_V1:
+        fields = read_children(datagram, start, end)
+        if len(fields) != 6:
+            raise TrapDecodeError('Malformed SNMPv1 trap')
+        varbinds = fields[5]
+    elif version == V2C and pdu in (TRAP_V2, INFORM):
+        fields = read_children(datagram, start, end)
+        if len(fields) != 4:
+            raise TrapDecodeError('Malformed SNMPv2 trap')
+        if pdu == INFORM:
+            request_id = decode_integer(datagram, fields[0][1], fields[0][2])
+        varbinds = fields[3]
+    else:
+        raise TrapDecodeError('Unsupported SNMP version {} or PDU 0x{:02x}'.format(version, pdu))
+    if varbinds[0] != SEQUENCE:
+        raise TrapDecodeError('Malformed varbind list')
+
+    values = {}
+    for tag, start, end in read_children(datagram, varbinds[1], varbinds[2]):
+        if tag != SEQUENCE:
+            raise TrapDecodeError('Malformed varbind')
+        oid_tag, oid_start, oid_end = read_tlv(datagram, start, end)
+        if oid_tag != OBJECT_IDENTIFIER:
+            raise TrapDecodeError('Varbind without an OBJECT IDENTIFIER')
+        name = _OID_KEYS.get(datagram[oid_start:oid_end])
+        if name is not None:
+            value_tag, value_start, value_end = read_tlv(datagram, oid_end, end)
+            values[name] = decode_value(value_tag, datagram, value_start, value_end)
+    if not values.get('alarm_name') or not values.get('newstatus'):
+        return community, None, request_id
+    return community, alarm_environ(values), request_id
+
+
+def encode_response(community, request_id, datagram):
+    """
+    :param datagram: the inform being acknowledged
+    :return: bytes of the Response-PDU acknowledging an inform, echoing its varbinds
+    """
+    tag, start, end = read_tlv(datagram, 0)
+    pdu, start, end = read_children(datagram, start, end)[2]
+    varbinds = read_children(datagram, start, end)[3]
+    return encode_sequence(
+        encode_integer(V2C), encode_string(community),
+        encode_sequence(encode_integer(request_id), encode_integer(0), encode_integer(0),
+                        encode_tlv(SEQUENCE, datagram[varbinds[1]:varbinds[2]]), tag=RESPONSE))
+
+
+def encode_trap(name, target, old_status, new_status, community='public', value='', host=None, vm=None,
+                target_type='HostSystem', version=V2C, uptime=0):
+    """
+    Craft a vpxdAlarm trap the way vCenter sends it
+    :return: bytes of the SNMP message
+    """
+    alarm = [(301, name), (302, host if host is not None else target), (303, vm or ''), (304, old_status),
+             (305, new_status), (306, value), (307, target), (308, target_type)]
+    varbinds = [encode_sequence(encode_oid('{}.{}.0'.format(VMWARE_TRAP_ROOT, number)), encode_string(text))
+                for number, text in alarm]
+    if version == V1:
+        pdu = encode_sequence(encode_oid(VMWARE_TRAP_ROOT), encode_tlv(IP_ADDRESS, bytes(4)), encode_integer(6),
+                              encode_integer(201), encode_integer(uptime, tag=TIMETICKS),
+                              encode_sequence(*varbinds), tag=TRAP_V1)
+    else:
+        varbinds = [encode_sequence(encode_oid(SYS_UPTIME), encode_integer(uptime, tag=TIMETICKS)),
+                    encode_sequence(encode_oid(SNMP_TRAP_OID), encode_oid(VPXD_ALARM_TRAP))] + varbinds
+        pdu = encode_sequence(encode_integer(int(time.time()) & 0x7fffffff), encode_integer(0), encode_integer(0),
+                              encode_sequence(*varbinds), tag=TRAP_V2)
+    return encode_sequence(encode_integer(version), encode_string(community), pdu)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Craft and send vCenter alarm SNMP traps")
+    sub = parser.add_subparsers(dest='command')
+    send = sub.add_parser('send', help='Send crafted vpxdAlarm traps')
+    send.add_argument('--to', required=True, action='store', help='host:port of the trap listener')
+    send.add_argument('--community', required=False, action='store', default='public')
+    send.add_argument('--name', required=False, action='store', default='Host CPU usage')
+    send.add_argument('--target', required=False, action='store', default='esx01.example.com')
+    send.add_argument('--old', required=False, action='store', default='Green')
+    send.add_argument('--new', required=False, action='store', default='Red')
+    send.add_argument('--v1', required=False, action='store_true', help='Send SNMPv1 traps instead of v2c')
+    send.add_argument('--count', required=False, action='store', type=int, default=1,
+                      help='Traps sent, the targets are numbered when more than one')
+    send.add_argument('--rate', required=False, action='store', type=float, default=0,
+                      help='Traps per second, 0 sends as fast as possible')
+    args = parser.parse_args(argv)
+
+    if args.command != 'send':
+        parser.print_help()
+        return 2
+    host, port = args.to.rsplit(':', 1)
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_DGRAM)
+    started = time.perf_counter()
+    for n in range(args.count):
+        target = args.target if args.count == 1 else '{}-{}'.format(args.target, n)
+        sock.sendto(encode_trap(args.name, target, args.old, args.new, community=args.community,
+                                version=V1 if args.v1 else V2C), (host.strip('[]'), int(port)))
+        if args.rate:
+            delay = started + (n + 1) / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    elapsed = time.perf_counter() - started
+    sys.stdout.write('Sent {} traps in {:.2f}s\n'.format(args.count, elapsed))
+    sock.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,252 @@
+"""
+Self-telemetry over DogStatsD.
+
+Hot paths record into an in-process aggregate (counters are summed, gauges keep the last value, timings keep their
+samples) and a background thread flushes it as UDP datagrams to the local agent every flush_interval seconds.
+Recording is a dict update under a lock, sending never blocks: the socket is non-blocking and a full buffer or an
+absent agent only increments a drop counter.
+
+Instrumented code calls telemetry() which returns a no-op NullTelemetry until configure() installs a StatsdTelemetry:
+
+    vcenterdd.alarm.parse / .format / .dns           timings (ms) of VcenterAlarm stages
+    vcenterdd.dns.hit / .miss / .nxdomain            DnsCache counters
+    vcenterdd.datadog.key_decrypt                    timing of the API key decryption
+    vcenterdd.datadog.post                           timing of Datadog.post_event, status:success|failure tags
+    vcenterdd.datadog.retries / .throttled           Dispatcher counters
+    vcenterdd.breaker.transition / .rejected         circuit breaker state changes (state tag) and fast failed requests
+    vcenterdd.logging.setup                          timing of LoggerSetup.setup
+    vcenterdd.logging.dropped                        log records dropped because the log queue was full
+    vcenterdd.queue.depth                            gauge per queue:<name>, sampled at every flush
+    vcenterdd.queue.shed                             alarms downgraded, shed, evicted or rejected by the daemon's
+                                                     priority queue, outcome and alert_type tags
+    vcenterdd.snmp.traps / .batch                    SNMP traps received, datagrams read per loop iteration
+"""
+import time
+import socket
+import logging
+import threading
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PREFIX = 'vcenterdd.'
+DEFAULT_PORT = 8125
+
+
+class NullTelemetry(object):
+    """ Telemetry that records nothing, the default until configure() is called """
+
+    enabled = False
+
+    def increment(self, name, value=1, tags=None):
+        pass
+
+    def gauge(self, name, value, tags=None):
+        pass
+
+    def timing(self, name, seconds, tags=None):
+        pass
+
+    @contextlib.contextmanager
+    def timer(self, name, tags=None):
+        yield
+
+    def register_gauge(self, name, func, tags=None):
+        pass
+
+    def flush(self):
+        pass
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+
+class StatsdTelemetry(NullTelemetry):
+    """ Aggregates metrics in process and flushes them as DogStatsD datagrams """
+
+    enabled = True
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, prefix=DEFAULT_PREFIX, tags=None, flush_interval=10.0,
+                 max_packet=1432, max_samples=1000):
+        """
+        :param host: DogStatsD host
+        :param port: DogStatsD UDP port
+        :param prefix: prepended to every metric name
+        :param tags: constant tags added to every metric
+        :param flush_interval: seconds between flushes when started with start()
+        :param max_packet: maximum datagram size, metrics are packed newline separated up to this size
+        :param max_samples: timing samples kept per metric and tag set between flushes
+        """
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.tags = tuple(tags or ())
+        self.flush_interval = flush_interval
+        self.max_packet = max_packet
+        self.max_samples = max_samples
+        self.dropped = 0
+        self._counts = {}
+        self._gauges = {}
+        self._timings = {}
+        self._gauge_funcs = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def increment(self, name, value=1, tags=None):
+        key = (name, tuple(tags) if tags else ())
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + value
+
+    def gauge(self, name, value, tags=None):
+        key = (name, tuple(tags) if tags else ())
+        with self._lock:
+            self._gauges[key] = value
+
+    def timing(self, name, seconds, tags=None):
+        key = (name, tuple(tags) if tags else ())
+        with self._lock:
+            samples = self._timings.get(key)
+            if samples is None:
+                samples = self._timings[key] = []
+            if len(samples) < self.max_samples:
+                samples.append(seconds * 1000.0)
+            else:
+                self.dropped += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, tags=None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(name, time.perf_counter() - started, tags)
+
+    def register_gauge(self, name, func, tags=None):
+        """
+        Sample func() at every flush and report it as a gauge, e.g. the depth of a queue
+        :param func: callable returning a number, exceptions are ignored
+        """
+        self._gauge_funcs.append((name, tuple(tags or ()), func))
+
+    def _line(self, name, values, kind, tags):
+        tags = self.tags + tags
+        line = '{}{}:{}|{}'.format(self.prefix, name, ':'.join(_number(v) for v in values), kind)
+        if tags:
+            line += '|#' + ','.join(tags)
+        return line
+
+    def lines(self):
+        """ :return: DogStatsD lines of everything recorded since the last call, resetting the aggregate """
+        for name, tags, func in self._gauge_funcs:
+            try:
+                self.gauge(name, func(), tags)
+            except Exception:
+                pass
+        with self._lock:
+            counts, self._counts = self._counts, {}
+            gauges, self._gauges = self._gauges, {}
+            timings, self._timings = self._timings, {}
+        lines = []
+        for (name, tags), value in counts.items():
+            lines.append(self._line(name, (value,), 'c', tags))
+        for (name, tags), value in gauges.items():
+            lines.append(self._line(name, (value,), 'g', tags))
+        for (name, tags), samples in timings.items():
+            # multi-value packets, several samples of one timer share a line
+            chunk = []
+            for sample in samples:
+                chunk.append(sample)
+                if len(chunk) == 50:
+                    lines.append(self._line(name, chunk, 'ms', tags))
+                    chunk = []
+            if chunk:
+                lines.append(self._line(name, chunk, 'ms', tags))
+        return lines
+
+    def flush(self):
+        """ Send the aggregate as datagrams of at most max_packet bytes """
+        packet = b''
+        for line in self.lines():
+            data = line.encode('utf-8')
+            if packet and len(packet) + 1 + len(data) > self.max_packet:
+                self._send(packet)
+                packet = b''
+            packet = packet + b'\n' + data if packet else data
+        if packet:
+            self._send(packet)
+
+    def _send(self, packet):
+        try:
+            self._socket.sendto(packet, self.address)
+        except OSError:
+            self.dropped += 1
+
+    def start(self):
+        if self.flush_interval and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='statsd-telemetry', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.debug('Telemetry flush failed: %s', e)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        self._socket.close()
+
+
+def _number(value):
+    if isinstance(value, float):
+        return '{:.3f}'.format(value).rstrip('0').rstrip('.')
+    return str(value)
+
+
+_telemetry = NullTelemetry()
+
+
+def telemetry():
+    """ :return: the process wide telemetry, a NullTelemetry unless configure() was called """
+    return _telemetry
+
+
+def configure(address=None, **kwargs):
+    """
+    Install a StatsdTelemetry as the process wide telemetry
+    :param address: 'host:port', 'host' or ':port' of the DogStatsD agent, defaults to 127.0.0.1:8125
+    :param kwargs: passed to StatsdTelemetry
+    :return: the StatsdTelemetry, not started
+    :raises ValueError: the port isn't a number
+    """
+    global _telemetry
+    if address:
+        host, sep, port = address.rpartition(':')
+        if not sep:
+            host, port = address, ''
+        kwargs.setdefault('host', host or '127.0.0.1')
+        kwargs.setdefault('port', int(port) if port else DEFAULT_PORT)
+    _telemetry = StatsdTelemetry(**kwargs)
+    return _telemetry
+
+
+def install(instance):
+    """
+    Replace the process wide telemetry, e.g. with a wrapper that also records what passes through it
+    :param instance: NullTelemetry compatible object
+    :return: the telemetry installed before
+    """
+    global _telemetry
+    previous, _telemetry = _telemetry, instance
+    return previous